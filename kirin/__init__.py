@@ -26,9 +26,12 @@
 # IRC #navitia on freenode
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
+import atexit
 import os
 from kirin import exceptions
 from kirin.rabbitmq_handler import RabbitMQHandler
+from kirin.worker import Worker
+from kirin.cache import LruTtlCache, SingleFlight
 
 VERSION = '0.2.2'
 
@@ -67,6 +70,54 @@ else:  # Default is std out
     app.logger.setLevel('INFO')
 
 rabbitmq_handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'],
-                                   app.config['EXCHANGE'])
+                                   app.config['EXCHANGE'],
+                                   async_publish=app.config['RABBITMQ_ASYNC_PUBLISH'],
+                                   queue_size=app.config['RABBITMQ_PUBLISH_QUEUE_SIZE'],
+                                   batch_delay=app.config['RABBITMQ_PUBLISH_BATCH_DELAY'],
+                                   confirm_publish=app.config['RABBITMQ_CONFIRM_PUBLISH'],
+                                   spool_path=app.config['RABBITMQ_SPOOL_PATH'],
+                                   replay_interval=app.config['RABBITMQ_SPOOL_REPLAY_INTERVAL'],
+                                   retries=app.config['RABBITMQ_PUBLISH_RETRIES'],
+                                   retry_delay=app.config['RABBITMQ_PUBLISH_RETRY_DELAY'])
+
+worker = Worker(app, app.config['WORKER_POOL_SIZE'], app.config['WORKER_MAX_PENDING'])
+
+# the serialized FeedEntity of the last versions of the trip updates
+gtfs_rt_entity_cache = LruTtlCache(app.config['GTFS_RT_ENTITY_CACHE_SIZE'], app.config['GTFS_RT_ENTITY_CACHE_TTL'])
+
+from kirin.core.coalescer import Coalescer
+coalescer = Coalescer(rabbitmq_handler.publish, gtfs_rt_entity_cache, app.config['COALESCING_RETRY_DELAY'])
+
+
+def _shutdown():
+    """
+    publish the trip updates still held before the process exits
+    """
+    coalescer.flush_all()
+    rabbitmq_handler.join(timeout=app.config['SHUTDOWN_PUBLISH_TIMEOUT'])
+
+atexit.register(_shutdown)
+
+navitia_vj_cache = LruTtlCache(app.config['NAVITIA_VJ_CACHE_SIZE'], app.config['NAVITIA_VJ_CACHE_TTL'])
+navitia_vj_miss_cache = LruTtlCache(app.config['NAVITIA_VJ_MISS_CACHE_SIZE'],
+                                    app.config['NAVITIA_VJ_MISS_CACHE_TTL'])
+navitia_single_flight = SingleFlight()
+
+from kirin.vj_catalogue import VJCatalogue, start_daily_load
+vj_catalogue = VJCatalogue()
+if app.config['NAVITIA_VJ_CATALOGUE']:
+    start_daily_load(app, vj_catalogue)
+
+from kirin.core.feed_cache import FullFeedCache, start_refresh
+gtfs_rt_feed = FullFeedCache(app.config['GTFS_RT_FEED_DAYS_BEFORE'], gtfs_rt_entity_cache)
+start_refresh(app, gtfs_rt_feed, app.config['GTFS_RT_FEED_REFRESH_PERIOD'])
+
+if app.config['PUBLISH_OUTBOX'] and app.config['OUTBOX_RELAY_IN_APP']:
+    from kirin.core.outbox import start_relay
+    start_relay(app, rabbitmq_handler.publish_confirmed, app.config['OUTBOX_RELAY_BATCH_SIZE'],
+                app.config['OUTBOX_RELAY_INTERVAL'])
+
+from kirin.ire.dedup import Deduplicator
+ire_deduplicator = Deduplicator(app.config['IRE_DEDUP_CACHE_SIZE'], app.config['IRE_DEDUP_WINDOW'])
 
 import kirin.api
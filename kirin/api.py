@@ -53,6 +53,10 @@ api.add_resource(ire.Ire,
                  '/ire',
                  endpoint='ire')
 
+api.add_resource(resources.GtfsRt,
+                 '/gtfs_rt',
+                 endpoint='gtfs_rt')
+
 
 def log_exception(sender, exception):
     """
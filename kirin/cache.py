@@ -0,0 +1,125 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+from collections import OrderedDict
+import time
+from gevent.event import AsyncResult
+
+
+class LruTtlCache(object):
+    """
+    bounded in memory cache
+
+    the entries expire after 'ttl' seconds and when the cache is full
+    the least recently used entry is evicted
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return default
+        # we reinsert the entry to flag it as the most recently used
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + self.ttl, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SingleFlight(object):
+    """
+    collapse the concurrent calls sharing the same key
+
+    while a call is running, the other greenlets asking for the same key
+    do not make the call but wait for its result (or its exception).
+    If the call is interrupted (greenlet killed, gevent.Timeout), the waiting greenlets get a RuntimeError
+    """
+    def __init__(self):
+        self._in_flight = {}
+        self.calls = 0
+        self.collapsed = 0
+
+    def call(self, key, func, *args, **kwargs):
+        pending = self._in_flight.get(key)
+        if pending is not None:
+            self.collapsed += 1
+            return pending.get()
+
+        self.calls += 1
+        pending = self._in_flight[key] = AsyncResult()
+        try:
+            res = func(*args, **kwargs)
+        except BaseException as e:
+            # the GreenletExit or the Timeout of the caller are not raised in the waiting greenlets
+            if not isinstance(e, Exception):
+                e = RuntimeError('the call {} has been interrupted'.format(key))
+            pending.set_exception(e)
+            raise
+        else:
+            pending.set(res)
+            return res
+        finally:
+            del self._in_flight[key]
+
+    def info(self):
+        return {
+            'in_flight': len(self._in_flight),
+            'calls': self.calls,
+            'collapsed': self.collapsed,
+        }
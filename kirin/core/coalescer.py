@@ -0,0 +1,130 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import logging
+import time
+import gevent
+from kirin.core.populate_pb import make_feed, serialize_entity, assemble_feed
+
+
+class _PendingEntity(object):
+    __slots__ = ('entity', 'first_seen', 'deadline')
+
+    def __init__(self, entity, first_seen, deadline):
+        self.entity = entity
+        self.first_seen = first_seen
+        self.deadline = deadline
+
+
+class Coalescer(object):
+    """
+    hold the trip updates of a contributor before publishing them, so only the last state of
+    a vj is published when it is updated several times in a short time
+
+    a trip update is published 'window' seconds after its last update, and never later
+    than 'max_hold' seconds after its first update. All the trip updates of a contributor
+    ready at the same time are published in one FeedMessage
+
+    if the publication fails, the trip updates are kept and published again 'retry_delay' seconds later
+    (unless a newer state has been added in the meantime)
+    """
+    def __init__(self, publish, entity_cache=None, retry_delay=5):
+        self._publish = publish
+        self._entity_cache = entity_cache
+        self.retry_delay = retry_delay
+        self._pending = {}  # contributor -> {vj_id -> _PendingEntity}
+        self._timers = {}  # contributor -> (time of the flush, greenlet)
+        self.published = 0
+        self.coalesced = 0
+
+    def add(self, contributor, trip_updates, window, max_hold):
+        now = time.time()
+        pending = self._pending.setdefault(contributor, {})
+        for trip_update in trip_updates:
+            entity = serialize_entity(trip_update, self._entity_cache)
+            previous = pending.get(trip_update.vj_id)
+            if previous:
+                # the previous state has never been published, it is replaced by the new one
+                self.coalesced += 1
+                first_seen = previous.first_seen
+            else:
+                first_seen = now
+            pending[trip_update.vj_id] = _PendingEntity(entity, first_seen, min(now + window, first_seen + max_hold))
+        self._schedule(contributor)
+
+    def _schedule(self, contributor):
+        pending = self._pending.get(contributor)
+        if not pending:
+            return
+        next_flush = min(p.deadline for p in pending.itervalues())
+        timer = self._timers.get(contributor)
+        if timer and timer[0] <= next_flush:
+            return
+        if timer:
+            timer[1].kill(block=False)
+        self._timers[contributor] = (next_flush,
+                                     gevent.spawn_later(max(next_flush - time.time(), 0), self._flush, contributor))
+
+    def _flush(self, contributor, force=False):
+        self._timers.pop(contributor, None)
+        pending = self._pending.get(contributor, {})
+        now = time.time()
+        ready = [vj_id for vj_id, p in pending.iteritems() if force or p.deadline <= now]
+        if ready:
+            entities = [(vj_id, pending.pop(vj_id)) for vj_id in ready]
+            feed = assemble_feed(make_feed(), [p.entity for _, p in entities])
+            try:
+                self._publish(feed, contributor)
+                self.published += len(ready)
+            except Exception:
+                logging.getLogger(__name__).exception('impossible to publish the trip updates of {}, retry in {}s'
+                                                      .format(contributor, self.retry_delay))
+                retry_at = time.time() + self.retry_delay
+                for vj_id, p in entities:
+                    # a newer state added during the publication replaces the failed one
+                    if vj_id not in pending:
+                        p.deadline = retry_at
+                        pending[vj_id] = p
+        self._schedule(contributor)
+
+    def flush_all(self):
+        """
+        publish immediately all the pending trip updates (it is called when kirin stops)
+        """
+        for contributor in list(self._pending):
+            timer = self._timers.get(contributor)
+            if timer:
+                timer[1].kill(block=False)
+            self._flush(contributor, force=True)
+
+    def info(self):
+        return {
+            'pending': sum(len(p) for p in self._pending.itervalues()),
+            'published': self.published,
+            'coalesced': self.coalesced,
+        }
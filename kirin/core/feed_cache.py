@@ -0,0 +1,199 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import datetime
+import hashlib
+import logging
+import zlib
+import gevent
+from gevent.lock import RLock
+from kirin import gtfs_realtime_pb2
+from kirin.core.model import TripUpdate
+from kirin.core.populate_pb import make_feed, serialize_entity, assemble_feed
+
+
+# the modification timestamps come from the clocks of the kirins and a transaction is committed
+# some time after them, the trip updates modified a bit before the last one seen are loaded again
+_MODIFICATION_MARGIN = datetime.timedelta(minutes=1)
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class FullFeedCache(object):
+    """
+    current state of the trip updates, as serialized FeedEntity, to serve the FULL_DATASET feed
+
+    the database is the reference since the trip updates can be handled by another kirin:
+    the feed is refreshed by a background greenlet (see start_refresh), that checks the state of the
+    trip updates in the database with a cheap query, and when it has changed loads again the trip
+    updates modified since the last check (all of them if that is not enough to get the same state).
+    The trip updates circulating more than 'days_before' days ago are not active anymore
+
+    the requests only read the last feed built, its body, gzipped body and etag are built once
+    for each version. Only the first request loads the feed
+    """
+    def __init__(self, days_before=1, entity_cache=None):
+        self.days_before = days_before
+        self._entity_cache = entity_cache
+        self._lock = RLock()
+        self._entities = {}  # vj_id -> (circulation_date, trip update version, serialized FeedEntity)
+        self._checked = None  # (first active date, state of the trip updates in the database) when last checked
+        self._last_modification = None
+        self._current = None  # (body, gzipped body, etag) of the feed served
+        self.version = 0
+
+    @property
+    def loaded(self):
+        return self._current is not None
+
+    def _first_active_date(self):
+        return datetime.date.today() - datetime.timedelta(days=self.days_before)
+
+    def _load(self, entities, first_active_date, modified_since=None):
+        """
+        put in 'entities' the trip updates circulating from first_active_date (and modified since
+        modified_since), return the last modification of these trip updates
+        """
+        last_modification = None
+        for trip_update in TripUpdate.find_by_circulation_date(first_active_date, modified_since):
+            entities[trip_update.vj_id] = (trip_update.vj.circulation_date, trip_update.version,
+                                           serialize_entity(trip_update, self._entity_cache))
+            modification = trip_update.updated_at or trip_update.created_at
+            if last_modification is None or modification > last_modification:
+                last_modification = modification
+        return last_modification
+
+    @staticmethod
+    def _state(entities):
+        """
+        number of entities and sum of their versions, to be compared with the database
+        """
+        return len(entities), sum(version for _, version, _ in entities.itervalues())
+
+    def refresh(self):
+        """
+        check the state of the trip updates in the database, and build the feed again if it has changed
+
+        the new entities are built aside, the feed served is replaced only once they are complete
+        """
+        with self._lock:
+            first_active_date = self._first_active_date()
+            checked = (first_active_date, tuple(TripUpdate.state_by_circulation_date(first_active_date)))
+            if checked == self._checked:
+                return
+            entities = {vj_id: entity for vj_id, entity in self._entities.iteritems()
+                        if entity[0] >= first_active_date}
+            last_modification = self._last_modification
+            if last_modification is not None:
+                modification = self._load(entities, first_active_date, last_modification - _MODIFICATION_MARGIN)
+                if modification is not None and modification > last_modification:
+                    last_modification = modification
+            if last_modification is None or self._state(entities) != checked[1][:2]:
+                # first load, or some trip updates have been deleted or modified without being seen
+                entities = {}
+                last_modification = self._load(entities, first_active_date)
+
+            sorted_entities = [entity for _, (_, _, entity) in sorted(entities.iteritems())]
+            body = assemble_feed(make_feed(gtfs_realtime_pb2.FeedHeader.FULL_DATASET), sorted_entities)
+            self._entities = entities
+            self._last_modification = last_modification
+            self._checked = checked
+            self._current = (body, _gzip(body), self._digest(sorted_entities))
+            self.version += 1
+
+    @staticmethod
+    def _digest(entities):
+        """
+        digest of the entities, the header is left out since its timestamp changes on each build
+
+        the etag is derived from it, so all the kirins serving the same trip updates agree on it
+        """
+        digest = hashlib.sha1()
+        for entity in entities:
+            digest.update('{}:'.format(len(entity)))
+            digest.update(entity)
+        return digest.hexdigest()[:16]
+
+    def current(self, gzipped=False):
+        """
+        (serialized feed, etag) of the feed served, read together so they always match
+
+        it is only read from memory, the database is only queried when the feed has not been loaded yet
+        (the first request loads it, the concurrent ones wait for it)
+        """
+        if self._current is None:
+            self.refresh()
+        body, gzipped_body, etag = self._current
+        if gzipped:
+            return gzipped_body, etag + '-gzip'
+        return body, etag
+
+    def feed(self, gzipped=False):
+        """
+        serialized FULL_DATASET FeedMessage of all the active trip updates
+        """
+        return self.current(gzipped)[0]
+
+    def etag(self, gzipped=False):
+        """
+        etag of the current feed, the gzipped feed is another representation so it has another etag
+        """
+        return self.current(gzipped)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entities = {}
+            self._checked = None
+            self._last_modification = None
+            self._current = None
+
+    def info(self):
+        return {
+            'loaded': self.loaded,
+            'nb_entities': len(self._entities),
+            'version': self.version,
+        }
+
+
+def start_refresh(app, feed_cache, interval):
+    """
+    refresh the feed in a background greenlet every 'interval' seconds, once it has been loaded
+    """
+    def run():
+        if feed_cache.loaded:
+            with app.app_context():
+                try:
+                    feed_cache.refresh()
+                except Exception:
+                    logging.getLogger(__name__).exception('impossible to refresh the GTFS-RT feed')
+        gevent.spawn_later(interval, run)
+
+    gevent.spawn_later(interval, run)
@@ -30,17 +30,193 @@ import kirin
 from kirin import gtfs_realtime_pb2
 
 from kirin.core import model
-from kirin.core.model import RealTimeUpdate, TripUpdate, StopTimeUpdate
+from kirin.core.model import RealTimeUpdate, TripUpdate, StopTimeUpdate, OutboxMessage
+import collections
 import datetime
-from kirin.core.populate_pb import convert_to_gtfsrt
+from flask.globals import current_app
+import sqlalchemy
+from kirin.core.populate_pb import serialize_feed
 
 
-def persist(real_time_update):
+def persist(real_time_update, commit=True):
     """
     receive a RealTimeUpdate and persist it in the database
+
+    if commit is False, the rows are only flushed, it's up to the caller to commit the transaction
     """
     model.db.session.add(real_time_update)
-    model.db.session.commit()
+    if commit:
+        model.db.session.commit()
+    else:
+        model.db.session.flush()
+
+
+# real_time_update is partitioned and ON CONFLICT does not see the rows of the partitions,
+# so an update is done first and the row is inserted only if it does not exist
+_UPSERT_REAL_TIME_UPDATE = sqlalchemy.text("""
+WITH updated AS (
+    UPDATE real_time_update SET status = CAST(:status AS rt_status), error = :error, content_hash = :content_hash,
+                                train_number = :train_number, updated_at = :now
+    WHERE id = :id RETURNING id
+)
+INSERT INTO real_time_update (id, created_at, received_at, contributor, connector, status, error, raw_data,
+                              raw_data_compressed, content_hash, train_number)
+SELECT CAST(:id AS UUID), :now, :received_at, :contributor, CAST(:connector AS connector_type),
+       CAST(:status AS rt_status), :error, :raw_data, :raw_data_compressed, :content_hash, :train_number
+WHERE NOT EXISTS (SELECT 1 FROM updated)
+""").bindparams(sqlalchemy.bindparam('raw_data_compressed', type_=model.CompressedText))
+
+# the statements below are written for all the trip updates of a message at once,
+# their multi-row VALUES clause is built by _values
+
+# the update on conflict is needed to get the id of the existing vjs
+_UPSERT_VEHICLE_JOURNEYS = """
+INSERT INTO vehicle_journey (id, navitia_id, circulation_date)
+VALUES {values}
+ON CONFLICT (navitia_id, circulation_date) DO UPDATE SET navitia_id = EXCLUDED.navitia_id
+RETURNING id, navitia_id, circulation_date
+"""
+
+# the version is incremented from the row, the one of the merged trip update can be stale
+# if another kirin has written the row in the meantime (EXCLUDED.created_at is the current time)
+_UPSERT_TRIP_UPDATES = """
+INSERT INTO trip_update (vj_id, status, version, created_at)
+VALUES {values}
+ON CONFLICT (vj_id) DO UPDATE SET status = EXCLUDED.status, version = trip_update.version + 1,
+                                  updated_at = EXCLUDED.created_at
+RETURNING vj_id, version
+"""
+
+_DELETE_OTHER_STOP_TIME_UPDATES = sqlalchemy.text("""
+DELETE FROM stop_time_update
+WHERE trip_update_id = ANY(CAST(:vj_ids AS UUID[])) AND id <> ALL(CAST(:ids AS UUID[]))
+""")
+
+# the stops that have not changed are not written again
+_UPSERT_STOP_TIME_UPDATES = """
+INSERT INTO stop_time_update (id, trip_update_id, stop_id, departure, departure_status, arrival, arrival_status,
+                              created_at)
+VALUES {values}
+ON CONFLICT (id) DO UPDATE SET departure = EXCLUDED.departure, departure_status = EXCLUDED.departure_status,
+                               arrival = EXCLUDED.arrival, arrival_status = EXCLUDED.arrival_status,
+                               updated_at = EXCLUDED.created_at
+WHERE (stop_time_update.departure, stop_time_update.departure_status,
+       stop_time_update.arrival, stop_time_update.arrival_status)
+      IS DISTINCT FROM (EXCLUDED.departure, EXCLUDED.departure_status, EXCLUDED.arrival, EXCLUDED.arrival_status)
+"""
+
+_LINK_REAL_TIME_UPDATE_TRIP_UPDATES = """
+INSERT INTO associate_realtimeupdate_tripupdate (real_time_update_id, trip_update_id)
+VALUES {values}
+ON CONFLICT DO NOTHING
+"""
+
+
+def _values(statement, rows):
+    """
+    the statement with its {values} replaced by one tuple of bind parameters for each row, and these parameters
+
+    >>> sql, params = _values('INSERT INTO bob VALUES {values}', [(1, 'a'), (2, 'b')])
+    >>> sql
+    'INSERT INTO bob VALUES (:p0_0, :p0_1), (:p1_0, :p1_1)'
+    >>> sorted(params.items())
+    [('p0_0', 1), ('p0_1', 'a'), ('p1_0', 2), ('p1_1', 'b')]
+    """
+    params = {}
+    values = []
+    for i, row in enumerate(rows):
+        names = []
+        for j, value in enumerate(row):
+            name = 'p{}_{}'.format(i, j)
+            params[name] = value
+            names.append(':' + name)
+        values.append('({})'.format(', '.join(names)))
+    return statement.format(values=', '.join(values)), params
+
+
+def _execute_values(session, statement, rows):
+    sql, params = _values(statement, rows)
+    return session.execute(sqlalchemy.text(sql), params)
+
+
+def _expunge_upserted(session, real_time_update, trip_updates):
+    """
+    detach from the session the objects written by the upserts, the other objects are left untouched
+
+    the stops removed from the trip updates by the merge are detached too, they are deleted by the upserts
+    """
+    # the rt update's trip_updates are loaded before since they are needed to build the feed
+    objects = {real_time_update}
+    objects.update(real_time_update.trip_updates)
+    for trip_update in trip_updates:
+        objects.add(trip_update)
+        objects.add(trip_update.vj)
+        objects.update(trip_update.stop_time_updates)
+        objects.update(sqlalchemy.orm.attributes.get_history(trip_update, 'stop_time_updates').deleted)
+    for obj in objects:
+        if obj in session:
+            session.expunge(obj)
+
+
+def persist_with_upsert(real_time_update, trip_updates, commit=True):
+    """
+    persist the RealTimeUpdate and its merged TripUpdates with 'INSERT ... ON CONFLICT DO UPDATE'
+
+    the rows are written in a few statements whatever their previous state, so two workers
+    handling the same vj do not fail on the unique constraint of the vj (the last one wins).
+    There is one statement by table for all the trip updates and their stops, and the stops
+    that have not changed are not written again
+
+    if commit is False, it's up to the caller to commit the transaction
+
+    Note: needs PostgreSQL >= 9.5
+    """
+    session = model.db.session
+    # the objects are detached from the session, they are written by the upserts and not by the orm
+    _expunge_upserted(session, real_time_update, trip_updates)
+
+    now = datetime.datetime.utcnow()
+    session.execute(_UPSERT_REAL_TIME_UPDATE, {
+        'id': real_time_update.id,
+        'now': now,
+        'received_at': real_time_update.received_at,
+        'contributor': real_time_update.contributor,
+        'connector': real_time_update.connector,
+        'status': real_time_update.status,
+        'error': real_time_update.error,
+        'raw_data': real_time_update._raw_data,
+        'raw_data_compressed': real_time_update.raw_data_compressed,
+        'content_hash': real_time_update.content_hash,
+        'train_number': real_time_update.train_number,
+    })
+
+    if trip_updates:
+        vj_ids = {(row.navitia_id, row.circulation_date): row.id
+                  for row in _execute_values(session, _UPSERT_VEHICLE_JOURNEYS, [
+                      (t.vj.id, t.vj.navitia_id, t.vj.circulation_date) for t in trip_updates])}
+        for trip_update in trip_updates:
+            trip_update.vj.id = trip_update.vj_id = vj_ids[(trip_update.vj.navitia_id,
+                                                            trip_update.vj.circulation_date)]
+            for st in trip_update.stop_time_updates:
+                st.trip_update_id = trip_update.vj_id
+
+        versions = dict(_execute_values(session, _UPSERT_TRIP_UPDATES, [
+            (t.vj_id, t.status, t.version, now) for t in trip_updates]).fetchall())
+        for trip_update in trip_updates:
+            trip_update.version = versions[trip_update.vj_id]
+
+        stop_time_updates = [st for t in trip_updates for st in t.stop_time_updates]
+        session.execute(_DELETE_OTHER_STOP_TIME_UPDATES, {'vj_ids': [t.vj_id for t in trip_updates],
+                                                          'ids': [st.id for st in stop_time_updates]})
+        if stop_time_updates:
+            _execute_values(session, _UPSERT_STOP_TIME_UPDATES, [
+                (st.id, st.trip_update_id, st.stop_id, st.departure, st.departure_status, st.arrival,
+                 st.arrival_status, now) for st in stop_time_updates])
+
+        _execute_values(session, _LINK_REAL_TIME_UPDATE_TRIP_UPDATES, [
+            (real_time_update.id, t.vj_id) for t in trip_updates])
+    if commit:
+        session.commit()
 
 
 def handle(real_time_update, trip_updates):
@@ -51,21 +227,50 @@ def handle(real_time_update, trip_updates):
     if not real_time_update:
         raise TypeError()
 
+    dated_vjs = [(t.vj.navitia_id, t.vj.circulation_date) for t in trip_updates]
+    # a concurrent worker merging the same vjs waits for this transaction, so no merged stop is lost
+    TripUpdate.lock_dated_vjs(dated_vjs)
+    #find in one query the rows already in db
+    old_trip_updates = TripUpdate.find_by_dated_vjs(dated_vjs)
+
+    current_trip_updates = []
     for trip_update in trip_updates:
-        #find if there already a row in db
-        old = TripUpdate.find_by_dated_vj(trip_update.vj.navitia_id, trip_update.vj.circulation_date)
+        dated_vj = (trip_update.vj.navitia_id, trip_update.vj.circulation_date)
         #merge the theoric, the current realtime, and the new relatime
-        current_trip_update = merge(trip_update, old)
+        current_trip_update = merge(trip_update, old_trip_updates.get(dated_vj))
+        #if the same vj is updated twice, the second update is merged with the first one
+        old_trip_updates[dated_vj] = current_trip_update
 
         # we have to link the current_vj_update with the new real_time_update
         # this link is done quite late to avoid too soon persistence of trip_update by sqlalchemy
         current_trip_update.real_time_updates.append(real_time_update)
+        if current_trip_update not in current_trip_updates:
+            current_trip_updates.append(current_trip_update)
 
-    persist(real_time_update)
+    coalescing = current_app.config['COALESCING'].get(real_time_update.contributor)
+    # with the outbox, the feed is saved in the same transaction as the trip updates
+    use_outbox = current_app.config['PUBLISH_OUTBOX'] and not coalescing
+
+    if current_app.config['DB_UPSERT']:
+        persist_with_upsert(real_time_update, current_trip_updates, commit=not use_outbox)
+    else:
+        persist(real_time_update, commit=not use_outbox)
 
-    feed = convert_to_gtfsrt(real_time_update)
+    if coalescing:
+        # the trip updates are published later, with the next updates of the same vjs
+        kirin.coalescer.add(real_time_update.contributor, current_trip_updates,
+                            coalescing['window'], coalescing['max_hold'])
+    else:
+        # with the outbox the transaction is not committed yet, the entities are not cached
+        # since the versions of the trip updates could be reused if it is rolled back
+        feed = serialize_feed(real_time_update.trip_updates, kirin.gtfs_rt_entity_cache, committed=not use_outbox)
 
-    publish(feed, real_time_update)
+        if use_outbox:
+            # the feed will be published by the outbox relay
+            model.db.session.add(OutboxMessage(real_time_update.contributor, feed))
+            model.db.session.commit()
+        else:
+            publish(feed, real_time_update)
 
     return real_time_update
 
@@ -83,27 +288,33 @@ def merge(trip_update, old_trip_update):
 
 
 def merge_realtime_theoric(trip_update, navitia_vj):
-    for idx, navitia_stop in enumerate(navitia_vj.get('stop_times', [])):
-        stop_id = navitia_stop.get('stop_point', {}).get('id')
-        stop = trip_update.find_stop(stop_id)
-        #TODO: order is important...
+    """
+    complete the trip_update with the theoric stop times of the navitia vj
+
+    the stop list is built in one pass, in the vj order, and assigned at once
+    (inserting the stops one by one in the orm collection is quadratic)
+    """
+    stop_time_updates = []
+    occurrences = collections.Counter()
+    for navitia_stop in navitia_vj.stop_times:
+        stop_id = navitia_stop.stop_point_id
+        stop = trip_update.find_stop(stop_id, occurrences[stop_id])
+        occurrences[stop_id] += 1
         if not stop:
-            departure_time = navitia_stop.get('departure_time')
-            arrival_time = navitia_stop.get('arrival_time')
-            departure = arrival = None
-            #TODO handle past midnigth
-            if departure_time:
-                departure = datetime.datetime.combine(trip_update.vj.circulation_date, departure_time)
-            if arrival_time:
-                arrival = datetime.datetime.combine(trip_update.vj.circulation_date, arrival_time)
+            departure = navitia_stop.departure(trip_update.vj.circulation_date)
+            arrival = navitia_stop.arrival(trip_update.vj.circulation_date)
+            stop = StopTimeUpdate({'id': stop_id}, departure, arrival)
+        stop_time_updates.append(stop)
+
+    # the realtime stops not served by the vj are kept after the vj's stops
+    in_vj = set(stop_time_updates)
+    stop_time_updates.extend(st for st in trip_update.stop_time_updates if st not in in_vj)
 
-            st = StopTimeUpdate(navitia_stop['stop_point'], departure, arrival)
-            #we want to keep the order
-            trip_update.stop_time_updates.insert(idx, st)
+    trip_update.stop_time_updates = stop_time_updates
 
 
 def publish(feed, rt_update):
     """
-    send RT feed to navitia
+    send the serialized RT feed to navitia
     """
-    kirin.rabbitmq_handler.publish(feed.SerializeToString(), rt_update.contributor)
+    kirin.rabbitmq_handler.publish(feed, rt_update.contributor)
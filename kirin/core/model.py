@@ -29,8 +29,12 @@
 
 from sqlalchemy.dialects import postgresql
 from flask_sqlalchemy import SQLAlchemy
+from flask.globals import current_app
+import collections
 import datetime
 import sqlalchemy
+import zlib
+from kirin.core.navitia_vj import NavitiaVJ
 db = SQLAlchemy()
 
 # default name convention for db constraints (when not specified), for future alembic updates
@@ -65,19 +69,40 @@ class TimestampMixin(object):
 ModificationType = db.Enum('add', 'delete', 'update', 'none', name='modification_type')
 
 
+class CompressedText(sqlalchemy.types.TypeDecorator):
+    """
+    text stored compressed with zlib in a bytea, it is decompressed when loaded
+    """
+    impl = db.LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return zlib.compress(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.decompress(value).decode('utf-8')
+
+
 class VehicleJourney(db.Model):
     """
     Vehicle Journey
     """
     id = db.Column(postgresql.UUID, default=gen_uuid, primary_key=True)
     navitia_id = db.Column(db.Text, nullable=False)
-    circulation_date = db.Column(db.Date, nullable=False)
+    circulation_date = db.Column(db.Date, nullable=False, index=True)
 
     __table_args__ = (db.UniqueConstraint('navitia_id', 'circulation_date', name='vehicle_journey_navitia_id_circulation_date_idx'),)
 
     def __init__(self, navitia_vj, circulation_date):
         self.id = gen_uuid()
-        self.navitia_id = navitia_vj['id']
+        if not isinstance(navitia_vj, NavitiaVJ):
+            navitia_vj = NavitiaVJ(navitia_vj)
+        self.navitia_id = navitia_vj.id
         self.circulation_date = circulation_date
         self.navitia_vj = navitia_vj  # Not persisted
 
@@ -87,7 +112,7 @@ class StopTimeUpdate(db.Model, TimestampMixin):
     Stop time
     """
     id = db.Column(postgresql.UUID, default=gen_uuid, primary_key=True)
-    trip_update_id = db.Column(postgresql.UUID, db.ForeignKey('trip_update.vj_id'), nullable=False)
+    trip_update_id = db.Column(postgresql.UUID, db.ForeignKey('trip_update.vj_id'), nullable=False, index=True)
 
     stop_id = db.Column(db.Text, nullable=False)
 
@@ -120,8 +145,9 @@ class StopTimeUpdate(db.Model, TimestampMixin):
 
 associate_realtimeupdate_tripupdate = db.Table('associate_realtimeupdate_tripupdate',
                                     db.metadata,
-                                    db.Column('real_time_update_id', postgresql.UUID, db.ForeignKey('real_time_update.id')),
-                                    db.Column('trip_update_id', postgresql.UUID, db.ForeignKey('trip_update.vj_id')),
+                                    # no foreign key on real_time_update, it is partitioned (see kirin.core.partition)
+                                    db.Column('real_time_update_id', postgresql.UUID),
+                                    db.Column('trip_update_id', postgresql.UUID, db.ForeignKey('trip_update.vj_id'), index=True),
                                     db.PrimaryKeyConstraint('real_time_update_id', 'trip_update_id', name='associate_realtimeupdate_tripupdate_pkey')
 )
 
@@ -132,6 +158,8 @@ class TripUpdate(db.Model, TimestampMixin):
     """
     vj_id = db.Column(postgresql.UUID, db.ForeignKey('vehicle_journey.id'), nullable=False, primary_key=True)
     status = db.Column(ModificationType, nullable=False, default='none')
+    # incremented on each merge, the serialized FeedEntity of a version is cached (see populate_pb)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     vj = db.relationship('VehicleJourney', backref='trip_update', uselist=False)
     stop_time_updates = db.relationship('StopTimeUpdate', backref='trip_update', lazy='joined',
                                         cascade='all, delete-orphan')
@@ -140,26 +168,143 @@ class TripUpdate(db.Model, TimestampMixin):
         self.created_at = datetime.datetime.utcnow()
         self.vj = vj
         self.status = 'none'
+        self.version = 0
+        self._stops_index = None  # Not persisted
+
+    @sqlalchemy.orm.reconstructor
+    def init_on_load(self):
+        # the index is built on the first search
+        self._stops_index = None
 
     @classmethod
     def find_by_dated_vj(cls, vj_navitia_id, vj_circulation_date):
         return cls.query.join(VehicleJourney).filter(VehicleJourney.navitia_id == vj_navitia_id,
                                               VehicleJourney.circulation_date == vj_circulation_date).first()
 
-    def find_stop(self, stop_id):
-        #TODO: we will need to handle vj who deserve the same stop multiple times
-        for st in self.stop_time_updates:
-            if st.stop_id == stop_id:
-                return st
-        return None
+    @classmethod
+    def find_by_dated_vjs(cls, dated_vjs):
+        """
+        load in one query the TripUpdates of a list of (vj navitia_id, circulation_date)
+
+        return a dict (vj navitia_id, circulation_date) -> TripUpdate, without the vjs not found in the db
+        """
+        dated_vjs = set(dated_vjs)
+        if not dated_vjs:
+            return {}
+        trip_updates = cls.query.join(VehicleJourney)\
+            .options(sqlalchemy.orm.contains_eager(cls.vj))\
+            .filter(sqlalchemy.tuple_(VehicleJourney.navitia_id, VehicleJourney.circulation_date)
+                    .in_(list(dated_vjs)))\
+            .all()
+        return {(t.vj.navitia_id, t.vj.circulation_date): t for t in trip_updates}
+
+    @classmethod
+    def lock_dated_vjs(cls, dated_vjs):
+        """
+        lock the TripUpdates of a list of (vj navitia_id, circulation_date) until the end of the transaction
+
+        a concurrent update of the same vjs waits for the end of the transaction, it then merges
+        the committed state (it has to be loaded in another statement, after the lock)
+        """
+        dated_vjs = set(dated_vjs)
+        if not dated_vjs:
+            return
+        db.session.query(cls.vj_id).join(VehicleJourney)\
+            .filter(sqlalchemy.tuple_(VehicleJourney.navitia_id, VehicleJourney.circulation_date)
+                    .in_(list(dated_vjs)))\
+            .with_for_update(of=cls)\
+            .all()
+
+    @classmethod
+    def find_by_circulation_date(cls, since, modified_since=None):
+        """
+        load all the TripUpdates of the vjs circulating from the given date, with their stop times
+
+        if modified_since is given, only the TripUpdates created or modified since then are loaded
+        """
+        query = cls.query.join(VehicleJourney)\
+            .options(sqlalchemy.orm.contains_eager(cls.vj), sqlalchemy.orm.subqueryload(cls.stop_time_updates))\
+            .filter(VehicleJourney.circulation_date >= since)
+        if modified_since:
+            query = query.filter(sqlalchemy.func.coalesce(cls.updated_at, cls.created_at) >= modified_since)
+        return query.all()
+
+    @classmethod
+    def state_by_circulation_date(cls, since):
+        """
+        (number of TripUpdates, sum of their versions, last modification) of the vjs circulating
+        from the given date
+
+        it is a cheap summary of these TripUpdates, that changes when one of them is added,
+        modified or deleted, by any kirin
+        """
+        return db.session.query(sqlalchemy.func.count(cls.vj_id),
+                                sqlalchemy.func.coalesce(sqlalchemy.func.sum(cls.version), 0),
+                                sqlalchemy.func.max(sqlalchemy.func.coalesce(cls.updated_at, cls.created_at)))\
+            .join(VehicleJourney)\
+            .filter(VehicleJourney.circulation_date >= since)\
+            .one()
+
+    def _get_stops_index(self):
+        """
+        transient index stop_id -> list of the StopTimeUpdates of the stop (in the vj order)
+
+        it is built lazily and kept up to date by the events of the stop_time_updates collection
+        """
+        if self._stops_index is None:
+            self._stops_index = {}
+            for st in self.stop_time_updates:
+                self._stops_index.setdefault(st.stop_id, []).append(st)
+        return self._stops_index
+
+    def _on_stop_added(self, stop_time_update):
+        if self._stops_index is None:
+            return
+        if stop_time_update.stop_id in self._stops_index:
+            # the vj serves this stop several times, we don't know where the stop has been inserted,
+            # so the index will be rebuilt to keep the occurrences in the vj order
+            self._stops_index = None
+        else:
+            self._stops_index[stop_time_update.stop_id] = [stop_time_update]
+
+    def _on_stop_removed(self, stop_time_update):
+        if self._stops_index is None:
+            return
+        occurrences = self._stops_index.get(stop_time_update.stop_id, [])
+        if stop_time_update in occurrences:
+            occurrences.remove(stop_time_update)
+            if not occurrences:
+                del self._stops_index[stop_time_update.stop_id]
+
+    def find_stop(self, stop_id, occurrence=0):
+        """
+        return the StopTimeUpdate of the stop, or None
+        if the vj serves the stop several times, 'occurrence' is the rank of the wanted visit
+        """
+        occurrences = self._get_stops_index().get(stop_id, [])
+        return occurrences[occurrence] if occurrence < len(occurrences) else None
 
     def merge(self, other):
         if not other:
             return
+        # the nth visit of a stop is merged with the nth visit of the same stop
+        occurrences = collections.Counter()
         for stop in other.stop_time_updates:
-            current_stop = self.find_stop(stop.stop_id)
+            current_stop = self.find_stop(stop.stop_id, occurrences[stop.stop_id])
+            occurrences[stop.stop_id] += 1
             current_stop.merge(stop)
         self.status = other.status
+        self.version += 1
+
+
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, 'append')
+def _index_added_stop(trip_update, stop_time_update, initiator):
+    trip_update._on_stop_added(stop_time_update)
+
+
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, 'remove')
+def _unindex_removed_stop(trip_update, stop_time_update, initiator):
+    trip_update._on_stop_removed(stop_time_update)
 
 
 
@@ -174,21 +319,84 @@ class RealTimeUpdate(db.Model, TimestampMixin):
     There is a one-to-many relationship between RealTimeUpdate and TripUpdate.
     """
     id = db.Column(postgresql.UUID, default=gen_uuid, primary_key=True)
-    received_at = db.Column(db.DateTime, nullable=False)
+    received_at = db.Column(db.DateTime, nullable=False, index=True)
     contributor = db.Column(db.Text, nullable=True)
     connector = db.Column(db.Enum('ire', 'gtfs-rt', name='connector_type'), nullable=False)
     status = db.Column(db.Enum('OK', 'KO', 'pending', name='rt_status'), nullable=True)
     error = db.Column(db.Text, nullable=True)
-    raw_data = db.Column(db.Text, nullable=True)
-
-    trip_updates = db.relationship("TripUpdate", secondary=associate_realtimeupdate_tripupdate, backref='real_time_updates')
+    # the raw data is stored in one of the two columns depending on the RAW_DATA_COMPRESSION parameter,
+    # use the raw_data property to access it
+    _raw_data = db.Column('raw_data', db.Text, nullable=True)
+    raw_data_compressed = db.Column(CompressedText, nullable=True)
+    # hash of the content of the message, to find the duplicates
+    content_hash = db.Column(db.Text, nullable=True, index=True)
+    # number of the train updated by the message, its last message is the reference to find the duplicates
+    train_number = db.Column(db.Text, nullable=True)
+    __table_args__ = (db.Index('ix_real_time_update_train_number_received_at', 'train_number', 'received_at'),)
+    # when a worker claimed the pending real time update (see ire.process_pending)
+    processing_started_at = db.Column(db.DateTime, nullable=True)
+
+    trip_updates = db.relationship("TripUpdate", secondary=associate_realtimeupdate_tripupdate,
+                                   primaryjoin='RealTimeUpdate.id == '
+                                               'foreign(associate_realtimeupdate_tripupdate.c.real_time_update_id)',
+                                   backref='real_time_updates')
 
     def __init__(self, raw_data, connector,
-                 contributor=None, status=None, error=None, received_at=datetime.datetime.now()):
+                 contributor=None, status=None, error=None, received_at=None, content_hash=None,
+                 train_number=None):
         self.id = gen_uuid()
         self.raw_data = raw_data
         self.contributor = contributor
         self.connector = connector
         self.status = status
         self.error = error
-        self.received_at = received_at
+        self.received_at = received_at or datetime.datetime.now()
+        self.content_hash = content_hash
+        self.train_number = train_number
+
+    @property
+    def raw_data(self):
+        if self.raw_data_compressed is not None:
+            return self.raw_data_compressed
+        return self._raw_data
+
+    @raw_data.setter
+    def raw_data(self, value):
+        if current_app.config['RAW_DATA_COMPRESSION']:
+            self.raw_data_compressed = value
+            self._raw_data = None
+        else:
+            self._raw_data = value
+            self.raw_data_compressed = None
+
+    @classmethod
+    def compress_raw_data(cls, batch_size=100):
+        """
+        compress the raw data of batch_size real time updates stored uncompressed
+
+        return the number of real time updates compressed, 0 when everything is compressed
+        """
+        rt_updates = cls.query.filter(cls._raw_data.isnot(None)).limit(batch_size).all()
+        for rt_update in rt_updates:
+            rt_update.raw_data_compressed = rt_update._raw_data
+            rt_update._raw_data = None
+        db.session.commit()
+        return len(rt_updates)
+
+
+class OutboxMessage(db.Model, TimestampMixin):
+    """
+    GTFS-RT feed waiting to be published by the outbox relay (see kirin.core.outbox)
+
+    it is written in the same transaction as the trip updates, so a feed is never lost
+    """
+    id = db.Column(db.BigInteger, primary_key=True)
+    contributor = db.Column(db.Text, nullable=True)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('outbox_message_not_sent_idx', 'id', postgresql_where=sent_at.is_(None)),)
+
+    def __init__(self, contributor, payload):
+        self.contributor = contributor
+        self.payload = payload
@@ -0,0 +1,118 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import datetime
+
+
+def _as_time(navitia_time):
+    """
+    navitia gives the times as 'HHMMSS' strings, past midnight the hours go on (25 is 1 the next day)
+    return the time of the day and the number of days after the circulation date
+    >>> _as_time('174030')
+    (datetime.time(17, 40, 30), 0)
+    >>> _as_time('251000')
+    (datetime.time(1, 10), 1)
+    >>> _as_time(None)
+    (None, 0)
+    >>> _as_time(datetime.time(8, 10))
+    (datetime.time(8, 10), 0)
+    """
+    if navitia_time is None or isinstance(navitia_time, datetime.time):
+        return navitia_time, 0
+    days, hours = divmod(int(navitia_time[0:2]), 24)
+    return datetime.time(hours, int(navitia_time[2:4]), int(navitia_time[4:6])), days
+
+
+def _as_datetime(circulation_date, time, days):
+    if time is None:
+        return None
+    return datetime.datetime.combine(circulation_date + datetime.timedelta(days=days), time)
+
+
+class NavitiaStopTime(object):
+    """
+    stop time of a navitia vehicle journey, with only the fields used by kirin
+
+    the times are the times of the day, the stop times after midnight have a day offset
+    """
+    __slots__ = ('stop_point_id', 'arrival_time', 'departure_time', 'arrival_day', 'departure_day')
+
+    def __init__(self, stop_point_id, arrival_time, departure_time, arrival_day=0, departure_day=0):
+        self.stop_point_id = stop_point_id
+        self.arrival_time = arrival_time
+        self.departure_time = departure_time
+        self.arrival_day = arrival_day
+        self.departure_day = departure_day
+
+    def arrival(self, circulation_date):
+        return _as_datetime(circulation_date, self.arrival_time, self.arrival_day)
+
+    def departure(self, circulation_date):
+        return _as_datetime(circulation_date, self.departure_time, self.departure_day)
+
+
+class NavitiaVJ(object):
+    """
+    vehicle journey returned by navitia, indexed to find quickly its stop times
+
+    the navitia json is converted once, only the fields used by kirin are kept
+    (to lower the memory used by the vjs in the caches)
+
+    the stop times can be found by stop_point id or by CR-CI-CH code of their stop_area,
+    each index gives the list of stop times (in the vj order) since a vj can serve a stop several times
+    """
+    __slots__ = ('id', 'stop_times', '_stop_times_by_stop_point', '_stop_times_by_cr_ci_ch')
+
+    def __init__(self, navitia_vj):
+        self.id = navitia_vj['id']
+        self._stop_times_by_stop_point = {}
+        self._stop_times_by_cr_ci_ch = {}
+
+        stop_times = []
+        for navitia_st in navitia_vj.get('stop_times', []):
+            stop_point = navitia_st.get('stop_point', {})
+            arrival_time, arrival_day = _as_time(navitia_st.get('arrival_time'))
+            departure_time, departure_day = _as_time(navitia_st.get('departure_time'))
+            st = NavitiaStopTime(stop_point_id=stop_point.get('id'),
+                                 arrival_time=arrival_time,
+                                 departure_time=departure_time,
+                                 arrival_day=arrival_day,
+                                 departure_day=departure_day)
+            stop_times.append(st)
+            self._stop_times_by_stop_point.setdefault(st.stop_point_id, []).append(st)
+            codes = set(c['value'] for c in stop_point.get('stop_area', {}).get('codes', [])
+                        if c['type'] == 'CR-CI-CH')
+            for code in codes:
+                self._stop_times_by_cr_ci_ch.setdefault(code, []).append(st)
+        self.stop_times = tuple(stop_times)
+
+    def stop_times_by_stop_point(self, stop_point_id):
+        return self._stop_times_by_stop_point.get(stop_point_id, [])
+
+    def stop_times_by_cr_ci_ch(self, code):
+        return self._stop_times_by_cr_ci_ch.get(code, [])
@@ -0,0 +1,103 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import logging
+import gevent
+import sqlalchemy
+from kirin.core.model import db
+
+# the rows locked by another relay are skipped, so several relays can drain the outbox together
+# (Note: needs PostgreSQL >= 9.5)
+_CLAIM_MESSAGES = sqlalchemy.text("""
+SELECT id, contributor, payload FROM outbox_message WHERE sent_at IS NULL
+ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED
+""")
+
+_MARK_SENT = sqlalchemy.text("""
+UPDATE outbox_message SET sent_at = now() AT TIME ZONE 'UTC', updated_at = now() AT TIME ZONE 'UTC'
+WHERE id = ANY(:ids)
+""")
+
+
+def relay_batch(publish, batch_size=100):
+    """
+    publish at most batch_size messages of the outbox and mark them as sent
+
+    the messages of a contributor are concatenated in one message (it's the merge of the feeds).
+    If the publication fails, the transaction is rolled back and the messages will be published
+    by the next relay.
+    'publish' must return only once the message is in rabbitmq (see RabbitMQHandler.publish_confirmed)
+
+    return the number of messages published
+    """
+    rows = db.session.execute(_CLAIM_MESSAGES, {'limit': batch_size}).fetchall()
+    if not rows:
+        db.session.rollback()
+        return 0
+    payloads_by_contributor = {}
+    contributors = []
+    for _, contributor, payload in rows:
+        if contributor not in payloads_by_contributor:
+            contributors.append(contributor)
+        payloads_by_contributor.setdefault(contributor, []).append(str(payload))
+    try:
+        for contributor in contributors:
+            publish(''.join(payloads_by_contributor[contributor]), contributor)
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.execute(_MARK_SENT, {'ids': [row[0] for row in rows]})
+    db.session.commit()
+    return len(rows)
+
+
+def relay(publish, batch_size=100):
+    """
+    publish all the messages of the outbox, return the number of messages published
+    """
+    total = 0
+    while True:
+        nb = relay_batch(publish, batch_size)
+        total += nb
+        if nb < batch_size:
+            return total
+
+
+def start_relay(app, publish, batch_size, interval):
+    """
+    drain the outbox in a background greenlet every 'interval' seconds
+    """
+    def run():
+        with app.app_context():
+            try:
+                relay(publish, batch_size)
+            except Exception:
+                logging.getLogger(__name__).exception('impossible to relay the outbox messages')
+        gevent.spawn_later(interval, run)
+
+    gevent.spawn_later(interval, run)
@@ -0,0 +1,114 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import datetime
+import logging
+from kirin import db
+
+PARENT_TABLE = 'real_time_update'
+PARTITION_PREFIX = PARENT_TABLE + '_'
+
+
+def partition_name(day):
+    """
+    >>> partition_name(datetime.date(2015, 9, 21))
+    'real_time_update_20150921'
+    """
+    return '{}{}'.format(PARTITION_PREFIX, day.strftime('%Y%m%d'))
+
+
+def list_partitions():
+    """
+    return the (day, table name) of the partitions attached to real_time_update, ordered by day
+    """
+    rows = db.session.execute("SELECT pg_class.relname FROM pg_inherits "
+                              "JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid "
+                              "WHERE pg_inherits.inhparent = CAST(:parent AS regclass)", {'parent': PARENT_TABLE})
+    partitions = []
+    for (name,) in rows:
+        try:
+            day = datetime.datetime.strptime(name[len(PARTITION_PREFIX):], '%Y%m%d').date()
+        except ValueError:
+            continue  # not one of our partitions
+        partitions.append((day, name))
+    return sorted(partitions)
+
+
+def create_partition(day):
+    """
+    create the partition of the given day if it does not exist
+
+    the check constraint on received_at allow postgres to skip the other partitions
+    when a query is filtered by received_at
+    """
+    db.session.execute("""
+CREATE TABLE IF NOT EXISTS {name} (
+    LIKE {parent} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES,
+    CHECK (received_at >= '{day}'::date AND received_at < '{next_day}'::date)
+) INHERITS ({parent})
+""".format(name=partition_name(day), parent=PARENT_TABLE,
+           day=day.isoformat(), next_day=(day + datetime.timedelta(days=1)).isoformat()))
+
+
+def remove_partition(name, detach=False):
+    """
+    drop the partition, or only detach it from real_time_update if we want to archive it
+
+    it only changes the catalog, whatever the number of rows of the partition: the association rows
+    with the trip updates are left (there is no foreign key on real_time_update), they are not loaded
+    without their real time update and they are deleted with their trip update by the purge
+    """
+    if detach:
+        db.session.execute('ALTER TABLE {} NO INHERIT {}'.format(name, PARENT_TABLE))
+    else:
+        db.session.execute('DROP TABLE {}'.format(name))
+
+
+def rotate_partitions(today, days_ahead, retention_days, detach=False):
+    """
+    create the partitions of the next days_ahead days and remove the ones older than retention_days
+
+    return the names of the created and removed partitions
+    """
+    log = logging.getLogger(__name__)
+    existing = set(name for _, name in list_partitions())
+    created = []
+    for i in range(days_ahead + 1):
+        day = today + datetime.timedelta(days=i)
+        if partition_name(day) not in existing:
+            create_partition(day)
+            created.append(partition_name(day))
+    removed = []
+    limit = today - datetime.timedelta(days=retention_days)
+    for day, name in list_partitions():
+        if day < limit:
+            remove_partition(name, detach=detach)
+            removed.append(name)
+    db.session.commit()
+    log.info('partitions created: {}, {}: {}'.format(created, 'detached' if detach else 'dropped', removed))
+    return created, removed
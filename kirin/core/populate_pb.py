@@ -43,12 +43,17 @@ def to_posix_time(date_time):
     return 0
 
 
-def convert_to_gtfsrt(real_time_update):
+def make_feed(incrementality=gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL):
     feed = gtfs_realtime_pb2.FeedMessage()
 
-    feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL
+    feed.header.incrementality = incrementality
     feed.header.gtfs_realtime_version = '1'
     feed.header.timestamp = to_posix_time(datetime.datetime.utcnow())
+    return feed
+
+
+def convert_to_gtfsrt(real_time_update):
+    feed = make_feed()
 
     for trip_update in real_time_update.trip_updates:
         fill_entity(feed.entity.add(), trip_update)
@@ -81,3 +86,66 @@ def fill_trip_update(pb_trip_update, trip_update):
 def fill_entity(pb_entity, trip_update):
     pb_entity.id = trip_update.vj_id
     fill_trip_update(pb_entity.trip_update, trip_update)
+
+
+def serialize_entity(trip_update, cache=None, committed=True):
+    """
+    serialized FeedEntity of the trip update
+
+    the version of the trip update is incremented each time it is modified, so with a cache
+    the entity is built only once for each version.
+    Only the entities of committed trip updates are put in the cache: if the transaction is
+    rolled back, the version will be used again for another state of the trip update
+    """
+    key = (trip_update.vj_id, trip_update.version)
+    if cache is not None:
+        entity = cache.get(key)
+        if entity is not None:
+            return entity
+    pb_entity = gtfs_realtime_pb2.FeedEntity()
+    fill_entity(pb_entity, trip_update)
+    entity = pb_entity.SerializeToString()
+    if cache is not None and committed:
+        cache.set(key, entity)
+    return entity
+
+
+def _varint(value):
+    """
+    protobuf encoding of an unsigned int
+
+    >>> _varint(1)
+    '\\x01'
+    >>> _varint(300)
+    '\\xac\\x02'
+    """
+    result = []
+    while value > 0x7f:
+        result.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    result.append(chr(value))
+    return ''.join(result)
+
+
+# FeedMessage.entity is the field 2, with the 'length delimited' wire type
+_ENTITY_KEY = chr((2 << 3) | 2)
+
+
+def assemble_feed(feed, serialized_entities):
+    """
+    serialized FeedMessage made of the feed (its header) and the already serialized FeedEntity
+
+    the entities are not parsed again, they are only appended to the serialized feed
+    (it's what the protobuf serialization of the entities field would have done)
+    """
+    return feed.SerializeToString() + ''.join(_ENTITY_KEY + _varint(len(entity)) + entity
+                                              for entity in serialized_entities)
+
+
+def serialize_feed(trip_updates, cache=None, incrementality=gtfs_realtime_pb2.FeedHeader.DIFFERENTIAL,
+                   committed=True):
+    """
+    serialized FeedMessage of the trip updates, it's the same as convert_to_gtfsrt(...).SerializeToString()
+    but the entities are taken from the cache when possible
+    """
+    return assemble_feed(make_feed(incrementality), [serialize_entity(t, cache, committed) for t in trip_updates])
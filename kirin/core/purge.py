@@ -0,0 +1,167 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import collections
+import logging
+import time
+import sqlalchemy
+from kirin import db
+
+# pg_column_size of the whole row gives the space the row occupies in the table (and its toast),
+# it will be reusable by the next vacuum
+# the rows of the partitions are not purged one by one, the whole partitions are dropped (see kirin.core.partition)
+_OLD_REAL_TIME_UPDATES = sqlalchemy.text("""
+SELECT id, pg_column_size(real_time_update.*) FROM ONLY real_time_update WHERE received_at < :before LIMIT :limit
+""")
+
+_OLD_TRIP_UPDATES = sqlalchemy.text("""
+SELECT vehicle_journey.id, pg_column_size(vehicle_journey.*) + coalesce(pg_column_size(trip_update.*), 0)
+FROM vehicle_journey LEFT JOIN trip_update ON trip_update.vj_id = vehicle_journey.id
+WHERE vehicle_journey.circulation_date < :before LIMIT :limit
+""")
+
+_SENT_OUTBOX_MESSAGES = sqlalchemy.text("""
+SELECT id, pg_column_size(outbox_message.*) FROM outbox_message WHERE sent_at < :before LIMIT :limit
+""")
+
+_STOP_TIME_UPDATES_SIZE = sqlalchemy.text("""
+SELECT coalesce(sum(pg_column_size(stop_time_update.*)), 0) FROM stop_time_update
+WHERE trip_update_id = ANY(CAST(:ids AS UUID[]))
+""")
+
+_DELETE_ASSOCIATION_BY_REAL_TIME_UPDATE = sqlalchemy.text("""
+DELETE FROM associate_realtimeupdate_tripupdate WHERE real_time_update_id = ANY(CAST(:ids AS UUID[]))
+""")
+
+_DELETE_ASSOCIATION_BY_TRIP_UPDATE = sqlalchemy.text("""
+DELETE FROM associate_realtimeupdate_tripupdate WHERE trip_update_id = ANY(CAST(:ids AS UUID[]))
+""")
+
+_DELETE_REAL_TIME_UPDATES = sqlalchemy.text("""
+DELETE FROM ONLY real_time_update WHERE id = ANY(CAST(:ids AS UUID[]))
+""")
+
+_DELETE_STOP_TIME_UPDATES = sqlalchemy.text("""
+DELETE FROM stop_time_update WHERE trip_update_id = ANY(CAST(:ids AS UUID[]))
+""")
+
+_DELETE_TRIP_UPDATES = sqlalchemy.text("""
+DELETE FROM trip_update WHERE vj_id = ANY(CAST(:ids AS UUID[]))
+""")
+
+_DELETE_VEHICLE_JOURNEYS = sqlalchemy.text("""
+DELETE FROM vehicle_journey WHERE id = ANY(CAST(:ids AS UUID[]))
+""")
+
+_DELETE_OUTBOX_MESSAGES = sqlalchemy.text("""
+DELETE FROM outbox_message WHERE id = ANY(:ids)
+""")
+
+
+class PurgeResult(object):
+    def __init__(self):
+        self.rows = collections.Counter()  # table -> number of rows deleted
+        self.bytes = 0
+        self.batches = 0
+
+    def add(self, rows, size):
+        self.rows.update(rows)
+        self.bytes += size
+
+
+def _purge_by_batch(select, delete_batch, before, batch_size, pause, name):
+    """
+    delete the rows selected by 'select' by batch of batch_size rows, each batch in its own transaction
+
+    the transactions are short so the ingestion is not blocked, and we wait 'pause' seconds between
+    two batches to let the vacuum and the replication follow
+    """
+    log = logging.getLogger(__name__)
+    result = PurgeResult()
+    while True:
+        rows = db.session.execute(select, {'before': before, 'limit': batch_size}).fetchall()
+        if not rows:
+            break
+        nb_rows, size = delete_batch([row[0] for row in rows])
+        db.session.commit()
+        result.add(nb_rows, size + sum(row[1] or 0 for row in rows))
+        result.batches += 1
+        log.info('purge of {}: batch {}, {} rows deleted, {} bytes'.format(name, result.batches,
+                                                                         dict(result.rows), result.bytes))
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+    return result
+
+
+def _delete_real_time_updates(ids):
+    """
+    return the number of rows deleted by table and the size of the rows not counted by the select
+    """
+    db.session.execute(_DELETE_ASSOCIATION_BY_REAL_TIME_UPDATE, {'ids': ids})
+    deleted = db.session.execute(_DELETE_REAL_TIME_UPDATES, {'ids': ids}).rowcount
+    return {'real_time_update': deleted}, 0
+
+
+def _delete_trip_updates(ids):
+    size = db.session.execute(_STOP_TIME_UPDATES_SIZE, {'ids': ids}).scalar()
+    rows = {}
+    rows['stop_time_update'] = db.session.execute(_DELETE_STOP_TIME_UPDATES, {'ids': ids}).rowcount
+    db.session.execute(_DELETE_ASSOCIATION_BY_TRIP_UPDATE, {'ids': ids})
+    rows['trip_update'] = db.session.execute(_DELETE_TRIP_UPDATES, {'ids': ids}).rowcount
+    rows['vehicle_journey'] = db.session.execute(_DELETE_VEHICLE_JOURNEYS, {'ids': ids}).rowcount
+    return rows, size
+
+
+def _delete_outbox_messages(ids):
+    deleted = db.session.execute(_DELETE_OUTBOX_MESSAGES, {'ids': ids}).rowcount
+    return {'outbox_message': deleted}, 0
+
+
+def purge_real_time_updates(before, batch_size=1000, pause=0.5):
+    """
+    delete the real time updates (and so their raw data) received before the given datetime
+    """
+    return _purge_by_batch(_OLD_REAL_TIME_UPDATES, _delete_real_time_updates,
+                           before, batch_size, pause, 'real_time_update')
+
+
+def purge_trip_updates(before, batch_size=1000, pause=0.5):
+    """
+    delete the vehicle journeys circulating before the given date, with their trip updates and stop time updates
+    """
+    return _purge_by_batch(_OLD_TRIP_UPDATES, _delete_trip_updates,
+                           before, batch_size, pause, 'trip_update')
+
+
+def purge_outbox(before, batch_size=1000, pause=0.5):
+    """
+    delete the outbox messages sent before the given (UTC) datetime
+    """
+    return _purge_by_batch(_SENT_OUTBOX_MESSAGES, _delete_outbox_messages,
+                           before, batch_size, pause, 'outbox_message')
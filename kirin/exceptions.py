@@ -51,3 +51,12 @@ class ObjectNotFound(KirinException):
     code = 404
     message = 'object not found'
 
+
+class NavitiaError(KirinException):
+    code = 503
+    message = 'error while calling navitia'
+
+
+class ServiceUnavailable(KirinException):
+    code = 503
+    message = 'too many real time updates waiting to be processed, retry later'
@@ -0,0 +1,129 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import datetime
+import hashlib
+import sqlalchemy
+from xml.etree import ElementTree
+from kirin.cache import LruTtlCache
+from kirin.core.model import db, RealTimeUpdate
+
+# the creation date changes each time a message is sent again, it is not part of the content
+IGNORED_TAGS = ('DateHeureCreationMessage',)
+
+
+def content_hash(raw_xml):
+    """
+    hash of the content of an IRE message, the formatting and the creation date are not taken into account
+
+    return None if the xml is not valid
+
+    >>> content_hash('<InfoRetard><A>1</A></InfoRetard>') == content_hash('<InfoRetard>\\n  <A> 1 </A>\\n</InfoRetard>')
+    True
+    >>> content_hash('<InfoRetard><A>1</A></InfoRetard>') == content_hash('<InfoRetard><A>2</A></InfoRetard>')
+    False
+    >>> content_hash('<InfoRetard><DateHeureCreationMessage>21/09/2015 17:51:00</DateHeureCreationMessage></InfoRetard>') \\
+    ... == content_hash('<InfoRetard><DateHeureCreationMessage>21/09/2015 17:53:00</DateHeureCreationMessage></InfoRetard>')
+    True
+    >>> content_hash('<InfoRetard>') is None
+    True
+    """
+    try:
+        root = ElementTree.fromstring(raw_xml)
+    except ElementTree.ParseError:
+        return None
+    for element in root.iter():
+        for child in list(element):
+            if child.tag in IGNORED_TAGS:
+                element.remove(child)
+        element.text = element.text.strip() if element.text else None
+        element.tail = None
+    return hashlib.sha1(ElementTree.tostring(root)).hexdigest()
+
+
+class Deduplicator(object):
+    """
+    find the IRE messages repeating the last message accepted for their train in the last 'window' seconds
+
+    only the last message of the train is compared: after A, B then A again, the second A is not
+    a duplicate since it brings the train back to the state of A.
+    The last message of each train is kept in memory, but another kirin may have received a newer one,
+    so a repetition is always confirmed in the database
+    """
+    def __init__(self, max_size, window):
+        self.window = window
+        self._recent = LruTtlCache(max_size, window)  # train number -> (hash, id) of its last message
+        self.hits = 0
+
+    def find(self, train_number, content_hash):
+        """
+        return the id of the last RealTimeUpdate of the train if it has the same content, None otherwise
+        """
+        if content_hash is None or train_number is None:
+            return None
+        last = self._recent.get(train_number)
+        if last is not None and last[0] != content_hash:
+            return None
+        since = datetime.datetime.now() - datetime.timedelta(seconds=self.window)
+        # the messages in error do not change the state of the train, they are skipped
+        row = db.session.query(RealTimeUpdate.id, RealTimeUpdate.content_hash)\
+            .filter(RealTimeUpdate.train_number == train_number,
+                    RealTimeUpdate.received_at >= since,
+                    RealTimeUpdate.content_hash.isnot(None),
+                    sqlalchemy.or_(RealTimeUpdate.status.is_(None),
+                                   RealTimeUpdate.status != 'KO'))\
+            .order_by(RealTimeUpdate.received_at.desc()).first()
+        if row is None:
+            return None
+        self._recent.set(train_number, (row.content_hash, row.id))
+        if row.content_hash != content_hash:
+            return None
+        self.hits += 1
+        return row.id
+
+    def add(self, train_number, content_hash, rt_update_id):
+        if content_hash is not None and train_number is not None:
+            self._recent.set(train_number, (content_hash, rt_update_id))
+
+    def remove(self, train_number, content_hash):
+        """
+        forget a message ended in error, it may be processed successfully if it is sent again
+        """
+        last = self._recent.get(train_number) if train_number is not None else None
+        if last is not None and last[0] == content_hash:
+            self._recent.delete(train_number)
+
+    def clear(self):
+        self._recent.clear()
+        self.hits = 0
+
+    def info(self):
+        info = self._recent.info()
+        info['window'] = info.pop('ttl')
+        info['duplicates'] = self.hits
+        return info
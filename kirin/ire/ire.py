@@ -26,28 +26,38 @@
 # IRC #navitia on freenode
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
+import datetime
+import logging
 import flask
 from flask.globals import current_app
 from flask_restful import Resource
 from kirin import core
 from kirin.core import model
-from kirin.exceptions import InvalidArguments
+from kirin.exceptions import InvalidArguments, KirinException, ServiceUnavailable
 import kirin
-from model_maker import KirinModelBuilder
-import navitia_wrapper
+from kirin.navitia_client import get_navitia_client
+from kirin.ire.dedup import content_hash
+from model_maker import KirinModelBuilder, get_train_number
 
 
-def _make_rt_update(data):
+def _make_rt_update(data, status=None, error=None, content_hash=None, train_number=None):
     """
     Create an RealTimeUpdate object for the query and persist it
     """
-    rt_update = model.RealTimeUpdate(data, connector='ire')
+    rt_update = model.RealTimeUpdate(data, connector='ire', status=status, error=error, content_hash=content_hash,
+                                     train_number=train_number)
 
     model.db.session.add(rt_update)
     model.db.session.commit()
     return rt_update
 
 
+def _error_message(exception):
+    if isinstance(exception, KirinException):
+        return exception.data.get('error', exception.message)
+    return str(exception)
+
+
 def get_ire(req):
     """
     get IRE stream, for the moment, it's the raw xml
@@ -59,27 +69,147 @@ def get_ire(req):
 
 def make_navitia_wrapper():
     """
-    return a navitia wrapper to call the navitia API
+    return the navitia client to call the navitia API, it is shared by all the requests
+    """
+    return get_navitia_client(current_app.config['NAVITIA_INSTANCE'])
+
+
+def process(rt_update):
+    """
+    interpret the raw xml of the RealTimeUpdate, merge the resulting TripUpdates and publish them
+    """
+    # assuming UTF-8 encoding for all ire input
+    # (the raw data is still the received string if it has not been reloaded from the db)
+    if isinstance(rt_update.raw_data, unicode):
+        rt_update.raw_data = rt_update.raw_data.encode('utf-8')
+
+    # raw_xml is interpreted
+    trip_updates = KirinModelBuilder(make_navitia_wrapper()).build(rt_update)
+
+    core.handle(rt_update, trip_updates)
+
+
+def process_pending(rt_update_id):
+    """
+    process a RealTimeUpdate previously stored with the 'pending' status
+
+    this is run by the background worker, so the errors are only stored in the RealTimeUpdate
+    """
+    rt_update = _claim_pending(rt_update_id)
+    if not rt_update:
+        logging.getLogger(__name__).warning('no pending real time update {}, skipping it'.format(rt_update_id))
+        return
+
+    rt_update.status = 'OK'
+    try:
+        process(rt_update)
+    except Exception as e:
+        logging.getLogger(__name__).exception('impossible to process real time update {}'.format(rt_update_id))
+        model.db.session.rollback()
+        # unless it has been claimed again by another process in the meantime
+        failed = model.db.session.execute(_FAIL_PENDING, {
+            'id': rt_update_id,
+            'error': _error_message(e),
+            'now': datetime.datetime.utcnow(),
+            'claimed_at': rt_update.processing_started_at,
+        }).fetchone()
+        model.db.session.commit()
+        if failed:
+            kirin.ire_deduplicator.remove(failed.train_number, failed.content_hash)
+
+
+_CLAIM_PENDING = """
+UPDATE real_time_update SET processing_started_at = :now
+WHERE id = :id AND status = 'pending' AND (processing_started_at IS NULL OR processing_started_at < :expired)
+RETURNING id
+"""
+
+_FAIL_PENDING = """
+UPDATE real_time_update SET status = 'KO', error = :error, updated_at = :now
+WHERE id = :id AND status = 'pending' AND processing_started_at = :claimed_at
+RETURNING content_hash, train_number
+"""
+
+
+def _claim_pending(rt_update_id):
+    """
+    claim the pending RealTimeUpdate by recording when its processing started
+
+    the claim is committed at once, so no lock, transaction or connection is held while navitia is called.
+    None if it is not pending anymore or if another process (a worker or the process_pending command)
+    claimed it less than PENDING_CLAIM_TIMEOUT seconds ago
     """
-    url = current_app.config['NAVITIA_URL']
-    token = current_app.config.get('NAVITIA_TOKEN')
-    instance = current_app.config['NAVITIA_INSTANCE']
-    return navitia_wrapper.Navitia(url=url, token=token).instance(instance)
+    now = datetime.datetime.utcnow()
+    expired = now - datetime.timedelta(seconds=current_app.config['PENDING_CLAIM_TIMEOUT'])
+    claimed = model.db.session.execute(_CLAIM_PENDING, {'id': rt_update_id, 'now': now,
+                                                        'expired': expired}).fetchone()
+    model.db.session.commit()
+    if not claimed:
+        return None
+    rt_update = model.RealTimeUpdate.query.get(rt_update_id)
+    # the reading transaction is ended without expiring the loaded RealTimeUpdate
+    model.db.session.expunge(rt_update)
+    model.db.session.commit()
+    model.db.session.add(rt_update)
+    return rt_update
 
 
 class Ire(Resource):
 
     def post(self):
         raw_xml = get_ire(flask.globals.request)
+        train_number = get_train_number(raw_xml)
+
+        raw_xml_hash = None
+        if current_app.config['IRE_DEDUP']:
+            raw_xml_hash = content_hash(raw_xml)
+            duplicate_id = kirin.ire_deduplicator.find(train_number, raw_xml_hash)
+            if duplicate_id is not None:
+                # the message is the last one received for the train, there is nothing new to publish
+                logging.getLogger(__name__).info('duplicate of the real time update {}, skipping it'
+                                                 .format(duplicate_id))
+                if current_app.config['IRE_ASYNC_PROCESSING']:
+                    return {'id': duplicate_id}, 202
+                return 'OK', 200
+
+        if current_app.config['IRE_ASYNC_PROCESSING']:
+            if kirin.worker.is_full():
+                # better to make the sender retry than to make it wait for navitia
+                raise ServiceUnavailable()
+            # we only save the raw_xml, the background worker will do the rest
+            rt_update = _make_rt_update(raw_xml, status='pending', content_hash=raw_xml_hash,
+                                        train_number=train_number)
+            kirin.ire_deduplicator.add(train_number, raw_xml_hash, rt_update.id)
+            # the updates of a train are processed in the order they were received
+            kirin.worker.spawn(process_pending, rt_update.id, key=train_number)
+            return {'id': rt_update.id}, 202
+
+        if current_app.config['IRE_SINGLE_TRANSACTION']:
+            # the raw_xml is saved with the trip updates, in only one transaction
+            rt_update = model.RealTimeUpdate(raw_xml, connector='ire', status='OK', content_hash=raw_xml_hash,
+                                             train_number=train_number)
+            try:
+                process(rt_update)
+            except Exception as e:
+                model.db.session.rollback()
+                if model.RealTimeUpdate.query.get(rt_update.id):
+                    # the trip updates have been saved, only the publication failed
+                    logging.getLogger(__name__).exception('impossible to publish real time update {}'
+                                                          .format(rt_update.id))
+                    raise
+                # nothing has been saved, we only save the raw_xml with the error
+                _make_rt_update(raw_xml, status='KO', error=_error_message(e))
+                raise
+            kirin.ire_deduplicator.add(train_number, raw_xml_hash, rt_update.id)
+            return 'OK', 200
 
         # create a raw ire obj, save the raw_xml into the db
         rt_update = _make_rt_update(raw_xml)
-        # assuming UTF-8 encoding for all ire input
-        rt_update.raw_data = rt_update.raw_data.encode('utf-8')
-
-        # raw_xml is interpreted
-        trip_updates = KirinModelBuilder(make_navitia_wrapper()).build(rt_update)
 
-        core.handle(rt_update, trip_updates)
+        # the hash is saved with the trip updates, so a message in error is not a duplicate
+        rt_update.content_hash = raw_xml_hash
+        rt_update.train_number = train_number
+        process(rt_update)
 
+        kirin.ire_deduplicator.add(train_number, raw_xml_hash, rt_update.id)
         return 'OK', 200
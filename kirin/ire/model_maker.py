@@ -29,13 +29,15 @@
 import logging
 from datetime import timedelta
 from dateutil import parser
+from flask.globals import current_app
+import kirin
 from kirin.core import model
+from kirin.core.navitia_vj import NavitiaVJ
 
 # For perf benches:
 # http://effbot.org/zone/celementtree.htm
 import xml.etree.cElementTree as ElementTree
 from kirin.exceptions import InvalidArguments, ObjectNotFound
-import navitia_wrapper
 
 
 def get_node(elt, xpath):
@@ -76,17 +78,29 @@ def as_bool(s):
     return s == 'true'
 
 
+def get_train_number(raw_xml):
+    """
+    number of the train updated by the raw xml, None if it cannot be read
+
+    >>> get_train_number('<InfoRetard><Train><NumeroTrain>006113</NumeroTrain></Train></InfoRetard>')
+    '6113'
+    >>> get_train_number('<bob></bob>')
+    """
+    try:
+        number = ElementTree.fromstring(raw_xml).find('Train/NumeroTrain')
+    except ElementTree.ParseError:
+        return None
+    return headsign(number.text) if number is not None and number.text else None
+
+
 def get_navitia_stop_time(navitia_vj, stop_id):
-    nav_st = next((st for st in navitia_vj['stop_times']
-                  if st.get('journey_pattern_point', {})
-                       .get('stop_point', {})
-                       .get('id') == stop_id), None)
+    nav_sts = navitia_vj.stop_times_by_stop_point(stop_id)
 
     # if a VJ pass several times at the same stop, we cannot know
     # perfectly which stop time to impact
     # as a first version, we only impact the first
 
-    return nav_st
+    return nav_sts[0] if nav_sts else None
 
 
 class KirinModelBuilder(object):
@@ -127,15 +141,37 @@ class KirinModelBuilder(object):
         vj_end = as_date(get_value(xml_train, 'TerminusTheoriqueTrain/DateHeureTerminus'))
         until = vj_end + timedelta(hours=1)
 
-        log.debug('searching for vj {} on {} in navitia'.format(train_number, vj_start))
-
-        navitia_vjs = self.navitia.vehicle_journeys(q={
-            'headsign': train_number,
-            'since': to_str(since),
-            'until': to_str(until),
-            'depth': '2',  # we need this depth to get the stoptime's stop_area
-            'show_codes': 'true'  # we need the stop_points CRCICH codes
-        })
+        instance = current_app.config['NAVITIA_INSTANCE']
+        # the same train is often updated several times, so the navitia responses are cached
+        cache_key = (train_number, since.date(), instance)
+        # the trains unknown by navitia (freight trains, ...) are also received several times,
+        # so we keep the misses for a shorter time
+        miss_key = (train_number, since, until, instance)
+        # the vjs preloaded in the catalogue are used first
+        navitia_vjs = kirin.vj_catalogue.get(train_number, vj_start.date(), since, until)
+        if navitia_vjs is None:
+            navitia_vjs = kirin.navitia_vj_cache.get(cache_key)
+
+        if navitia_vjs is None and not kirin.navitia_vj_miss_cache.get(miss_key):
+            log.debug('searching for vj {} on {} in navitia'.format(train_number, vj_start))
+
+            q = {
+                'headsign': train_number,
+                'since': to_str(since),
+                'until': to_str(until),
+                'depth': '2',  # we need this depth to get the stoptime's stop_area
+                'show_codes': 'true'  # we need the stop_points CRCICH codes
+            }
+            # the updates of a train often arrive at the same time,
+            # only one of them queries navitia, the others wait for its response
+            # the vjs are indexed once, and shared by all the following messages of the train
+            navitia_vjs = kirin.navitia_single_flight.call(
+                (instance,) + tuple(sorted(q.items())),
+                lambda: [NavitiaVJ(nav_vj) for nav_vj in self.navitia.vehicle_journeys(q=q)])
+            if navitia_vjs:
+                kirin.navitia_vj_cache.set(cache_key, navitia_vjs)
+            else:
+                kirin.navitia_vj_miss_cache.set(miss_key, True)
 
         if not navitia_vjs:
             raise ObjectNotFound(
@@ -168,11 +204,9 @@ class KirinModelBuilder(object):
                 if nav_st is None:
                     continue
 
-                nav_stop = nav_st.get('stop_point', {})
-
                 departure = None
                 arrival = None
-                st_update = model.StopTimeUpdate(nav_stop, departure, arrival)
+                st_update = model.StopTimeUpdate({'id': nav_st.stop_point_id}, departure, arrival)
                 trip_update.stop_time_updates.append(st_update)
 
         removal = xml_modification.find('Suppression')
@@ -199,12 +233,7 @@ class KirinModelBuilder(object):
 
         nav_external_code = "{cr}-{ci}-{ch}".format(cr=cr, ci=ci, ch=ch)
 
-        nav_stop_times = []
-        for s in nav_vj.get('stop_times', []):
-            for c in s.get('stop_point', {}).get('stop_area', {}).get('codes', []):
-                if c['value'] == nav_external_code and c['type'] == 'CR-CI-CH':
-                    nav_stop_times.append(s)
-                    break
+        nav_stop_times = nav_vj.stop_times_by_cr_ci_ch(nav_external_code)
 
         if not nav_stop_times:
             logging.getLogger(__name__).info('impossible to find stop "{}" in the vj, skipping it'
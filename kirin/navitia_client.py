@@ -0,0 +1,137 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import logging
+from flask.globals import current_app
+from gevent.lock import BoundedSemaphore
+import requests
+from requests.adapters import HTTPAdapter
+from kirin.exceptions import NavitiaError
+
+
+class NavitiaClient(object):
+    """
+    long lived client of a navitia instance
+
+    the http connections are kept alive in a pool shared by all the greenlets,
+    when all the connections are used, the greenlets wait for a free one at most 'timeout' seconds
+    """
+    def __init__(self, url, instance, token=None, timeout=5, pool_size=10):
+        self.url = '{url}v1/coverage/{instance}/'.format(url=url, instance=instance)
+        self.instance = instance
+        self.token = token
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = requests.Session()
+        # the pool does not block (a blocked greenlet would not be bounded by the timeout),
+        # the number of concurrent calls is limited by the semaphore instead
+        self._slots = BoundedSemaphore(pool_size)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self.calls = 0
+        self.in_flight = 0
+
+    def query(self, query, q=None):
+        """
+        call navitia and return the json response with the status code
+        """
+        self.calls += 1
+        if not self._slots.acquire(timeout=self.timeout):
+            raise NavitiaError('no free connection to navitia after {}s'.format(self.timeout))
+        self.in_flight += 1
+        try:
+            response = self._session.get(self.url + query, auth=(self.token, None), params=q,
+                                         timeout=self.timeout)
+            return response.json(), response.status_code
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.getLogger(__name__).exception('call to navitia failed')
+            raise NavitiaError('call to navitia failed: {}'.format(e))
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def _vehicle_journeys_page(self, q):
+        res, status = self.query('vehicle_journeys/', q)
+        # navitia answers a 404 when no vehicle journey matches the filter
+        if status == 404:
+            return [], {}
+        if status != 200:
+            raise NavitiaError('navitia answered a {} error: {}'.format(status, res.get('error')))
+        return res.get('vehicle_journeys', []), res.get('pagination', {})
+
+    def vehicle_journeys(self, q=None):
+        vjs, _ = self._vehicle_journeys_page(q)
+        return vjs
+
+    def iter_vehicle_journeys(self, q=None, count=1000):
+        """
+        iterate over all the vehicle journeys matching the filter, querying navitia page by page
+        """
+        q = dict(q or {}, count=str(count))
+        start_page = 0
+        while True:
+            q['start_page'] = str(start_page)
+            vjs, pagination = self._vehicle_journeys_page(q)
+            for vj in vjs:
+                yield vj
+            start_page += 1
+            if not vjs or start_page * pagination.get('items_per_page', count) >= pagination.get('total_result', 0):
+                return
+
+    def info(self):
+        return {
+            'url': self.url,
+            'timeout': self.timeout,
+            'pool_size': self.pool_size,
+            'in_flight': self.in_flight,
+            'calls': self.calls,
+        }
+
+
+def get_navitia_client(instance):
+    """
+    return the navitia client of the instance for the current app
+
+    the client is created on the first call, then shared by all the requests
+    """
+    clients = current_app.extensions.setdefault('navitia_clients', {})
+    client = clients.get(instance)
+    if client is None:
+        config = current_app.config
+        client = clients.setdefault(instance, NavitiaClient(url=config['NAVITIA_URL'],
+                                                            instance=instance,
+                                                            token=config.get('NAVITIA_TOKEN'),
+                                                            timeout=config['NAVITIA_TIMEOUT'],
+                                                            pool_size=config['NAVITIA_POOL_SIZE']))
+    return client
+
+
+def navitia_clients_info():
+    return {instance: client.info()
+            for instance, client in current_app.extensions.get('navitia_clients', {}).items()}
@@ -29,26 +29,211 @@
 from kombu import BrokerConnection, Exchange
 from kombu.pools import producers, connections
 import logging
+import weakref
 from amqp.exceptions import ConnectionForced
 import gevent
+from gevent.event import Event
+from gevent.queue import JoinableQueue, Full, Empty
+from kirin.spool import Spool
 
 
 class RabbitMQHandler(object):
-    def __init__(self, connection_string, exchange):
-        self._connection = BrokerConnection(connection_string)
+    """
+    publish the GTFS-RT feeds on the exchange, with the contributor as routing key
+
+    if async_publish is True, publish() only put the feed in a bounded queue, a background greenlet
+    publishes them. The feeds of a contributor received in the same batch_delay are concatenated
+    in one message (the concatenation of serialized protobuf messages is their merge)
+
+    with confirm_publish, each message waits for the ack of rabbitmq (with async_publish, there
+    is only one message to confirm for each batch).
+    If spool_path is given, the messages that cannot be published are written in this file
+    and replayed every replay_interval seconds, in order.
+    Without spool, a batch that cannot be published is tried 'retries' more times, after
+    retry_delay, then 2 * retry_delay, ... seconds. The feeds still not published are counted as lost
+    (see publication_info). The retries are done by other greenlets, so the batches of the other
+    contributors are not delayed; the next feeds of the contributor wait to be published after them
+    """
+    def __init__(self, connection_string, exchange, async_publish=False, queue_size=1000, batch_delay=0.05,
+                 confirm_publish=False, spool_path=None, replay_interval=10, retries=3, retry_delay=1):
+        self._connection = BrokerConnection(connection_string,
+                                            transport_options={'confirm_publish': confirm_publish})
         self._connections = set([self._connection])  # set of connection for the heartbeat
+        # publish_confirmed always waits for the acks, it has its own connection if the others do not
+        self._confirmed_connection = self._connection if confirm_publish else \
+            BrokerConnection(connection_string, transport_options={'confirm_publish': True})
         self._exchange = Exchange(exchange, durable=True, delivry_mode=2, type='topic')
+        # the amqp connections on which the exchange has already been declared
+        self._declared = weakref.WeakSet()
         self._connection.connect()
         monitor_heartbeats(self._connections)
+        self._batch_delay = batch_delay
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self.published = 0
+        self.retried = 0
+        self.lost = 0
+        self._waiting = {}  # contributor being published -> feeds waiting to be published after
+        self._idle = Event()  # set when no contributor is being published
+        self._idle.set()
+        self._queue = None
+        if async_publish:
+            self._queue = JoinableQueue(maxsize=queue_size)
+            gevent.spawn(self._publish_loop)
+        self._replay_interval = replay_interval
+        self._spool = None
+        if spool_path:
+            self._spool = Spool(spool_path)
+            gevent.spawn_later(replay_interval, self._replay_loop)
 
-    def _get_producer(self):
-        producer = producers[self._connection].acquire(block=True, timeout=2)
+    def _get_producer(self, connection=None):
+        producer = producers[connection or self._connection].acquire(block=True, timeout=2)
         self._connections.add(producer.connection)
         return producer
 
+    def _publish(self, item, contributor, connection=None):
+        with self._get_producer(connection) as producer:
+            amqp_connection = producer.connection.connection
+            declare = [] if amqp_connection in self._declared else [self._exchange]
+            producer.publish(item, exchange=self._exchange, routing_key=contributor, declare=declare)
+            if declare:
+                self._declared.add(amqp_connection)
+
+    def _send(self, item, contributor):
+        """
+        publish the message, or spool it if rabbitmq is not available
+        """
+        if self._spool is None:
+            self._publish(item, contributor)
+            return
+        if not self._spool.is_empty():
+            # rabbitmq is not available, and the message has to be published after the spooled ones
+            self._spool.append(contributor, item)
+            return
+        try:
+            self._publish(item, contributor)
+        except Exception:
+            logging.getLogger(__name__).exception('impossible to publish, the message is spooled')
+            self._spool.append(contributor, item)
+
     def publish(self, item, contributor):
-        with self._get_producer() as producer:
-            producer.publish(item, exchange=self._exchange, routing_key=contributor, declare=[self._exchange])
+        if self._queue is None:
+            self._send(item, contributor)
+            self.published += 1
+            return
+        try:
+            self._queue.put_nowait((item, contributor))
+        except Full:
+            # the queue is full, the caller will have to wait for the broker
+            logging.getLogger(__name__).warning('the publication queue is full, publishing synchronously')
+            self._send(item, contributor)
+            self.published += 1
+
+    def publish_confirmed(self, item, contributor):
+        """
+        publish the message now and wait for the ack of rabbitmq, whatever the configuration
+        (no background publication and no spool), the errors are raised
+
+        it's used by the outbox relay: a message is marked as sent only once rabbitmq has it
+        """
+        self._publish(item, contributor, self._confirmed_connection)
+
+    def _publish_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            gevent.sleep(self._batch_delay)
+            try:
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self._publish_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _publish_batch(self, batch):
+        items_by_contributor = {}
+        contributors = []
+        for item, contributor in batch:
+            if contributor not in items_by_contributor:
+                contributors.append(contributor)
+            items_by_contributor.setdefault(contributor, []).append(item)
+        for contributor in contributors:
+            items = items_by_contributor[contributor]
+            if contributor in self._waiting:
+                # the previous feeds of the contributor are being retried, these ones are published after
+                self._waiting[contributor].extend(items)
+                continue
+            self._waiting[contributor] = []
+            self._idle.clear()
+            self._try_publish(contributor, items)
+
+    def _try_publish(self, contributor, items, attempt=0):
+        """
+        publish the feeds of the contributor, then the ones that have been waiting behind them
+
+        if it fails, the next attempt is done later by another greenlet
+        """
+        while items:
+            try:
+                self._send(''.join(items), contributor)
+                self.published += len(items)
+            except Exception:
+                if attempt < self._retries:
+                    self.retried += 1
+                    logging.getLogger(__name__).warning('impossible to publish {} feeds for {}, retrying'
+                                                        .format(len(items), contributor))
+                    gevent.spawn_later(self._retry_delay * (attempt + 1),
+                                       self._try_publish, contributor, items, attempt + 1)
+                    return
+                self.lost += len(items)
+                logging.getLogger(__name__).exception('impossible to publish {} feeds for {}, they are lost'
+                                                      .format(len(items), contributor))
+            items, attempt = self._waiting[contributor], 0
+            self._waiting[contributor] = []
+        del self._waiting[contributor]
+        if not self._waiting:
+            self._idle.set()
+
+    def replay_spool(self):
+        """
+        publish the spooled messages, return the number of messages published
+        """
+        if self._spool is None:
+            return 0
+        try:
+            return self._spool.replay(self._publish)
+        except Exception:
+            logging.getLogger(__name__).warning('rabbitmq is still not available, {} bytes are spooled'
+                                                .format(self._spool.size()))
+            return 0
+
+    def _replay_loop(self):
+        self.replay_spool()
+        gevent.spawn_later(self._replay_interval, self._replay_loop)
+
+    def join(self, timeout=None):
+        """
+        wait for the queued feeds to be published (or lost), retries included
+        """
+        if self._queue is not None:
+            # JoinableQueue.join has no timeout with gevent 1.0
+            with gevent.Timeout(timeout, False):
+                self._queue.join()
+                self._idle.wait()
+
+    def publication_info(self):
+        return {
+            'async': self._queue is not None,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'published': self.published,
+            'retried': self.retried,
+            'lost': self.lost,
+            'retrying': len(self._waiting),
+            'spooled_bytes': self._spool.size() if self._spool is not None else 0,
+        }
 
     def info(self):
         if not self._is_active:
@@ -28,13 +28,15 @@
 
 from flask_restful import Resource, url_for
 import kirin
-from flask import current_app
+from kirin.navitia_client import navitia_clients_info
+from flask import current_app, Response, request
 
 class Index(Resource):
     def get(self):
         response = {
             'status': {'href': url_for('status', _external=True)},
-            'ire': {'href': url_for('ire', _external=True)}
+            'ire': {'href': url_for('ire', _external=True)},
+            'gtfs_rt': {'href': url_for('gtfs_rt', _external=True)}
         }
         return response, 200
 
@@ -45,5 +47,34 @@ class Status(Resource):
                    'db_pool_status': kirin.db.engine.pool.status(),
                    'db_version': kirin.db.engine.scalar('select version_num from alembic_version;'),
                    'navitia_url': current_app.config['NAVITIA_URL'],
+                   'navitia_clients': navitia_clients_info(),
+                   'navitia_vj_cache': kirin.navitia_vj_cache.info(),
+                   'navitia_vj_miss_cache': kirin.navitia_vj_miss_cache.info(),
+                   'navitia_single_flight': kirin.navitia_single_flight.info(),
+                   'vj_catalogue': kirin.vj_catalogue.info(),
+                   'ire_deduplicator': kirin.ire_deduplicator.info(),
+                   'coalescer': kirin.coalescer.info(),
+                   'gtfs_rt_feed': kirin.gtfs_rt_feed.info(),
+                   'gtfs_rt_entity_cache': kirin.gtfs_rt_entity_cache.info(),
+                   'rabbitmq_publication': kirin.rabbitmq_handler.publication_info(),
                    #'rabbitmq_info': publisher.info()
                }, 200
+
+
+class GtfsRt(Resource):
+    def get(self):
+        """
+        FULL_DATASET GTFS-RT feed of all the active trip updates, conditional on its etag and gzipped if accepted
+        """
+        gzipped = request.accept_encodings['gzip'] > 0
+        # answered from the feed in memory, refreshed in the background
+        feed, etag = kirin.gtfs_rt_feed.current(gzipped)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(feed, mimetype='application/octet-stream')
+            if gzipped:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        return response
@@ -0,0 +1,207 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import contextlib
+import fcntl
+import json
+import os
+import struct
+from gevent.lock import RLock
+
+_HEADER = struct.Struct('>II')
+
+
+class Spool(object):
+    """
+    append only file of the messages that could not be published
+
+    each record is the size of the json encoded contributor, the size of the message,
+    the contributor and the message. The messages are replayed in the order they have been spooled
+
+    the file is shared by all the processes of kirin: it is modified under an flock of 'path.lock'
+    (and of a gevent lock for the greenlets of the process), and only one process replays it at a time.
+    The lock file holds the generation of the spool, incremented each time the spool is rewritten by a replay
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock_path = path + '.lock'
+        self._replay_lock_path = path + '.replay.lock'
+        self._lock = RLock()
+        self._replaying = False
+        # the records of the spool are known to be complete up to this offset, for this generation
+        self._checked = (None, 0)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        the lock file is given, to read or change the generation
+        """
+        with self._lock:
+            with open(self._lock_path, 'a+') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield lock_file
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _generation(lock_file):
+        lock_file.seek(0)
+        return lock_file.read()
+
+    @staticmethod
+    def _next_generation(lock_file):
+        generation = int(Spool._generation(lock_file) or 0) + 1
+        lock_file.truncate(0)
+        lock_file.write(str(generation))
+        lock_file.flush()
+
+    def append(self, contributor, item):
+        contributor = json.dumps(contributor).encode('utf-8')
+        record = _HEADER.pack(len(contributor), len(item)) + contributor + item
+        with self._locked() as lock_file:
+            generation = self._generation(lock_file)
+            checked_generation, checked = self._checked
+            with open(self.path, 'a+b') as f:
+                # a record left incomplete by a crash is removed, the next records would be misread after it.
+                # Only the records written since the last append of this process are read
+                end = self._end_of_records(f, checked if generation == checked_generation else 0)
+                if end < f.tell():
+                    f.truncate(end)
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            self._checked = (generation, end + len(record))
+
+    def size(self):
+        """
+        size of the spool, in bytes
+        """
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def is_empty(self):
+        return self.size() == 0
+
+    @staticmethod
+    def _end_of_records(f, offset=0):
+        """
+        offset of the end of the last complete record of the file, the records are read from the given
+        offset (the end of a complete record). The file is left at its end
+        """
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if offset > size:
+            offset = 0
+        while offset + _HEADER.size <= size:
+            f.seek(offset)
+            contributor_size, item_size = _HEADER.unpack(f.read(_HEADER.size))
+            end = offset + _HEADER.size + contributor_size + item_size
+            if end > size:
+                break
+            offset = end
+        f.seek(0, os.SEEK_END)
+        return offset
+
+    @staticmethod
+    def _records(f):
+        """
+        yield the (contributor, message, offset of the end of the record) of the file
+
+        the reading stops at an incomplete record (being written by another process, or left by a crash
+        and removed by the next append)
+        """
+        offset = 0
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            contributor_size, item_size = _HEADER.unpack(header)
+            contributor = f.read(contributor_size)
+            item = f.read(item_size)
+            if len(contributor) < contributor_size or len(item) < item_size:
+                return
+            offset += _HEADER.size + contributor_size + item_size
+            yield json.loads(contributor.decode('utf-8')), item, offset
+
+    def replay(self, publish):
+        """
+        publish the spooled messages in order, it stops at the first error (the exception is raised)
+        and the messages not published are kept for the next replay
+
+        return the number of messages published (0 if another process is replaying the spool)
+        """
+        if self._replaying or self.is_empty():
+            return 0
+        with open(self._replay_lock_path, 'a') as replay_lock:
+            try:
+                fcntl.flock(replay_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return 0
+            # the spool may have been replayed by another process in the meantime
+            if self.is_empty():
+                fcntl.flock(replay_lock, fcntl.LOCK_UN)
+                return 0
+            self._replaying = True
+            published = 0
+            done = 0
+            try:
+                with open(self.path, 'rb') as f:
+                    for contributor, item, offset in self._records(f):
+                        publish(item, contributor)
+                        published += 1
+                        done = offset
+            finally:
+                self._remove_head(done)
+                self._replaying = False
+                fcntl.flock(replay_lock, fcntl.LOCK_UN)
+        return published
+
+    def _remove_head(self, offset):
+        """
+        remove the first 'offset' bytes of the spool, the messages spooled during the replay are kept
+        """
+        if offset == 0:
+            return
+        with self._locked() as lock_file:
+            # the offsets known by the processes are not valid anymore
+            self._next_generation(lock_file)
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                rest = f.read()
+            if not rest:
+                os.remove(self.path)
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(rest)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
@@ -0,0 +1,137 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import datetime
+import logging
+import gevent
+from kirin.core.navitia_vj import NavitiaVJ
+from kirin.navitia_client import get_navitia_client
+from kirin.ire.model_maker import headsign as normalize_headsign
+
+
+def _headsigns(navitia_vj):
+    """
+    the train numbers matched by the navitia 'headsign' filter: the ones of the vj and of its stop times
+    (the number of a train changes with its parity along the journey)
+    """
+    headsigns = {navitia_vj.get('headsign'), navitia_vj.get('name')}
+    headsigns.update(st.get('headsign') for st in navitia_vj.get('stop_times', []))
+    return {normalize_headsign(h) for h in headsigns if h}
+
+
+def _circulates_between(navitia_vj, circulation_date, since, until):
+    for st in navitia_vj.stop_times:
+        for dt in (st.departure(circulation_date), st.arrival(circulation_date)):
+            if dt is not None and since <= dt <= until:
+                return True
+    return False
+
+
+class VJCatalogue(object):
+    """
+    in memory index of all the vehicle journeys of a navitia instance, by headsign and circulation date
+    (only the fields used by kirin are kept, see NavitiaVJ)
+
+    the headsigns are normalized like the train numbers of the IRE messages, and the vjs are
+    filtered on the same time window as the navitia queries, so the catalogue gives the same vjs
+
+    it is loaded in background, so most of the messages do not need any call to navitia
+    """
+    def __init__(self):
+        self._vjs = {}
+        self.days = []
+        self.loaded_at = None
+
+    def get(self, headsign, circulation_date, since=None, until=None):
+        """
+        return the list of NavitiaVJ circulating between since and until,
+        or None if the vj is not in the catalogue
+        """
+        vjs = self._vjs.get((normalize_headsign(headsign), circulation_date))
+        if vjs and since is not None and until is not None:
+            vjs = [vj for vj in vjs if _circulates_between(vj, circulation_date, since, until)]
+        return vjs or None
+
+    def load(self, navitia, days, page_size=1000):
+        """
+        load the vehicle journeys of all the given days, page by page
+
+        the catalogue is replaced only when everything is loaded, so it is usable during the load
+        """
+        log = logging.getLogger(__name__)
+        vjs = {}
+        for day in days:
+            log.info('loading the vehicle journeys of {} in the catalogue'.format(day))
+            nb_vjs = 0
+            for navitia_vj in navitia.iter_vehicle_journeys(q={
+                    'since': day.strftime('%Y%m%dT000000'),
+                    'until': (day + datetime.timedelta(days=1)).strftime('%Y%m%dT000000'),
+                    'depth': '2',  # we need this depth to get the stoptime's stop_area
+                    'show_codes': 'true'  # we need the stop_points CRCICH codes
+                    }, count=page_size):
+                vj = NavitiaVJ(navitia_vj)
+                for headsign in _headsigns(navitia_vj):
+                    vjs.setdefault((headsign, day), []).append(vj)
+                nb_vjs += 1
+            log.info('{} vehicle journeys loaded for {}'.format(nb_vjs, day))
+
+        self._vjs = vjs
+        self.days = list(days)
+        self.loaded_at = datetime.datetime.utcnow()
+
+    def clear(self):
+        self._vjs = {}
+        self.days = []
+        self.loaded_at = None
+
+    def info(self):
+        return {
+            'days': [d.isoformat() for d in self.days],
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            'nb_entries': len(self._vjs),
+        }
+
+
+def start_daily_load(app, catalogue):
+    """
+    load the catalogue for today and tomorrow now, then reload it each day
+
+    since the catalogue always covers the next day, it can be reloaded at any hour
+    """
+    def load():
+        with app.app_context():
+            try:
+                today = datetime.date.today()
+                catalogue.load(get_navitia_client(app.config['NAVITIA_INSTANCE']),
+                               [today, today + datetime.timedelta(days=1)],
+                               page_size=app.config['NAVITIA_VJ_CATALOGUE_PAGE_SIZE'])
+            except Exception:
+                logging.getLogger(__name__).exception('impossible to load the vehicle journeys catalogue')
+        gevent.spawn_later(app.config['NAVITIA_VJ_CATALOGUE_RELOAD_PERIOD'], load)
+
+    gevent.spawn(load)
@@ -0,0 +1,107 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import logging
+from collections import deque
+import gevent
+from gevent.event import Event
+from gevent.queue import Queue
+
+
+class Worker(object):
+    """
+    pool of greenlets used to run the processing of the real time updates in background
+
+    each task is run in its own flask app context (and thus with its own db session)
+
+    the tasks with the same key (the updates of a train) are run one after the other, in the order
+    they were spawned, so an update is never overwritten by an older one.
+    At most 'max_pending' tasks are waiting, the callers have to check 'is_full()' before spawning
+    """
+    def __init__(self, app, size, max_pending=1000):
+        self._app = app
+        self.size = size
+        self.max_pending = max_pending
+        self._tasks = {}  # key -> deque of the tasks waiting for the previous task of the key
+        self._ready = Queue()  # keys whose tasks can be run
+        self._greenlets = []
+        self._pending = 0
+        self._idle = Event()
+        self._idle.set()
+
+    def is_full(self):
+        return self._pending >= self.max_pending
+
+    def spawn(self, func, *args, **kwargs):
+        """
+        schedule the task without blocking, after the tasks already scheduled with the same key
+        """
+        key = kwargs.pop('key', None)
+        if key is None:
+            key = object()  # a task without key can be run at any time
+        if not self._greenlets:
+            self._greenlets = [gevent.spawn(self._loop) for _ in range(self.size)]
+        self._pending += 1
+        self._idle.clear()
+        if key in self._tasks:
+            self._tasks[key].append((func, args, kwargs))
+        else:
+            self._tasks[key] = deque([(func, args, kwargs)])
+            self._ready.put(key)
+
+    def _loop(self):
+        while True:
+            key = self._ready.get()
+            tasks = self._tasks[key]
+            while tasks:
+                func, args, kwargs = tasks.popleft()
+                self._run(func, *args, **kwargs)
+                self._pending -= 1
+            del self._tasks[key]
+            if not self._pending:
+                self._idle.set()
+
+    def _run(self, func, *args, **kwargs):
+        with self._app.app_context():
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logging.getLogger(__name__).exception('background task {} failed'.format(func.__name__))
+
+    def join(self, timeout=None):
+        """
+        wait for all the scheduled tasks to be finished
+        """
+        self._idle.wait(timeout=timeout)
+
+    def info(self):
+        return {
+            'size': self.size,
+            'pending': self._pending,
+            'max_pending': self.max_pending,
+        }
@@ -38,5 +38,97 @@ manager = Manager(app)
 migrate = Migrate(app, db)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def process_pending():
+    """
+    process the real time updates left in 'pending' status (for example after a restart of kirin)
+
+    the updates being processed by a running kirin are skipped
+    """
+    from kirin.core.model import RealTimeUpdate
+    from kirin.ire.ire import process_pending
+    pending = db.session.query(RealTimeUpdate.id).filter_by(status='pending', connector='ire')\
+        .order_by(RealTimeUpdate.received_at).all()
+    for rt_update_id, in pending:
+        process_pending(rt_update_id)
+
+
+@manager.option('--days-ahead', dest='days_ahead', type=int, default=app.config['RT_UPDATE_PARTITIONS_AHEAD'])
+@manager.option('--retention', dest='retention_days', type=int, default=app.config['RT_UPDATE_RETENTION_DAYS'])
+@manager.option('--detach', dest='detach', action='store_true', default=False,
+                help='detach the old partitions instead of dropping them')
+def rotate_partitions(days_ahead, retention_days, detach):
+    """
+    create the next daily partitions of real_time_update and remove the old ones
+    """
+    import datetime
+    from kirin.core.partition import rotate_partitions
+    created, removed = rotate_partitions(datetime.date.today(), days_ahead, retention_days, detach=detach)
+    print('created: {}'.format(', '.join(created) or 'none'))
+    print('{}: {}'.format('detached' if detach else 'dropped', ', '.join(removed) or 'none'))
+
+
+@manager.option('--rt-retention', dest='rt_retention_days', type=int, default=app.config['RT_UPDATE_RETENTION_DAYS'])
+@manager.option('--trip-retention', dest='trip_retention_days', type=int,
+                default=app.config['TRIP_UPDATE_RETENTION_DAYS'])
+@manager.option('--outbox-retention', dest='outbox_retention_hours', type=int,
+                default=app.config['OUTBOX_RETENTION_HOURS'])
+@manager.option('--batch-size', dest='batch_size', type=int, default=app.config['PURGE_BATCH_SIZE'])
+@manager.option('--pause', dest='pause', type=float, default=app.config['PURGE_PAUSE'])
+def purge(rt_retention_days, trip_retention_days, outbox_retention_hours, batch_size, pause):
+    """
+    delete the old real time updates, the trip updates of the past circulation dates
+    and the outbox messages already sent
+    """
+    import datetime
+    from kirin.core.purge import purge_real_time_updates, purge_trip_updates, purge_outbox
+    now = datetime.datetime.now()
+    # the sending dates of the outbox messages are in UTC
+    outbox_before = datetime.datetime.utcnow() - datetime.timedelta(hours=outbox_retention_hours)
+    for result in (purge_real_time_updates(now - datetime.timedelta(days=rt_retention_days), batch_size, pause),
+                   purge_trip_updates(now.date() - datetime.timedelta(days=trip_retention_days), batch_size, pause),
+                   purge_outbox(outbox_before, batch_size, pause)):
+        for table, rows in sorted(result.rows.items()):
+            print('{}: {} rows deleted'.format(table, rows))
+        print('{} bytes reclaimed'.format(result.bytes))
+
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=100)
+@manager.option('--pause', dest='pause', type=float, default=app.config['PURGE_PAUSE'])
+def compress_raw_data(batch_size, pause):
+    """
+    compress the raw data of the real time updates stored before the activation of RAW_DATA_COMPRESSION
+    """
+    import time
+    from kirin.core.model import RealTimeUpdate
+    total = 0
+    while True:
+        nb = RealTimeUpdate.compress_raw_data(batch_size)
+        total += nb
+        if nb < batch_size:
+            break
+        print('{} real time updates compressed'.format(total))
+        time.sleep(pause)
+    print('{} real time updates compressed'.format(total))
+
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=app.config['OUTBOX_RELAY_BATCH_SIZE'])
+@manager.option('--interval', dest='interval', type=float, default=app.config['OUTBOX_RELAY_INTERVAL'])
+def relay_outbox(batch_size, interval):
+    """
+    publish the feeds of the outbox, several relays can be run at the same time
+    """
+    import kirin
+    import logging
+    import time
+    from kirin.core.outbox import relay
+    while True:
+        try:
+            relay(kirin.rabbitmq_handler.publish_confirmed, batch_size)
+        except Exception:
+            logging.getLogger(__name__).exception('impossible to relay the outbox messages')
+        time.sleep(interval)
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,22 @@
+"""add the version of trip_update
+
+Revision ID: 1900429cf322
+Revises: 4459b3b0fef8
+Create Date: 2026-10-18 14:38:02.551930
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1900429cf322'
+down_revision = '4459b3b0fef8'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('trip_update', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('trip_update', 'version')
@@ -0,0 +1,31 @@
+"""add the train number of real_time_update
+
+the duplicates of an IRE message are looked for among the last message of the same train,
+the index is built concurrently to not lock the table in production (see 70c11395412a).
+As the other indexes of real_time_update, it is copied in the next partitions
+
+Revision ID: 3b3b2016835b
+Revises: 73191490a0af
+Create Date: 2026-10-18 17:02:48.630571
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b3b2016835b'
+down_revision = '73191490a0af'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('real_time_update', sa.Column('train_number', sa.Text(), nullable=True))
+    op.execute('COMMIT')
+    op.create_index('ix_real_time_update_train_number_received_at', 'real_time_update',
+                    ['train_number', 'received_at'], postgresql_concurrently=True)
+
+
+def downgrade():
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_real_time_update_train_number_received_at')
+    op.drop_column('real_time_update', 'train_number')
@@ -0,0 +1,69 @@
+"""partition real_time_update by day of received_at
+
+the partitions are tables inheriting real_time_update, named real_time_update_YYYYMMDD,
+they are created (and dropped) by the 'rotate_partitions' command of manage.py.
+A trigger routes the inserted rows to their partition, the row stays in real_time_update
+if the partition does not exist.
+
+The foreign key of associate_realtimeupdate_tripupdate on real_time_update is removed
+since postgres does not check a foreign key against the inheriting tables.
+
+Revision ID: 3c3d2f2b6c8e
+Revises: 70c11395412a
+Create Date: 2026-10-18 11:02:17.204518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c3d2f2b6c8e'
+down_revision = '70c11395412a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.drop_constraint('associate_realtimeupdate_tripupdate_real_time_update_id_fkey',
+                       'associate_realtimeupdate_tripupdate', type_='foreignkey')
+    op.execute("""
+CREATE OR REPLACE FUNCTION real_time_update_partition_insert() RETURNS TRIGGER AS $$
+DECLARE
+    partition TEXT := 'real_time_update_' || to_char(NEW.received_at, 'YYYYMMDD');
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_inherits JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid
+                   WHERE pg_inherits.inhparent = 'real_time_update'::regclass AND pg_class.relname = partition) THEN
+        RETURN NEW;
+    END IF;
+    EXECUTE format('INSERT INTO %I SELECT ($1).*', partition) USING NEW;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+""")
+    op.execute("""
+CREATE TRIGGER real_time_update_partition_insert BEFORE INSERT ON real_time_update
+FOR EACH ROW EXECUTE PROCEDURE real_time_update_partition_insert();
+""")
+
+
+def downgrade():
+    op.execute('DROP TRIGGER real_time_update_partition_insert ON real_time_update')
+    op.execute('DROP FUNCTION real_time_update_partition_insert()')
+    # the rows of the partitions are moved back in real_time_update
+    op.execute("""
+DO $$
+DECLARE
+    partition RECORD;
+BEGIN
+    FOR partition IN SELECT pg_class.relname FROM pg_inherits JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid
+                     WHERE pg_inherits.inhparent = 'real_time_update'::regclass LOOP
+        EXECUTE format('INSERT INTO real_time_update SELECT * FROM %I', partition.relname);
+        EXECUTE format('DROP TABLE %I', partition.relname);
+    END LOOP;
+END;
+$$;
+""")
+    op.execute('DELETE FROM associate_realtimeupdate_tripupdate WHERE real_time_update_id NOT IN '
+               '(SELECT id FROM real_time_update)')
+    op.create_foreign_key('associate_realtimeupdate_tripupdate_real_time_update_id_fkey',
+                          'associate_realtimeupdate_tripupdate', 'real_time_update',
+                          ['real_time_update_id'], ['id'])
@@ -0,0 +1,33 @@
+"""add the outbox of the GTFS-RT feeds
+
+Revision ID: 4459b3b0fef8
+Revises: a0a36a0a2a3b
+Create Date: 2026-10-18 13:41:26.095112
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4459b3b0fef8'
+down_revision = 'a0a36a0a2a3b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('outbox_message',
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('contributor', sa.Text(), nullable=True),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('outbox_message_not_sent_idx', 'outbox_message', ['id'],
+                    postgresql_where=sa.text('sent_at IS NULL'))
+
+
+def downgrade():
+    op.drop_index('outbox_message_not_sent_idx', table_name='outbox_message')
+    op.drop_table('outbox_message')
@@ -0,0 +1,34 @@
+"""add indexes on the trip_update_id foreign keys
+
+the stop_time_update and associate_realtimeupdate_tripupdate tables are queried by trip_update_id
+on each message, without index it was a sequential scan on both tables.
+
+The indexes are built concurrently to not lock the tables in production,
+this can't be done in a transaction so the alembic transaction is committed first.
+
+Revision ID: 70c11395412a
+Revises: 57117f136777
+Create Date: 2026-10-18 10:12:43.518235
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '70c11395412a'
+down_revision = '57117f136777'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('COMMIT')
+    op.create_index('ix_stop_time_update_trip_update_id', 'stop_time_update', ['trip_update_id'],
+                    postgresql_concurrently=True)
+    op.create_index('ix_associate_realtimeupdate_tripupdate_trip_update_id', 'associate_realtimeupdate_tripupdate',
+                    ['trip_update_id'], postgresql_concurrently=True)
+
+
+def downgrade():
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_associate_realtimeupdate_tripupdate_trip_update_id')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_stop_time_update_trip_update_id')
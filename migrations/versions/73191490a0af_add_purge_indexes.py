@@ -0,0 +1,38 @@
+"""add indexes on real_time_update.received_at and vehicle_journey.circulation_date
+
+the batches of the purge select the rows received (or circulating) before a date, without index
+each batch was a sequential scan from the start of the table, through the rows deleted by the previous
+batches. The GTFS-RT feed also selects the vehicle journeys by circulation date.
+
+Only the index of real_time_update itself is built here, the purge does not read the partitions
+(the next partitions get the index since they copy the indexes of real_time_update).
+
+The indexes are built concurrently to not lock the tables in production,
+this can't be done in a transaction so the alembic transaction is committed first.
+
+Revision ID: 73191490a0af
+Revises: efe0f886dff2
+Create Date: 2026-10-18 16:41:37.815902
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '73191490a0af'
+down_revision = 'efe0f886dff2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute('COMMIT')
+    op.create_index('ix_real_time_update_received_at', 'real_time_update', ['received_at'],
+                    postgresql_concurrently=True)
+    op.create_index('ix_vehicle_journey_circulation_date', 'vehicle_journey', ['circulation_date'],
+                    postgresql_concurrently=True)
+
+
+def downgrade():
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_vehicle_journey_circulation_date')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_real_time_update_received_at')
@@ -0,0 +1,32 @@
+"""add the compressed raw data of real_time_update
+
+the rows already stored are compressed by 'manage.py compress_raw_data'
+
+Revision ID: 7503724ddbc0
+Revises: 3c3d2f2b6c8e
+Create Date: 2026-10-18 11:47:09.330154
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7503724ddbc0'
+down_revision = '3c3d2f2b6c8e'
+
+from alembic import op
+import sqlalchemy as sa
+import zlib
+
+
+def upgrade():
+    op.add_column('real_time_update', sa.Column('raw_data_compressed', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    # the compressed raw data are stored back as text before dropping the column
+    connection = op.get_bind()
+    rows = connection.execute('SELECT id, raw_data_compressed FROM real_time_update '
+                              'WHERE raw_data_compressed IS NOT NULL')
+    for id, raw_data_compressed in rows.fetchall():
+        connection.execute(sa.text('UPDATE real_time_update SET raw_data = :raw_data WHERE id = :id'),
+                           raw_data=zlib.decompress(raw_data_compressed).decode('utf-8'), id=id)
+    op.drop_column('real_time_update', 'raw_data_compressed')
@@ -0,0 +1,31 @@
+"""add the content hash of real_time_update to find the duplicated messages
+
+the index is not inherited, so it is also created on the existing partitions
+
+Revision ID: a0a36a0a2a3b
+Revises: 7503724ddbc0
+Create Date: 2026-10-18 12:24:51.870317
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a0a36a0a2a3b'
+down_revision = '7503724ddbc0'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('real_time_update', sa.Column('content_hash', sa.Text(), nullable=True))
+    partitions = op.get_bind().execute("SELECT pg_class.relname FROM pg_inherits "
+                                       "JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid "
+                                       "WHERE pg_inherits.inhparent = 'real_time_update'::regclass").fetchall()
+    op.execute('COMMIT')
+    for table in ['real_time_update'] + [p[0] for p in partitions]:
+        op.create_index('ix_{}_content_hash'.format(table), table, ['content_hash'], postgresql_concurrently=True)
+
+
+def downgrade():
+    # the indexes are dropped with the column
+    op.drop_column('real_time_update', 'content_hash')
@@ -0,0 +1,25 @@
+"""add the processing start of real_time_update
+
+a pending real time update is claimed by recording when its processing started,
+the claim is committed so no lock is held while navitia is called
+
+Revision ID: efe0f886dff2
+Revises: 1900429cf322
+Create Date: 2026-10-18 16:05:12.204417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'efe0f886dff2'
+down_revision = '1900429cf322'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('real_time_update', sa.Column('processing_started_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('real_time_update', 'processing_started_at')
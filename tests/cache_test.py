@@ -0,0 +1,137 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+from kirin.cache import LruTtlCache, SingleFlight
+import gevent
+import pytest
+
+
+def test_cache_get_set():
+    cache = LruTtlCache(max_size=10, ttl=60)
+    assert cache.get('bob') is None
+    cache.set('bob', 42)
+    assert cache.get('bob') == 42
+    assert cache.get('bobette', 'default') == 'default'
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+
+def test_cache_lru_eviction():
+    cache = LruTtlCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # 'a' is read, so 'b' becomes the least recently used
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_cache_ttl(monkeypatch):
+    now = [1000]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    cache = LruTtlCache(max_size=10, ttl=60)
+    cache.set('bob', 42)
+
+    now[0] += 59
+    assert cache.get('bob') == 42
+
+    now[0] += 2
+    assert cache.get('bob') is None
+    assert len(cache) == 0
+
+
+def test_single_flight():
+    """
+    3 concurrent calls with the same key, only one must be done
+    """
+    calls = []
+
+    def slow_call(value):
+        calls.append(value)
+        gevent.sleep(0.01)
+        return {'value': value}
+
+    single_flight = SingleFlight()
+    greenlets = [gevent.spawn(single_flight.call, 'bob', slow_call, 42) for _ in range(3)]
+    gevent.joinall(greenlets)
+
+    assert calls == [42]
+    results = [g.value for g in greenlets]
+    assert results == [{'value': 42}] * 3
+    # the result is shared
+    assert results[0] is results[1] is results[2]
+    assert single_flight.collapsed == 2
+
+    # once the call is finished, a new call is done
+    assert single_flight.call('bob', slow_call, 43) == {'value': 43}
+    assert calls == [42, 43]
+
+
+def test_single_flight_exception():
+    """
+    the exception of the call is raised in all the waiting greenlets
+    """
+    def failing_call():
+        gevent.sleep(0.01)
+        raise ValueError('bob')
+
+    single_flight = SingleFlight()
+    greenlets = [gevent.spawn(single_flight.call, 'bob', failing_call) for _ in range(2)]
+    gevent.joinall(greenlets)
+
+    for g in greenlets:
+        assert isinstance(g.exception, ValueError)
+
+    with pytest.raises(ValueError):
+        single_flight.call('bob', failing_call)
+
+
+def test_single_flight_interrupted():
+    """
+    the greenlets waiting for a call that has been interrupted by a timeout get an error
+    """
+    def slow_call():
+        gevent.sleep(1)
+
+    def call_with_timeout():
+        with gevent.Timeout(0.01, False):
+            single_flight.call('bob', slow_call)
+
+    single_flight = SingleFlight()
+    leader = gevent.spawn(call_with_timeout)
+    gevent.sleep(0)
+    follower = gevent.spawn(single_flight.call, 'bob', slow_call)
+    gevent.joinall([leader, follower], timeout=0.5)
+
+    assert leader.ready() and follower.ready()
+    assert isinstance(follower.exception, RuntimeError)
+    assert single_flight.info()['in_flight'] == 0
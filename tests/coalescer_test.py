@@ -0,0 +1,157 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import datetime
+import gevent
+from kirin import gtfs_realtime_pb2
+from kirin.core.coalescer import Coalescer
+from kirin.core.model import TripUpdate, VehicleJourney, StopTimeUpdate
+
+
+def make_trip_update(trip_id, departure):
+    trip_update = TripUpdate()
+    trip_update.vj = VehicleJourney({'id': trip_id}, datetime.date(2015, 9, 21))
+    trip_update.vj_id = trip_id  # the trip updates of a trip are coalesced
+    trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, departure, None))
+    return trip_update
+
+
+class PublishMock(object):
+    def __init__(self):
+        self.feeds = []
+
+    def __call__(self, item, contributor):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(item)
+        self.feeds.append((contributor, feed))
+
+
+def test_coalesce_updates_of_the_same_vj():
+    publish = PublishMock()
+    coalescer = Coalescer(publish)
+    trip_update = make_trip_update('vj:1', datetime.datetime(2015, 9, 21, 15, 0))
+    coalescer.add('realtime.ire', [trip_update], window=0.05, max_hold=1)
+    trip_update = make_trip_update('vj:1', datetime.datetime(2015, 9, 21, 15, 10))
+    coalescer.add('realtime.ire', [trip_update], window=0.05, max_hold=1)
+    assert publish.feeds == []
+    assert coalescer.info()['pending'] == 1
+
+    gevent.sleep(0.1)
+
+    assert len(publish.feeds) == 1
+    contributor, feed = publish.feeds[0]
+    assert contributor == 'realtime.ire'
+    assert len(feed.entity) == 1
+    # only the last state is published
+    assert feed.entity[0].trip_update.stop_time_update[0].departure.time == 1442848200
+    assert coalescer.info() == {'pending': 0, 'published': 1, 'coalesced': 1}
+
+
+def test_coalesce_several_vjs_in_one_feed():
+    publish = PublishMock()
+    coalescer = Coalescer(publish)
+    coalescer.add('realtime.ire', [make_trip_update('vj:1', datetime.datetime(2015, 9, 21, 15, 0)),
+                                   make_trip_update('vj:2', datetime.datetime(2015, 9, 21, 16, 0))],
+                  window=0.05, max_hold=1)
+
+    gevent.sleep(0.1)
+
+    assert len(publish.feeds) == 1
+    assert len(publish.feeds[0][1].entity) == 2
+
+
+def test_coalesce_max_hold():
+    """
+    a vj updated continuously is published after max_hold seconds
+    """
+    publish = PublishMock()
+    coalescer = Coalescer(publish)
+    for i in range(6):
+        coalescer.add('realtime.ire', [make_trip_update('vj:1', datetime.datetime(2015, 9, 21, 15, i))],
+                      window=0.05, max_hold=0.1)
+        gevent.sleep(0.03)
+
+    assert len(publish.feeds) == 1
+
+
+def test_coalesce_flush_all():
+    publish = PublishMock()
+    coalescer = Coalescer(publish)
+    coalescer.add('realtime.ire', [make_trip_update('vj:1', datetime.datetime(2015, 9, 21, 15, 0))],
+                  window=10, max_hold=10)
+    coalescer.flush_all()
+
+    assert len(publish.feeds) == 1
+    assert coalescer.info()['pending'] == 0
+
+
+def test_coalesce_publish_retry():
+    """
+    the trip updates are not lost when the publication fails, they are published again later
+    """
+    publish = PublishMock()
+    failures = []
+
+    def failing_publish(item, contributor):
+        if not failures:
+            failures.append(contributor)
+            raise IOError('rabbitmq is not available')
+        publish(item, contributor)
+
+    coalescer = Coalescer(failing_publish, retry_delay=0.05)
+    coalescer.add('realtime.ire', [make_trip_update('vj:1', datetime.datetime(2015, 9, 21, 15, 0))],
+                  window=0.01, max_hold=1)
+    gevent.sleep(0.03)
+    assert failures == ['realtime.ire']
+    assert publish.feeds == []
+    assert coalescer.info()['pending'] == 1
+
+    gevent.sleep(0.1)
+    assert len(publish.feeds) == 1
+    assert coalescer.info()['pending'] == 0
+
+
+def test_coalesce_retry_replaced_by_newer_state():
+    """
+    a newer state of the vj received while the publication was failing is the one published
+    """
+    publish = PublishMock()
+    coalescer = Coalescer(None, retry_delay=0.05)
+
+    def failing_publish(item, contributor):
+        coalescer._publish = publish
+        coalescer.add('realtime.ire', [make_trip_update('vj:1', datetime.datetime(2015, 9, 21, 15, 10))],
+                      window=0.01, max_hold=1)
+        raise IOError('rabbitmq is not available')
+
+    coalescer._publish = failing_publish
+    coalescer.add('realtime.ire', [make_trip_update('vj:1', datetime.datetime(2015, 9, 21, 15, 0))],
+                  window=0.01, max_hold=1)
+    gevent.sleep(0.1)
+    assert len(publish.feeds) == 1
+    assert publish.feeds[0][1].entity[0].trip_update.stop_time_update[0].departure.time == 1442848200
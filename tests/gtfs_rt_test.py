@@ -94,3 +94,19 @@ def make_96231_20150728_0():
     stop_time.departure.time = unix_time(2015, 07, 28, 18, 39, 0)# ?
 
     return message
+
+
+def test_assemble_feed():
+    """
+    the feed assembled from the serialized entities is the same as the one serialized by protobuf
+    """
+    from kirin.core.populate_pb import assemble_feed
+    message = make_96231_20150728_0()
+    message.header.gtfs_realtime_version = '1'
+    other_entity = message.entity.add()
+    other_entity.CopyFrom(message.entity[0])
+    other_entity.id = "96231_2015-07-29_0"
+
+    header = gtfs_realtime_pb2.FeedMessage()
+    header.header.CopyFrom(message.header)
+    assert assemble_feed(header, [e.SerializeToString() for e in message.entity]) == message.SerializeToString()
@@ -26,6 +26,7 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 import os
+import kirin
 from kirin import app, db
 import pytest
 import flask_migrate
@@ -62,10 +63,23 @@ def clean_db():
         db.session.commit()
 
 
+@pytest.fixture(scope='function', autouse=True)
+def clear_navitia_cache():
+    """
+    the navitia responses are cached, we don't want a test to depend on the previous ones
+    """
+    kirin.navitia_vj_cache.clear()
+    kirin.navitia_vj_miss_cache.clear()
+    kirin.vj_catalogue.clear()
+    kirin.ire_deduplicator.clear()
+    kirin.gtfs_rt_feed.clear()
+    kirin.gtfs_rt_entity_cache.clear()
+
+
 @pytest.fixture(scope='function')
 def mock_navitia_fixture(monkeypatch):
     from .. import mock_navitia
     """
     Mock all calls to navitia for this fixture
     """
-    monkeypatch.setattr('navitia_wrapper._NavitiaWrapper.query', mock_navitia.mock_navitia_query)
\ No newline at end of file
+    monkeypatch.setattr('kirin.navitia_client.NavitiaClient.query', mock_navitia.mock_navitia_query)
\ No newline at end of file
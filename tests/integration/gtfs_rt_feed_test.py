@@ -0,0 +1,223 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import gzip
+import pytest
+from StringIO import StringIO
+import kirin
+from kirin import app, db, gtfs_realtime_pb2
+from kirin.core.model import TripUpdate
+from tests import mock_navitia
+from tests.check_utils import api_post, get_ire_data
+
+
+@pytest.fixture(scope='function', autouse=True)
+def navitia(monkeypatch):
+    monkeypatch.setattr('kirin.navitia_client.NavitiaClient.query', mock_navitia.mock_navitia_query)
+
+
+@pytest.fixture(scope='function', autouse=True)
+def all_days_active(monkeypatch):
+    """
+    the trains of the fixtures circulated in 2015
+    """
+    monkeypatch.setattr(kirin.gtfs_rt_feed, 'days_before', 365 * 100)
+
+
+@pytest.fixture(scope='function', autouse=True)
+def mock_rabbitmq(monkeypatch):
+    from mock import MagicMock
+    monkeypatch.setattr('kombu.messaging.Producer.publish', MagicMock())
+
+
+def get_feed():
+    resp = app.test_client().get('/gtfs_rt')
+    assert resp.status_code == 200
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(resp.data)
+    return feed
+
+
+def refresh_feed():
+    """
+    the feed is refreshed by a background greenlet, the tests do not wait for it
+    """
+    with app.app_context():
+        kirin.gtfs_rt_feed.refresh()
+
+
+def test_gtfs_rt_empty():
+    feed = get_feed()
+    assert feed.header.incrementality == gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+    assert len(feed.entity) == 0
+
+
+def test_gtfs_rt_loaded_from_db():
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+
+    feed = get_feed()
+    assert len(feed.entity) == 2
+    trips = {e.trip_update.trip.schedule_relationship for e in feed.entity}
+    assert trips == {gtfs_realtime_pb2.TripDescriptor.SCHEDULED, gtfs_realtime_pb2.TripDescriptor.CANCELED}
+
+
+def test_gtfs_rt_updated_by_handle():
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    assert len(get_feed().entity) == 1
+    version = kirin.gtfs_rt_feed.version
+
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    # the requests do not check the database, the feed changes only once refreshed
+    assert len(get_feed().entity) == 1
+    assert kirin.gtfs_rt_feed.version == version
+
+    refresh_feed()
+    assert len(get_feed().entity) == 2
+    assert kirin.gtfs_rt_feed.version > version
+
+
+def test_gtfs_rt_updated_by_another_kirin():
+    """
+    the feed follows the database, whatever the kirin that modified the trip updates
+    """
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    feed = get_feed()
+    assert len(feed.entity) == 1
+    assert feed.entity[0].trip_update.trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.SCHEDULED
+
+    with app.app_context():
+        db.session.execute("UPDATE trip_update SET status = 'delete', version = version + 1, "
+                           "updated_at = now() AT TIME ZONE 'UTC'")
+        db.session.commit()
+    refresh_feed()
+    feed = get_feed()
+    assert len(feed.entity) == 1
+    assert feed.entity[0].trip_update.trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.CANCELED
+
+    with app.app_context():
+        db.session.execute('TRUNCATE trip_update CASCADE')
+        db.session.commit()
+    refresh_feed()
+    assert len(get_feed().entity) == 0
+
+
+def test_gtfs_rt_inactive_trips(monkeypatch):
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    assert len(get_feed().entity) == 1
+
+    monkeypatch.setattr(kirin.gtfs_rt_feed, 'days_before', 0)
+    refresh_feed()
+    assert len(get_feed().entity) == 0
+
+
+def test_gtfs_rt_not_modified():
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    resp = app.test_client().get('/gtfs_rt')
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+
+    resp = app.test_client().get('/gtfs_rt', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == ''
+    assert resp.headers['ETag'] == etag
+
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    refresh_feed()
+    resp = app.test_client().get('/gtfs_rt', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(resp.data)
+    assert len(feed.entity) == 2
+
+
+def test_gtfs_rt_gzip():
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    resp = app.test_client().get('/gtfs_rt', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(gzip.GzipFile(fileobj=StringIO(resp.data)).read())
+    assert len(feed.entity) == 1
+    assert feed == get_feed()
+
+    # the gzipped and the plain feeds are two representations with their own etag
+    assert resp.headers['ETag'] != app.test_client().get('/gtfs_rt').headers['ETag']
+
+
+def test_gtfs_rt_built_once_per_version():
+    """
+    the feed is serialized and compressed only when the trip updates change
+    """
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    with app.app_context():
+        first = kirin.gtfs_rt_feed.feed(gzipped=True)
+        assert kirin.gtfs_rt_feed.feed(gzipped=True) is first
+
+    with app.app_context():
+        kirin.gtfs_rt_feed.refresh()
+        assert kirin.gtfs_rt_feed.feed(gzipped=True) is first
+
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    with app.app_context():
+        kirin.gtfs_rt_feed.refresh()
+        assert kirin.gtfs_rt_feed.feed(gzipped=True) is not first
+
+
+def test_gtfs_rt_etag_from_content():
+    """
+    the etag only depends on the feed, so two kirins serving the same feed give the same etag
+    """
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    etag = app.test_client().get('/gtfs_rt').headers['ETag']
+
+    # another kirin, or this one after a restart
+    kirin.gtfs_rt_feed.clear()
+    resp = app.test_client().get('/gtfs_rt', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+
+def test_gtfs_rt_no_db_query_on_request(monkeypatch):
+    """
+    once loaded, the feed and the conditional requests are answered without querying the database
+    """
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    etag = app.test_client().get('/gtfs_rt').headers['ETag']
+
+    def no_query(*args, **kwargs):
+        raise AssertionError('the database must not be queried')
+    monkeypatch.setattr(TripUpdate, 'state_by_circulation_date', staticmethod(no_query))
+    monkeypatch.setattr(TripUpdate, 'find_by_circulation_date', staticmethod(no_query))
+
+    assert len(get_feed().entity) == 1
+    resp = app.test_client().get('/gtfs_rt', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.headers['ETag'] == etag
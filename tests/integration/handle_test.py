@@ -31,6 +31,7 @@ import pytest
 from kirin.core.handler import handle
 from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate
 import datetime
+import sqlalchemy
 from kirin import app, db
 from tests.check_utils import _dt
 
@@ -250,3 +251,151 @@ def test_handle_update_vj(setup_database, navitia_vj):
         assert 'sa:3' in db_stu_map
         assert db_stu_map['sa:3'].arrival == _dt("10:05")
         assert db_stu_map['sa:3'].departure ==  None
+
+
+def test_handle_update_vj_with_upsert(setup_database, navitia_vj, monkeypatch):
+    """
+    same as test_handle_update_vj, but the rows are written with upserts
+    """
+    monkeypatch.setitem(app.config, 'DB_UPSERT', True)
+    with app.app_context():
+        trip_update = TripUpdate()
+        vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, 8))
+        trip_update.status = 'update'
+        trip_update.vj = vj
+        st = StopTimeUpdate({'id': 'sa:2'}, departure=_dt("9:20"), arrival=_dt("9:15"))
+        st.arrival_status = st.departure_status = 'update'
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire')
+        real_time_update.id = '30866ce8-0638-4fa1-8556-1ddfa22d09d3'
+        trip_update.stop_time_updates.append(st)
+        res = handle(real_time_update, [trip_update])
+
+        assert len(res.trip_updates) == 1
+        assert res.trip_updates[0].vj_id == '70866ce8-0638-4fa1-8556-1ddfa22d09d3'
+
+        db_trip_updates = TripUpdate.query.join(VehicleJourney).order_by('circulation_date').all()
+        assert len(db_trip_updates) == 2
+        assert len(VehicleJourney.query.all()) == 2
+        assert len(RealTimeUpdate.query.all()) == 3
+        assert len(StopTimeUpdate.query.all()) == 6
+
+        assert db_trip_updates[1].status == 'update'
+        assert len(db_trip_updates[1].real_time_updates) == 2
+        db_stu_map = {stu.stop_id: stu for stu in db_trip_updates[1].stop_time_updates}
+        assert db_stu_map['sa:1'].departure == _dt("8:15")
+        assert db_stu_map['sa:2'].arrival == _dt("9:15")
+        assert db_stu_map['sa:2'].departure == _dt("9:20")
+        assert db_stu_map['sa:2'].updated_at is not None
+        assert db_stu_map['sa:3'].arrival == _dt("10:05")
+        # the stops that have not changed are not written again
+        assert db_stu_map['sa:1'].updated_at is None
+
+        # the trip update of the 2015/09/07 has not been changed
+        db_stu_map = {stu.stop_id: stu for stu in db_trip_updates[0].stop_time_updates}
+        assert db_stu_map['sa:2'].departure == _dt("9:40", day=7)
+
+
+def test_upsert_one_statement_by_table(setup_database, navitia_vj, monkeypatch):
+    """
+    the trip updates and their stops are written with one statement by table, whatever their number
+    """
+    monkeypatch.setitem(app.config, 'DB_UPSERT', True)
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, executemany))
+
+    with app.app_context():
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            trip_updates = []
+            for day in (7, 8):
+                trip_update = TripUpdate()
+                trip_update.status = 'update'
+                trip_update.vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, day))
+                trip_updates.append(trip_update)
+            handle(RealTimeUpdate(raw_data=None, connector='ire'), trip_updates)
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+        assert not any(executemany for _, executemany in statements)
+        for table in ('vehicle_journey', 'trip_update', 'stop_time_update', 'associate_realtimeupdate_tripupdate'):
+            assert len([s for s, _ in statements if 'INSERT INTO {} '.format(table) in s]) == 1
+
+
+def test_upsert_keeps_the_other_objects(setup_database, navitia_vj, monkeypatch):
+    """
+    only the objects written by the upserts are detached from the session
+    """
+    monkeypatch.setitem(app.config, 'DB_UPSERT', True)
+    with app.app_context():
+        other_trip_update = TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 7))
+        other_trip_update.status = 'delete'
+
+        trip_update = TripUpdate()
+        trip_update.status = 'update'
+        trip_update.vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, 8))
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire')
+        handle(real_time_update, [trip_update])
+
+        assert other_trip_update in db.session
+        db.session.commit()
+        db.session.expire_all()
+        assert TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 7)).status == 'delete'
+
+
+def test_upsert_concurrent_new_vj(setup_database, navitia_vj, monkeypatch):
+    """
+    another kirin has created the trip update after we looked for it in the db:
+    the existing rows are updated instead of failing on the unique constraint of the vj
+    """
+    from kirin.core.handler import persist_with_upsert, merge
+    with app.app_context():
+        trip_update = TripUpdate()
+        trip_update.vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, 8))
+        trip_update.status = 'delete'
+        real_time_update = RealTimeUpdate(raw_data='<bob/>', connector='ire')
+        # we simulate that the trip update was not found in the db
+        current_trip_update = merge(trip_update, None)
+        current_trip_update.real_time_updates.append(real_time_update)
+
+        persist_with_upsert(real_time_update, [current_trip_update])
+
+        assert current_trip_update.vj_id == '70866ce8-0638-4fa1-8556-1ddfa22d09d3'
+        assert len(VehicleJourney.query.all()) == 2
+        db_trip_update = TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 8))
+        assert db_trip_update.status == 'delete'
+        # the version is incremented from the one of the existing row
+        assert db_trip_update.version == 1
+        assert current_trip_update.version == 1
+        assert len(db_trip_update.stop_time_updates) == 0
+        assert len(db_trip_update.real_time_updates) == 2
+
+
+def test_handle_new_trip_long_vj():
+    """
+    a vj with 50 stops, only 2 of them are updated, the others must be filled in the vj order
+    """
+    navitia_vj = {'id': 'vehicle_journey:1', 'stop_times': [
+        {'arrival_time': datetime.time(8, i), 'departure_time': datetime.time(8, i),
+         'stop_point': {'id': 'sa:{}'.format(i)}}
+        for i in range(50)
+        ]}
+    with app.app_context():
+        trip_update = TripUpdate()
+        trip_update.vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, 8))
+        trip_update.status = 'update'
+        for i in (30, 10):
+            delayed = _dt("9:{}".format(i))
+            st = StopTimeUpdate({'id': 'sa:{}'.format(i)}, departure=delayed, arrival=delayed)
+            trip_update.stop_time_updates.append(st)
+        res = handle(RealTimeUpdate(raw_data=None, connector='ire'), [trip_update])
+
+        trip_update = res.trip_updates[0]
+        assert [st.stop_id for st in trip_update.stop_time_updates] == ['sa:{}'.format(i) for i in range(50)]
+        for i, st in enumerate(trip_update.stop_time_updates):
+            if i in (10, 30):
+                assert st.departure == _dt("9:{}".format(i))
+            else:
+                assert st.departure == datetime.datetime(2015, 9, 8, 8, i)
+        assert len(StopTimeUpdate.query.all()) == 50
@@ -27,16 +27,20 @@
 # www.navitia.io
 import pytest
 
+import datetime
+import kirin
 from kirin import db, app
+from kirin.exceptions import ObjectNotFound
 from kirin.core import model
 from kirin.ire.model_maker import KirinModelBuilder
-import navitia_wrapper
+from kirin.navitia_client import NavitiaClient
+from tests import mock_navitia
 from tests.check_utils import get_ire_data
 
 
 def dumb_nav_wrapper():
-    """return a dumb navitia wrapper (all the param are useless since the 'query' call has been mocked"""
-    return navitia_wrapper.Navitia(url='').instance('')
+    """return a dumb navitia client (all the param are useless since the 'query' call has been mocked"""
+    return NavitiaClient(url='', instance='')
 
 
 def test_train_delayed(mock_navitia_fixture):
@@ -86,3 +90,83 @@ def test_train_trip_removal(mock_navitia_fixture):
         assert trip_up.status == 'delete'
         # full trip removal : no stop_time to precise
         assert len(trip_up.stop_time_updates) == 0
+
+
+def test_navitia_vj_cache(monkeypatch):
+    """
+    the same train is received twice, navitia must be called only once
+    """
+    navitia_calls = []
+
+    def counting_query(self, query, q=None):
+        navitia_calls.append(query)
+        return mock_navitia.mock_navitia_query(self, query, q)
+    monkeypatch.setattr('kirin.navitia_client.NavitiaClient.query', counting_query)
+
+    input_train_delayed = get_ire_data('train_96231_delayed.xml')
+
+    with app.app_context():
+        for _ in range(2):
+            rt_update = model.RealTimeUpdate(input_train_delayed, connector='ire')
+            trip_updates = KirinModelBuilder(dumb_nav_wrapper()).build(rt_update)
+            assert len(trip_updates) == 1
+            assert trip_updates[0].vj.navitia_id == 'vehicle_journey:OCETrainTER-87212027-85000109-3:11859'
+
+    assert len(navitia_calls) == 1
+    assert kirin.navitia_vj_cache.hits == 1
+    assert kirin.navitia_vj_cache.misses == 1
+
+
+def test_navitia_vj_miss_cache(monkeypatch):
+    """
+    a train unknown by navitia is received twice, navitia must be called only once
+    """
+    navitia_calls = []
+
+    def empty_vehicle_journeys(self, q=None):
+        navitia_calls.append(q)
+        return []
+    monkeypatch.setattr('kirin.navitia_client.NavitiaClient.vehicle_journeys', empty_vehicle_journeys)
+
+    input_unknown_train = get_ire_data('train_96231_delayed.xml').replace('<NumeroTrain>096231',
+                                                                          '<NumeroTrain>099999')
+
+    with app.app_context():
+        for _ in range(2):
+            rt_update = model.RealTimeUpdate(input_unknown_train, connector='ire')
+            with pytest.raises(ObjectNotFound):
+                KirinModelBuilder(dumb_nav_wrapper()).build(rt_update)
+
+    assert len(navitia_calls) == 1
+    assert navitia_calls[0]['headsign'] == '99999'
+    assert kirin.navitia_vj_miss_cache.hits == 1
+
+
+def test_vj_catalogue(monkeypatch):
+    """
+    the train is in the catalogue, navitia must not be called
+    """
+    def no_call(self, query, q=None):
+        assert False, 'navitia must not be called'
+    monkeypatch.setattr('kirin.navitia_client.NavitiaClient.query', no_call)
+
+    class CatalogueNavitia(object):
+        def iter_vehicle_journeys(self, q=None, count=1000):
+            if q['since'] == '20150921T000000':
+                res, _ = mock_navitia.mock_navitia_query(self, 'vehicle_journeys/', q={
+                    'depth': '2', 'since': '20150921T153000', 'headsign': '96231', 'show_codes': 'true',
+                    'until': '20150921T193900'})
+                for vj in res['vehicle_journeys']:
+                    yield vj
+
+    kirin.vj_catalogue.load(CatalogueNavitia(), [datetime.date(2015, 9, 21)])
+
+    input_train_delayed = get_ire_data('train_96231_delayed.xml')
+    with app.app_context():
+        rt_update = model.RealTimeUpdate(input_train_delayed, connector='ire')
+        trip_updates = KirinModelBuilder(dumb_nav_wrapper()).build(rt_update)
+
+        assert len(trip_updates) == 1
+        trip_up = trip_updates[0]
+        assert trip_up.vj.navitia_id == 'vehicle_journey:OCETrainTER-87212027-85000109-3:11859'
+        assert len(trip_up.stop_time_updates) == 5
@@ -41,7 +41,7 @@ def navitia(monkeypatch):
     """
     Mock all calls to navitia for this fixture
     """
-    monkeypatch.setattr('navitia_wrapper._NavitiaWrapper.query', mock_navitia.mock_navitia_query)
+    monkeypatch.setattr('kirin.navitia_client.NavitiaClient.query', mock_navitia.mock_navitia_query)
 
 
 @pytest.fixture(scope='function')
@@ -309,3 +309,416 @@ def test_ire_two_trip_removal_post_twice(mock_rabbitmq):
     check_db_ire_JOHN_trip_removal()
     # the rabbit mq has to have been called twice
     assert mock_rabbitmq.call_count == 2
+
+
+def test_ire_async_post(mock_rabbitmq, monkeypatch):
+    """
+    in async mode, the post only saves the raw data, the processing is done by the background worker
+    """
+    import kirin
+    monkeypatch.setitem(app.config, 'IRE_ASYNC_PROCESSING', True)
+    ire_96231 = get_ire_data('train_96231_delayed.xml')
+    res, status = api_post('/ire', check=False, data=ire_96231)
+    assert status == 202
+    assert 'id' in res
+
+    kirin.worker.join()
+
+    with app.app_context():
+        rt_update = RealTimeUpdate.query.get(res['id'])
+        assert rt_update.status == 'OK'
+        assert len(TripUpdate.query.all()) == 1
+    check_db_ire_96231_delayed()
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_ire_async_post_invalid_xml(mock_rabbitmq, monkeypatch):
+    """
+    in async mode, the errors are stored in the RealTimeUpdate
+    """
+    import kirin
+    monkeypatch.setitem(app.config, 'IRE_ASYNC_PROCESSING', True)
+    res, status = api_post('/ire', check=False, data='<bob></bob>')
+    assert status == 202
+
+    kirin.worker.join()
+
+    with app.app_context():
+        rt_update = RealTimeUpdate.query.get(res['id'])
+        assert rt_update.status == 'KO'
+        assert rt_update.error
+        assert len(TripUpdate.query.all()) == 0
+    assert mock_rabbitmq.call_count == 0
+
+
+def test_ire_single_transaction_post(mock_rabbitmq, monkeypatch):
+    """
+    the raw data is saved with the trip updates
+    """
+    monkeypatch.setitem(app.config, 'IRE_SINGLE_TRANSACTION', True)
+    ire_96231 = get_ire_data('train_96231_delayed.xml')
+    res = api_post('/ire', data=ire_96231)
+    assert res == 'OK'
+
+    with app.app_context():
+        rt_updates = RealTimeUpdate.query.all()
+        assert len(rt_updates) == 1
+        assert rt_updates[0].status == 'OK'
+        assert rt_updates[0].trip_updates
+    check_db_ire_96231_delayed()
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_ire_single_transaction_invalid_post(mock_rabbitmq, monkeypatch):
+    """
+    the processing fails, only the raw data is saved with the error
+    """
+    monkeypatch.setitem(app.config, 'IRE_SINGLE_TRANSACTION', True)
+    res, status = api_post('/ire', check=False, data='<bob></bob>')
+    assert status == 400
+
+    with app.app_context():
+        rt_updates = RealTimeUpdate.query.all()
+        assert len(rt_updates) == 1
+        assert rt_updates[0].status == 'KO'
+        assert rt_updates[0].error
+        assert rt_updates[0].raw_data == '<bob></bob>'
+        assert len(TripUpdate.query.all()) == 0
+    assert mock_rabbitmq.call_count == 0
+
+
+def test_ire_single_transaction_publish_error(mock_rabbitmq, monkeypatch):
+    """
+    the trip updates are saved but the publication fails, no KO real time update is added
+    """
+    def publish_error(feed, rt_update):
+        raise IOError('rabbitmq is not available')
+    monkeypatch.setitem(app.config, 'IRE_SINGLE_TRANSACTION', True)
+    monkeypatch.setattr('kirin.core.handler.publish', publish_error)
+    res, status = api_post('/ire', check=False, data=get_ire_data('train_96231_delayed.xml'))
+    assert status == 500
+
+    with app.app_context():
+        rt_updates = RealTimeUpdate.query.all()
+        assert len(rt_updates) == 1
+        assert rt_updates[0].status == 'OK'
+    check_db_ire_96231_delayed()
+
+
+def test_ire_duplicate_post(mock_rabbitmq, monkeypatch):
+    """
+    the same message is sent again with another creation date, it is not processed nor published twice
+    """
+    import kirin
+    monkeypatch.setitem(app.config, 'IRE_DEDUP', True)
+    ire_96231 = get_ire_data('train_96231_delayed.xml')
+    assert api_post('/ire', data=ire_96231) == 'OK'
+    resent = ire_96231.replace('<DateHeureCreationMessage>21/09/2015 17:51:00',
+                               '<DateHeureCreationMessage>21/09/2015 17:53:00')
+    assert api_post('/ire', data=resent) == 'OK'
+
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 1
+    check_db_ire_96231_delayed()
+    assert mock_rabbitmq.call_count == 1
+    assert kirin.ire_deduplicator.hits == 1
+
+    # the duplicate is also found in the database (for example if it has been received by another kirin)
+    kirin.ire_deduplicator.clear()
+    assert api_post('/ire', data=resent) == 'OK'
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 1
+    assert mock_rabbitmq.call_count == 1
+    assert kirin.ire_deduplicator.hits == 1
+
+
+def test_ire_reverted_post_not_duplicate(mock_rabbitmq, monkeypatch):
+    """
+    the train is delayed, removed, then delayed again: the last message is not a duplicate of the first one
+    since it changes the state of the train back
+    """
+    import kirin
+    monkeypatch.setitem(app.config, 'IRE_DEDUP', True)
+    ire_96231_delayed = get_ire_data('train_96231_delayed.xml')
+    assert api_post('/ire', data=ire_96231_delayed) == 'OK'
+    assert api_post('/ire', data=get_ire_data('train_96231_trip_removal.xml')) == 'OK'
+    assert api_post('/ire', data=ire_96231_delayed) == 'OK'
+
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 3
+        assert TripUpdate.query.one().status != 'delete'
+    assert mock_rabbitmq.call_count == 3
+    assert kirin.ire_deduplicator.hits == 0
+
+    # but the same message sent again is a duplicate
+    assert api_post('/ire', data=ire_96231_delayed) == 'OK'
+    assert mock_rabbitmq.call_count == 3
+    assert kirin.ire_deduplicator.hits == 1
+
+
+def test_ire_duplicate_of_error_post(mock_rabbitmq, monkeypatch):
+    """
+    a message in error is processed again if it is sent again
+    """
+    import kirin
+    monkeypatch.setitem(app.config, 'IRE_DEDUP', True)
+    for _ in range(2):
+        res, status = api_post('/ire', check=False, data='<bob></bob>')
+        assert status == 400
+
+    with app.app_context():
+        rt_updates = RealTimeUpdate.query.all()
+        assert len(rt_updates) == 2
+        assert all(rt_update.content_hash is None for rt_update in rt_updates)
+    assert kirin.ire_deduplicator.hits == 0
+
+
+def test_ire_async_duplicate_post(mock_rabbitmq, monkeypatch):
+    import kirin
+    monkeypatch.setitem(app.config, 'IRE_DEDUP', True)
+    monkeypatch.setitem(app.config, 'IRE_ASYNC_PROCESSING', True)
+    ire_96231 = get_ire_data('train_96231_delayed.xml')
+    res, status = api_post('/ire', check=False, data=ire_96231)
+    assert status == 202
+    duplicate_res, status = api_post('/ire', check=False, data=ire_96231)
+    assert status == 202
+    assert duplicate_res['id'] == res['id']
+
+    kirin.worker.join()
+
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 1
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_ire_async_failed_post_not_duplicate(mock_rabbitmq, monkeypatch):
+    """
+    a message ended in error is processed again if it is sent again
+    """
+    import kirin
+    monkeypatch.setitem(app.config, 'IRE_DEDUP', True)
+    monkeypatch.setitem(app.config, 'IRE_ASYNC_PROCESSING', True)
+    res, status = api_post('/ire', check=False, data='<bob></bob>')
+    assert status == 202
+    kirin.worker.join()
+
+    resent_res, status = api_post('/ire', check=False, data='<bob></bob>')
+    assert status == 202
+    assert resent_res['id'] != res['id']
+    kirin.worker.join()
+
+    with app.app_context():
+        assert [rt_update.status for rt_update in RealTimeUpdate.query.all()] == ['KO', 'KO']
+    assert kirin.ire_deduplicator.hits == 0
+
+
+def test_ire_coalesced_post(mock_rabbitmq, monkeypatch):
+    """
+    the same train is updated twice in a short time, only its last state is published
+    """
+    import gevent
+    monkeypatch.setitem(app.config, 'COALESCING', {None: {'window': 0.05, 'max_hold': 1}})
+    ire_96231 = get_ire_data('train_96231_delayed.xml')
+    assert api_post('/ire', data=ire_96231) == 'OK'
+    assert api_post('/ire', data=ire_96231) == 'OK'
+    assert mock_rabbitmq.call_count == 0
+
+    gevent.sleep(0.1)
+
+    check_db_ire_96231_delayed()
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_ire_async_publish(mock_rabbitmq, monkeypatch):
+    """
+    the feeds are published in background, the two feeds are published in one message
+    """
+    import kirin
+    from kirin import gtfs_realtime_pb2
+    from kirin.rabbitmq_handler import RabbitMQHandler
+    handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'], app.config['EXCHANGE'],
+                              async_publish=True, batch_delay=0.2)
+    monkeypatch.setattr(kirin, 'rabbitmq_handler', handler)
+
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    assert mock_rabbitmq.call_count == 0
+
+    handler.join()
+
+    check_db_ire_96231_delayed()
+    check_db_ire_6113_trip_removal()
+    assert mock_rabbitmq.call_count == 1
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(mock_rabbitmq.call_args[0][0])
+    assert len(feed.entity) == 2
+
+    # the exchange is declared only once for a connection
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    handler.join()
+    assert mock_rabbitmq.call_count == 2
+    assert mock_rabbitmq.call_args[1]['declare'] == []
+
+
+def test_ire_async_publish_retry(mock_rabbitmq, monkeypatch):
+    """
+    without spool, a batch that cannot be published is retried, then counted as lost
+    """
+    import kirin
+    from kirin.rabbitmq_handler import RabbitMQHandler
+    handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'], app.config['EXCHANGE'],
+                              async_publish=True, batch_delay=0, retries=2, retry_delay=0.01)
+    monkeypatch.setattr(kirin, 'rabbitmq_handler', handler)
+
+    mock_rabbitmq.side_effect = [IOError('rabbitmq is down'), None]
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    handler.join()
+    assert mock_rabbitmq.call_count == 2
+    assert handler.publication_info()['published'] == 1
+    assert handler.publication_info()['retried'] == 1
+
+    mock_rabbitmq.side_effect = IOError('rabbitmq is down')
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    handler.join()
+    assert mock_rabbitmq.call_count == 5
+    assert handler.publication_info()['lost'] == 1
+
+
+def test_publish_retry_does_not_block_the_others(mock_rabbitmq):
+    """
+    while the feeds of a contributor are retried, the feeds of the others are published,
+    and its next feeds are published after the retried ones
+    """
+    import gevent
+    from kirin.rabbitmq_handler import RabbitMQHandler
+    handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'], app.config['EXCHANGE'],
+                              async_publish=True, batch_delay=0, retries=1, retry_delay=0.2)
+    mock_rabbitmq.side_effect = [IOError('rabbitmq is down'), None, None, None]
+
+    handler.publish('a1', 'a')
+    gevent.sleep(0.05)
+    handler.publish('b1', 'b')
+    handler.publish('a2', 'a')
+    gevent.sleep(0.05)
+    # b has been published during the retry delay of a
+    assert [call[0][0] for call in mock_rabbitmq.call_args_list] == ['a1', 'b1']
+    assert handler.publication_info()['retrying'] == 1
+
+    handler.join()
+    assert [call[0][0] for call in mock_rabbitmq.call_args_list] == ['a1', 'b1', 'a1', 'a2']
+    assert handler.publication_info()['published'] == 3
+    assert handler.publication_info()['retrying'] == 0
+
+
+def test_publish_queue_full(mock_rabbitmq):
+    """
+    when the queue is full the feed is published synchronously, and counted
+    """
+    from kirin.rabbitmq_handler import RabbitMQHandler
+    handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'], app.config['EXCHANGE'],
+                              async_publish=True, queue_size=1, batch_delay=0)
+    handler.publish('a1', 'a')
+    handler.publish('a2', 'a')
+    assert mock_rabbitmq.call_count == 1
+    assert handler.publication_info()['published'] == 1
+
+    handler.join()
+    assert mock_rabbitmq.call_count == 2
+    assert handler.publication_info()['published'] == 2
+
+
+def test_ire_post_rabbitmq_down(mock_rabbitmq, monkeypatch, tmpdir):
+    """
+    the feeds are spooled while rabbitmq is not available, and published in order afterward
+    """
+    import kirin
+    from kirin.rabbitmq_handler import RabbitMQHandler
+    handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'], app.config['EXCHANGE'],
+                              spool_path=str(tmpdir.join('spool')), replay_interval=3600)
+    monkeypatch.setattr(kirin, 'rabbitmq_handler', handler)
+
+    mock_rabbitmq.side_effect = IOError('rabbitmq is down')
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    # the next feed is directly spooled, to be published after the first one
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    assert mock_rabbitmq.call_count == 1
+    check_db_ire_96231_delayed()
+    check_db_ire_6113_trip_removal()
+
+    mock_rabbitmq.side_effect = None
+    assert handler.replay_spool() == 2
+    assert mock_rabbitmq.call_count == 3
+
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    assert mock_rabbitmq.call_count == 4
+
+
+def test_ire_async_post_worker_full(mock_rabbitmq, monkeypatch):
+    """
+    when too many updates are waiting for the worker, the sender has to retry later
+    """
+    import kirin
+    monkeypatch.setitem(app.config, 'IRE_ASYNC_PROCESSING', True)
+    monkeypatch.setattr(kirin.worker, 'max_pending', 0)
+    res, status = api_post('/ire', check=False, data=get_ire_data('train_96231_delayed.xml'))
+    assert status == 503
+
+    with app.app_context():
+        assert len(RealTimeUpdate.query.all()) == 0
+    assert mock_rabbitmq.call_count == 0
+
+
+def test_process_pending_skip_claimed(mock_rabbitmq):
+    """
+    a pending update claimed by another process is not processed twice, unless the claim has expired
+    """
+    from kirin import db
+    from kirin.ire.ire import process_pending, _make_rt_update
+    with app.app_context():
+        rt_update_id = _make_rt_update(get_ire_data('train_96231_delayed.xml'), status='pending').id
+        db.session.execute("UPDATE real_time_update SET processing_started_at = now() AT TIME ZONE 'UTC' "
+                           "WHERE id = :id", {'id': rt_update_id})
+        db.session.commit()
+
+    with app.app_context():
+        process_pending(rt_update_id)
+        assert RealTimeUpdate.query.get(rt_update_id).status == 'pending'
+    assert mock_rabbitmq.call_count == 0
+
+    with app.app_context():
+        db.session.execute("UPDATE real_time_update SET processing_started_at = processing_started_at - "
+                           "interval '1 hour' WHERE id = :id", {'id': rt_update_id})
+        db.session.commit()
+
+    with app.app_context():
+        process_pending(rt_update_id)
+        assert RealTimeUpdate.query.get(rt_update_id).status == 'OK'
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_process_pending_claim_committed(mock_rabbitmq, monkeypatch):
+    """
+    the claim is committed before navitia is called, no lock is held on the real time update
+    """
+    from kirin import db
+    from kirin.ire import ire
+    with app.app_context():
+        rt_update_id = ire._make_rt_update(get_ire_data('train_96231_delayed.xml'), status='pending').id
+
+    process = ire.process
+
+    def check_not_locked(rt_update):
+        other_connection = db.engine.connect()
+        try:
+            # fails if the row is still locked by the claim
+            other_connection.execute('SELECT id FROM real_time_update WHERE id = %s FOR UPDATE NOWAIT',
+                                     rt_update_id)
+        finally:
+            other_connection.close()
+        process(rt_update)
+
+    monkeypatch.setattr(ire, 'process', check_not_locked)
+
+    with app.app_context():
+        ire.process_pending(rt_update_id)
+        assert RealTimeUpdate.query.get(rt_update_id).status == 'OK'
@@ -27,10 +27,12 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
-from kirin.core.model import VehicleJourney, TripUpdate, StopTimeUpdate
+from kirin.core.model import VehicleJourney, TripUpdate, StopTimeUpdate, RealTimeUpdate
 from kirin import db, app
+from tests.check_utils import get_ire_data
 import datetime
 import pytest
+import os
 
 def create_trip_update(vj_id, trip_id, circulation_date):
     trip_update = TripUpdate()
@@ -64,6 +66,26 @@ def test_find_by_vj(setup_database):
 
 
 
+def test_lock_dated_vjs(setup_database):
+    """
+    the trip updates are locked until the end of the transaction
+    """
+    import sqlalchemy
+    with app.app_context():
+        TripUpdate.lock_dated_vjs([('vehicle_journey:1', datetime.date(2015, 9, 8))])
+        other_connection = db.engine.connect()
+        try:
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                other_connection.execute("SELECT 1 FROM trip_update WHERE vj_id = '70866ce8-0638-4fa1-8556-1ddfa22d09d3'"
+                                         " FOR UPDATE NOWAIT")
+            # the other trip updates are not locked
+            other_connection.execute("SELECT 1 FROM trip_update WHERE vj_id = '70866ce8-0638-4fa1-8556-1ddfa22d09d4'"
+                                     " FOR UPDATE NOWAIT")
+        finally:
+            other_connection.close()
+        db.session.rollback()
+
+
 def test_find_stop():
     with app.app_context():
         vj = create_trip_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
@@ -77,3 +99,173 @@ def test_find_stop():
         assert vj.find_stop('sa:1') == st1
         assert vj.find_stop('sa:3') == st3
         assert vj.find_stop('sa:4') is None
+
+
+def test_find_by_dated_vjs(setup_database):
+    with app.app_context():
+        assert TripUpdate.find_by_dated_vjs([]) == {}
+
+        res = TripUpdate.find_by_dated_vjs([('vehicle_journey:1', datetime.date(2015, 9, 8)),
+                                            ('vehicle_journey:1', datetime.date(2015, 9, 9)),
+                                            ('vehicle_journey:2', datetime.date(2015, 9, 9)),
+                                            ('vehicle_journey:3', datetime.date(2015, 9, 8))])
+        assert len(res) == 2
+        assert res[('vehicle_journey:1', datetime.date(2015, 9, 8))].vj_id == '70866ce8-0638-4fa1-8556-1ddfa22d09d3'
+        assert res[('vehicle_journey:2', datetime.date(2015, 9, 9))].vj_id == '70866ce8-0638-4fa1-8556-1ddfa22d09d5'
+
+
+def test_find_stop_occurrences():
+    """
+    the vj serves twice the stop sa:1
+    """
+    with app.app_context():
+        vj = create_trip_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
+        st1 = StopTimeUpdate({'id': 'sa:1'}, None, None)
+        st2 = StopTimeUpdate({'id': 'sa:2'}, None, None)
+        st3 = StopTimeUpdate({'id': 'sa:1'}, None, None)
+        vj.stop_time_updates = [st1, st2, st3]
+
+        assert vj.find_stop('sa:1') == st1
+        assert vj.find_stop('sa:1', occurrence=1) == st3
+        assert vj.find_stop('sa:1', occurrence=2) is None
+        assert vj.find_stop('sa:2', occurrence=1) is None
+
+
+def test_find_stop_index_update():
+    """
+    the stops index must follow the modifications of the stop_time_updates
+    """
+    with app.app_context():
+        vj = create_trip_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
+        st1 = StopTimeUpdate({'id': 'sa:1'}, None, None)
+        vj.stop_time_updates.append(st1)
+        assert vj.find_stop('sa:1') == st1
+        assert vj.find_stop('sa:2') is None
+
+        st2 = StopTimeUpdate({'id': 'sa:2'}, None, None)
+        vj.stop_time_updates.append(st2)
+        assert vj.find_stop('sa:2') == st2
+
+        # a new visit of sa:1 is inserted before the first one
+        st0 = StopTimeUpdate({'id': 'sa:1'}, None, None)
+        vj.stop_time_updates.insert(0, st0)
+        assert vj.find_stop('sa:1') == st0
+        assert vj.find_stop('sa:1', occurrence=1) == st1
+
+        vj.stop_time_updates.remove(st0)
+        assert vj.find_stop('sa:1') == st1
+
+        vj.stop_time_updates = []
+        assert vj.find_stop('sa:1') is None
+        assert vj.find_stop('sa:2') is None
+
+
+def test_find_stop_after_load(setup_database):
+    with app.app_context():
+        trip_update = TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 8))
+        trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, None, None))
+        db.session.commit()
+
+    with app.app_context():
+        trip_update = TripUpdate.find_by_dated_vj('vehicle_journey:1', datetime.date(2015, 9, 8))
+        assert trip_update.find_stop('sa:1') is not None
+        assert trip_update.find_stop('sa:2') is None
+
+
+def test_merge_stop_occurrences():
+    """
+    the second visit of a stop is merged with the second visit
+    """
+    with app.app_context():
+        vj = create_trip_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
+        vj.stop_time_updates = [StopTimeUpdate({'id': 'sa:1'}, datetime.datetime(2015, 9, 8, 8, 0), None),
+                                StopTimeUpdate({'id': 'sa:2'}, datetime.datetime(2015, 9, 8, 8, 10), None),
+                                StopTimeUpdate({'id': 'sa:1'}, datetime.datetime(2015, 9, 8, 8, 20), None)]
+        new_trip_update = TripUpdate()
+        new_trip_update.status = 'update'
+        new_trip_update.stop_time_updates = [
+            StopTimeUpdate({'id': 'sa:2'}, datetime.datetime(2015, 9, 8, 8, 15), None),
+            StopTimeUpdate({'id': 'sa:1'}, datetime.datetime(2015, 9, 8, 8, 5), None),
+            StopTimeUpdate({'id': 'sa:1'}, datetime.datetime(2015, 9, 8, 8, 25), None),
+        ]
+        vj.merge(new_trip_update)
+
+        assert vj.status == 'update'
+        assert [st.departure.minute for st in vj.stop_time_updates] == [5, 15, 25]
+
+
+def test_merge_bumps_the_version():
+    with app.app_context():
+        trip_update = create_trip_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
+        assert trip_update.version == 0
+        new_trip_update = TripUpdate()
+        new_trip_update.status = 'update'
+        trip_update.merge(new_trip_update)
+        assert trip_update.version == 1
+
+
+def _explain(query, **params):
+    """
+    return the plan of the query, sequential scans are disabled since the tables are nearly empty in the tests
+    """
+    db.session.execute('SET LOCAL enable_seqscan = off')
+    plan = db.session.execute('EXPLAIN ' + query, params).fetchall()
+    db.session.rollback()
+    return '\n'.join(row[0] for row in plan)
+
+
+def test_stop_time_updates_by_trip_update_use_index(setup_database):
+    with app.app_context():
+        plan = _explain('SELECT * FROM stop_time_update WHERE trip_update_id = :id',
+                        id='70866ce8-0638-4fa1-8556-1ddfa22d09d3')
+        assert 'ix_stop_time_update_trip_update_id' in plan
+
+
+def test_real_time_updates_by_trip_update_use_index(setup_database):
+    with app.app_context():
+        plan = _explain('SELECT * FROM associate_realtimeupdate_tripupdate WHERE trip_update_id = :id',
+                        id='70866ce8-0638-4fa1-8556-1ddfa22d09d3')
+        assert 'ix_associate_realtimeupdate_tripupdate_trip_update_id' in plan
+
+
+def _ire_fixtures():
+    fixtures_dir = os.path.join(os.path.dirname(__file__), '..', 'fixtures')
+    return [get_ire_data(f).decode('utf-8') for f in sorted(os.listdir(fixtures_dir)) if f.endswith('.xml')]
+
+
+def _raw_data_size(column):
+    return db.session.execute('SELECT sum(pg_column_size({})) FROM real_time_update'.format(column)).scalar()
+
+
+def test_raw_data_compressed(monkeypatch):
+    monkeypatch.setitem(app.config, 'RAW_DATA_COMPRESSION', True)
+    with app.app_context():
+        for raw_data in _ire_fixtures():
+            db.session.add(RealTimeUpdate(raw_data, 'ire'))
+        db.session.commit()
+
+        assert _raw_data_size('raw_data') is None
+        assert sorted(rtu.raw_data for rtu in RealTimeUpdate.query.all()) == sorted(_ire_fixtures())
+
+
+def test_compress_existing_raw_data(monkeypatch):
+    """
+    the raw data stored as text are compressed afterward, it has to take far less space
+    (even if postgres already compresses the biggest texts)
+    """
+    with app.app_context():
+        for raw_data in _ire_fixtures():
+            db.session.add(RealTimeUpdate(raw_data, 'ire'))
+        db.session.commit()
+        uncompressed_size = _raw_data_size('raw_data')
+        assert _raw_data_size('raw_data_compressed') is None
+
+        monkeypatch.setitem(app.config, 'RAW_DATA_COMPRESSION', True)
+        assert RealTimeUpdate.compress_raw_data(batch_size=3) == 3
+        assert RealTimeUpdate.compress_raw_data(batch_size=3) == 1
+        assert RealTimeUpdate.compress_raw_data(batch_size=3) == 0
+
+        compressed_size = _raw_data_size('raw_data_compressed')
+        assert _raw_data_size('raw_data') is None
+        assert compressed_size < uncompressed_size * 2 / 3
+        assert sorted(rtu.raw_data for rtu in RealTimeUpdate.query.all()) == sorted(_ire_fixtures())
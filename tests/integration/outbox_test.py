@@ -0,0 +1,144 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import pytest
+from kirin import app, db, gtfs_realtime_pb2
+from kirin.core.model import OutboxMessage
+from kirin.core.outbox import relay_batch, relay
+from tests import mock_navitia
+from tests.check_utils import api_post, get_ire_data
+
+
+@pytest.fixture(scope='function', autouse=True)
+def navitia(monkeypatch):
+    monkeypatch.setattr('kirin.navitia_client.NavitiaClient.query', mock_navitia.mock_navitia_query)
+
+
+class PublishMock(object):
+    def __init__(self):
+        self.messages = []
+
+    def __call__(self, item, contributor):
+        self.messages.append((contributor, item))
+
+
+def test_outbox_written_with_the_trip_updates(monkeypatch):
+    monkeypatch.setitem(app.config, 'PUBLISH_OUTBOX', True)
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+
+    with app.app_context():
+        messages = OutboxMessage.query.all()
+        assert len(messages) == 1
+        assert messages[0].sent_at is None
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(messages[0].payload)
+        assert len(feed.entity) == 1
+
+
+def test_outbox_relay(monkeypatch):
+    monkeypatch.setitem(app.config, 'PUBLISH_OUTBOX', True)
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+    assert api_post('/ire', data=get_ire_data('train_6113_trip_removal.xml')) == 'OK'
+    assert api_post('/ire', data=get_ire_data('train_96231_delayed.xml')) == 'OK'
+
+    publish = PublishMock()
+    with app.app_context():
+        assert relay_batch(publish, batch_size=2) == 2
+        # the two feeds of the same contributor are published in one message
+        assert len(publish.messages) == 1
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(publish.messages[0][1])
+        assert len(feed.entity) == 2
+
+        assert relay(publish, batch_size=2) == 1
+        assert len(publish.messages) == 2
+        assert all(m.sent_at is not None for m in OutboxMessage.query.all())
+        assert relay(publish) == 0
+
+
+def test_outbox_relay_error():
+    with app.app_context():
+        db.session.add(OutboxMessage(None, 'feed'))
+        db.session.commit()
+
+        def publish(item, contributor):
+            raise IOError('rabbitmq is down')
+
+        with pytest.raises(IOError):
+            relay_batch(publish)
+        # the message will be published by the next relay
+        assert OutboxMessage.query.one().sent_at is None
+
+
+def test_outbox_relay_skip_locked():
+    """
+    the messages locked by another relay are not published twice
+    """
+    with app.app_context():
+        db.session.add(OutboxMessage(None, 'feed 1'))
+        db.session.commit()
+        db.session.add(OutboxMessage(None, 'feed 2'))
+        db.session.commit()
+
+        other_relay = db.engine.connect()
+        transaction = other_relay.begin()
+        other_relay.execute('SELECT id FROM outbox_message ORDER BY id LIMIT 1 FOR UPDATE').fetchall()
+
+        publish = PublishMock()
+        assert relay_batch(publish) == 1
+        assert publish.messages == [(None, 'feed 2')]
+
+        transaction.rollback()
+        other_relay.close()
+
+
+def test_outbox_relay_confirmed_publish(monkeypatch):
+    """
+    the relay publishes synchronously even when the feeds are usually published in background,
+    so the messages are marked as sent only once rabbitmq has them
+    """
+    from mock import MagicMock
+    from kirin.rabbitmq_handler import RabbitMQHandler
+    mock_publish = MagicMock()
+    monkeypatch.setattr('kombu.messaging.Producer.publish', mock_publish)
+    handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'], app.config['EXCHANGE'],
+                              async_publish=True, batch_delay=3600)
+    with app.app_context():
+        db.session.add(OutboxMessage(None, 'feed'))
+        db.session.commit()
+
+        assert relay_batch(handler.publish_confirmed) == 1
+        assert mock_publish.call_count == 1
+        assert OutboxMessage.query.one().sent_at is not None
+
+        db.session.add(OutboxMessage(None, 'feed'))
+        db.session.commit()
+        mock_publish.side_effect = IOError('rabbitmq is down')
+        with pytest.raises(IOError):
+            relay_batch(handler.publish_confirmed)
+        assert OutboxMessage.query.filter(OutboxMessage.sent_at.is_(None)).count() == 1
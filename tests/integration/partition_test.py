@@ -0,0 +1,116 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+import pytest
+import datetime
+from kirin import app, db
+from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney
+from kirin.core import partition
+
+
+@pytest.yield_fixture()
+def no_partitions():
+    """
+    the partitions are tables, they are not removed by the truncate between the tests
+    """
+    yield
+    with app.app_context():
+        for _, name in partition.list_partitions():
+            partition.remove_partition(name)
+        db.session.commit()
+
+
+def _count_in(table):
+    return db.session.execute('SELECT count(*) FROM ONLY {}'.format(table)).scalar()
+
+
+def test_rotate_partitions_creates_next_days(no_partitions):
+    with app.app_context():
+        created, removed = partition.rotate_partitions(datetime.date(2015, 9, 21), days_ahead=2, retention_days=10)
+        assert created == ['real_time_update_20150921', 'real_time_update_20150922', 'real_time_update_20150923']
+        assert removed == []
+        assert [day for day, _ in partition.list_partitions()] == \
+            [datetime.date(2015, 9, 21), datetime.date(2015, 9, 22), datetime.date(2015, 9, 23)]
+
+        # nothing to do the second time
+        assert partition.rotate_partitions(datetime.date(2015, 9, 21), days_ahead=2, retention_days=10) == ([], [])
+
+
+def test_insert_routed_to_partition(no_partitions):
+    with app.app_context():
+        partition.create_partition(datetime.date(2015, 9, 21))
+        db.session.commit()
+
+        db.session.add(RealTimeUpdate(None, 'ire', received_at=datetime.datetime(2015, 9, 21, 15, 2)))
+        # no partition for this day, the row stays in real_time_update
+        db.session.add(RealTimeUpdate(None, 'ire', received_at=datetime.datetime(2015, 9, 22, 8, 0)))
+        db.session.commit()
+
+        assert _count_in('real_time_update_20150921') == 1
+        assert _count_in('real_time_update') == 1
+        assert RealTimeUpdate.query.count() == 2
+
+
+def test_rotate_partitions_drops_old_ones(no_partitions):
+    with app.app_context():
+        partition.create_partition(datetime.date(2015, 9, 1))
+        partition.create_partition(datetime.date(2015, 9, 20))
+        db.session.commit()
+
+        rtu = RealTimeUpdate(None, 'ire', received_at=datetime.datetime(2015, 9, 1, 10, 0))
+        trip_update = TripUpdate()
+        trip_update.vj = VehicleJourney({'id': 'vehicle_journey:1'}, datetime.date(2015, 9, 1))
+        rtu.trip_updates.append(trip_update)
+        db.session.add(rtu)
+        db.session.add(RealTimeUpdate(None, 'ire', received_at=datetime.datetime(2015, 9, 20, 10, 0)))
+        db.session.commit()
+
+        created, removed = partition.rotate_partitions(datetime.date(2015, 9, 21), days_ahead=0, retention_days=10)
+        assert created == ['real_time_update_20150921']
+        assert removed == ['real_time_update_20150901']
+        assert RealTimeUpdate.query.count() == 1
+        assert TripUpdate.query.count() == 1
+        assert TripUpdate.query.first().real_time_updates == []
+        # the association is left to the purge of the trip updates
+        assert _count_in('associate_realtimeupdate_tripupdate') == 1
+
+
+def test_rotate_partitions_detach(no_partitions):
+    with app.app_context():
+        partition.create_partition(datetime.date(2015, 9, 1))
+        db.session.commit()
+        db.session.add(RealTimeUpdate(None, 'ire', received_at=datetime.datetime(2015, 9, 1, 10, 0)))
+        db.session.commit()
+
+        partition.rotate_partitions(datetime.date(2015, 9, 21), days_ahead=0, retention_days=10, detach=True)
+        assert RealTimeUpdate.query.count() == 0
+        # the detached table is kept for archive
+        assert _count_in('real_time_update_20150901') == 1
+        db.session.execute('DROP TABLE real_time_update_20150901')
+        db.session.commit()
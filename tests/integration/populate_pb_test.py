@@ -28,7 +28,8 @@
 # www.navitia.io
 
 from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate
-from kirin.core.populate_pb import convert_to_gtfsrt, to_posix_time
+from kirin.core.populate_pb import convert_to_gtfsrt, to_posix_time, serialize_entity, serialize_feed
+from kirin.cache import LruTtlCache
 import datetime
 from kirin import app, db
 from kirin import gtfs_realtime_pb2
@@ -152,3 +153,81 @@ def test_populate_pb_with_cancelation():
         assert pb_trip_update.trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.CANCELED
 
         assert len(feed_entity.entity[0].trip_update.stop_time_update) == 0
+
+
+def test_serialize_feed():
+    """
+    the feed built from the serialized entities is the same as the one built by protobuf
+    """
+    navitia_vj = {'id': 'vehicle_journey:1', 'stop_times': [
+        {'arrival_time': None, 'departure_time': datetime.time(8, 10), 'stop_point': {'id': 'sa:1'}},
+        {'arrival_time': datetime.time(9, 10), 'departure_time': None, 'stop_point': {'id': 'sa:2'}}
+        ]}
+
+    with app.app_context():
+        trip_update = TripUpdate()
+        trip_update.vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, 8))
+        trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, departure=_dt("8:15"), arrival=None))
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire')
+        real_time_update.trip_updates.append(trip_update)
+        db.session.add(real_time_update)
+        db.session.commit()
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(serialize_feed(real_time_update.trip_updates))
+        expected = convert_to_gtfsrt(real_time_update)
+        expected.header.timestamp = feed.header.timestamp
+        assert feed == expected
+
+
+def test_serialize_entity_cache():
+    """
+    the serialized entity is cached until the version of the trip update changes
+    """
+    navitia_vj = {'id': 'vehicle_journey:1', 'stop_times': [
+        {'arrival_time': None, 'departure_time': datetime.time(8, 10), 'stop_point': {'id': 'sa:1'}}
+        ]}
+
+    with app.app_context():
+        trip_update = TripUpdate()
+        trip_update.vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, 8))
+        trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, departure=_dt("8:15"), arrival=None))
+        db.session.add(trip_update)
+        db.session.commit()
+
+        cache = LruTtlCache(10, 60)
+        entity = serialize_entity(trip_update, cache)
+        assert serialize_entity(trip_update, cache) is entity
+
+        new_trip_update = TripUpdate()
+        new_trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, departure=_dt("8:20"),
+                                                                 arrival=None))
+        trip_update.merge(new_trip_update)
+        db.session.commit()
+
+        new_entity = serialize_entity(trip_update, cache)
+        assert new_entity != entity
+        pb_entity = gtfs_realtime_pb2.FeedEntity()
+        pb_entity.ParseFromString(new_entity)
+        assert pb_entity.trip_update.stop_time_update[0].departure.time == to_posix_time(_dt("8:20"))
+
+
+def test_serialize_entity_not_committed():
+    """
+    the entity of a trip update not committed is not cached, the version could be used again
+    """
+    navitia_vj = {'id': 'vehicle_journey:1', 'stop_times': [
+        {'arrival_time': None, 'departure_time': datetime.time(8, 10), 'stop_point': {'id': 'sa:1'}}
+        ]}
+
+    with app.app_context():
+        trip_update = TripUpdate()
+        trip_update.vj = VehicleJourney(navitia_vj, datetime.date(2015, 9, 8))
+        trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, departure=_dt("8:15"), arrival=None))
+        db.session.add(trip_update)
+        db.session.flush()
+
+        cache = LruTtlCache(10, 60)
+        serialize_entity(trip_update, cache, committed=False)
+        assert cache.get((trip_update.vj_id, trip_update.version)) is None
+        db.session.rollback()
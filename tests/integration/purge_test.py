@@ -0,0 +1,123 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+import pytest
+import datetime
+from kirin import app, db
+from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate, OutboxMessage
+from kirin.core.purge import purge_real_time_updates, purge_trip_updates, purge_outbox
+
+
+def create_trip_update(trip_id, circulation_date, received_at):
+    rtu = RealTimeUpdate('<xml>{}</xml>'.format(trip_id), 'ire', received_at=received_at)
+    trip_update = TripUpdate()
+    trip_update.vj = VehicleJourney({'id': trip_id}, circulation_date)
+    trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, None, None))
+    trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:2'}, None, None))
+    rtu.trip_updates.append(trip_update)
+    db.session.add(rtu)
+
+
+@pytest.fixture()
+def setup_database():
+    with app.app_context():
+        for i in range(5):
+            create_trip_update('vehicle_journey:old_{}'.format(i), datetime.date(2015, 9, 1),
+                               datetime.datetime(2015, 9, 1, 10, i))
+        create_trip_update('vehicle_journey:new', datetime.date(2015, 9, 21), datetime.datetime(2015, 9, 21, 10, 0))
+        db.session.commit()
+
+
+def test_purge_real_time_updates(setup_database):
+    with app.app_context():
+        result = purge_real_time_updates(datetime.datetime(2015, 9, 20), batch_size=2, pause=0)
+        assert result.rows == {'real_time_update': 5}
+        assert result.batches == 3
+        assert result.bytes > 0
+
+        assert [rtu.raw_data for rtu in RealTimeUpdate.query.all()] == ['<xml>vehicle_journey:new</xml>']
+        # the trip updates are kept, only their history is purged
+        assert TripUpdate.query.count() == 6
+        assert db.session.execute('SELECT count(*) FROM associate_realtimeupdate_tripupdate').scalar() == 1
+
+
+def test_purge_trip_updates(setup_database):
+    with app.app_context():
+        result = purge_trip_updates(datetime.date(2015, 9, 20), batch_size=2, pause=0)
+        assert result.rows == {'vehicle_journey': 5, 'trip_update': 5, 'stop_time_update': 10}
+        assert result.batches == 3
+        assert result.bytes > 0
+
+        assert [tu.vj.navitia_id for tu in TripUpdate.query.all()] == ['vehicle_journey:new']
+        assert VehicleJourney.query.count() == 1
+        assert StopTimeUpdate.query.count() == 2
+        assert RealTimeUpdate.query.count() == 6
+
+
+def test_purge_nothing_to_do(setup_database):
+    with app.app_context():
+        result = purge_trip_updates(datetime.date(2015, 9, 1), batch_size=2, pause=0)
+        assert not result.rows
+        assert result.batches == 0
+        assert TripUpdate.query.count() == 6
+
+
+def test_purge_real_time_updates_not_in_partitions(setup_database):
+    """
+    the rows of the partitions are removed with their partition, not by the purge
+    """
+    from kirin.core import partition
+    with app.app_context():
+        partition.create_partition(datetime.date(2015, 9, 2))
+        db.session.commit()
+        db.session.add(RealTimeUpdate(None, 'ire', received_at=datetime.datetime(2015, 9, 2, 10, 0)))
+        db.session.commit()
+        try:
+            result = purge_real_time_updates(datetime.datetime(2015, 9, 20), batch_size=10, pause=0)
+            assert result.rows == {'real_time_update': 5}
+            assert db.session.execute('SELECT count(*) FROM real_time_update_20150902').scalar() == 1
+        finally:
+            partition.remove_partition('real_time_update_20150902')
+            db.session.commit()
+
+
+def test_purge_outbox():
+    """
+    only the messages sent before the date are deleted, the ones not sent are kept
+    """
+    with app.app_context():
+        for sent_at in (datetime.datetime(2015, 9, 1), datetime.datetime(2015, 9, 21), None):
+            message = OutboxMessage(None, 'feed')
+            message.sent_at = sent_at
+            db.session.add(message)
+        db.session.commit()
+
+        result = purge_outbox(datetime.datetime(2015, 9, 20), batch_size=10, pause=0)
+        assert result.rows == {'outbox_message': 1}
+        assert sorted(m.sent_at for m in OutboxMessage.query.all()) == [None, datetime.datetime(2015, 9, 21)]
@@ -33,6 +33,7 @@ def test_end_point():
     resp = api_get('/')
     assert 'status' in resp
     assert 'ire' in resp
+    assert 'gtfs_rt' in resp
 
 
 # Note: for the moment it's not possible to test the /status API because we need a bdd for that
@@ -43,4 +44,12 @@ def test_status():
     assert 'db_pool_status' in resp
     assert 'db_version' in resp
     assert 'navitia_url' in resp
+    assert 'navitia_clients' in resp
+    assert 'vj_catalogue' in resp
+    assert 'ire_deduplicator' in resp
+    assert 'coalescer' in resp
+    assert 'gtfs_rt_feed' in resp
+    assert 'gtfs_rt_entity_cache' in resp
+    assert 'rabbitmq_publication' in resp
+    assert 'navitia_vj_cache' in resp
 
@@ -0,0 +1,115 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import pytest
+from kirin import app
+from kirin.exceptions import NavitiaError
+from kirin.navitia_client import NavitiaClient, get_navitia_client
+
+
+def test_navitia_client_url():
+    client = NavitiaClient(url='http://bob.com/', instance='sncf')
+    assert client.url == 'http://bob.com/v1/coverage/sncf/'
+
+
+def test_vehicle_journeys(monkeypatch):
+    monkeypatch.setattr(NavitiaClient, 'query',
+                        lambda self, query, q=None: ({'vehicle_journeys': [{'id': 'vj:1'}]}, 200))
+    client = NavitiaClient(url='http://bob.com/', instance='sncf')
+    assert client.vehicle_journeys(q={'headsign': '42'}) == [{'id': 'vj:1'}]
+
+
+def test_vehicle_journeys_not_found(monkeypatch):
+    monkeypatch.setattr(NavitiaClient, 'query', lambda self, query, q=None: ({'error': 'no solution'}, 404))
+    client = NavitiaClient(url='http://bob.com/', instance='sncf')
+    assert client.vehicle_journeys(q={'headsign': '42'}) == []
+
+
+def test_vehicle_journeys_error(monkeypatch):
+    monkeypatch.setattr(NavitiaClient, 'query', lambda self, query, q=None: ({'error': 'bobette'}, 500))
+    client = NavitiaClient(url='http://bob.com/', instance='sncf')
+    with pytest.raises(NavitiaError):
+        client.vehicle_journeys(q={'headsign': '42'})
+
+
+def test_navitia_client_is_shared():
+    with app.app_context():
+        client = get_navitia_client('sncf')
+        assert get_navitia_client('sncf') is client
+        assert get_navitia_client('idf') is not client
+
+
+def test_iter_vehicle_journeys(monkeypatch):
+    """
+    navitia has 5 vjs, given 2 by 2
+    """
+    queries = []
+
+    def paged_query(self, query, q=None):
+        queries.append(dict(q))
+        start = int(q['start_page']) * int(q['count'])
+        vjs = [{'id': 'vj:{}'.format(i)} for i in range(start, min(start + int(q['count']), 5))]
+        return {'vehicle_journeys': vjs,
+                'pagination': {'start_page': int(q['start_page']),
+                               'items_on_page': len(vjs),
+                               'items_per_page': int(q['count']),
+                               'total_result': 5}}, 200
+    monkeypatch.setattr(NavitiaClient, 'query', paged_query)
+    client = NavitiaClient(url='http://bob.com/', instance='sncf')
+
+    vjs = list(client.iter_vehicle_journeys(q={'depth': '2'}, count=2))
+
+    assert [vj['id'] for vj in vjs] == ['vj:0', 'vj:1', 'vj:2', 'vj:3', 'vj:4']
+    assert [q['start_page'] for q in queries] == ['0', '1', '2']
+    assert all(q['depth'] == '2' for q in queries)
+
+
+def test_navitia_client_pool_full(monkeypatch):
+    """
+    when all the connections are used, a call fails after the timeout instead of waiting forever
+    """
+    import gevent
+
+    class SlowResponse(object):
+        status_code = 200
+
+        def json(self):
+            return {}
+
+    def slow_get(*args, **kwargs):
+        gevent.sleep(1)
+        return SlowResponse()
+    client = NavitiaClient(url='http://bob.com/', instance='sncf', timeout=0.05, pool_size=1)
+    monkeypatch.setattr(client._session, 'get', slow_get)
+
+    busy = gevent.spawn(client.query, 'vehicle_journeys/')
+    gevent.sleep(0)
+    with pytest.raises(NavitiaError):
+        client.query('vehicle_journeys/')
+    busy.kill()
+    assert client.info()['in_flight'] == 0
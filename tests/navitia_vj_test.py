@@ -0,0 +1,112 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import datetime
+from kirin.core.navitia_vj import NavitiaVJ
+from kirin.ire.model_maker import get_navitia_stop_time
+
+
+def _stop_time(stop_point_id, *codes):
+    return {
+        'stop_point': {
+            'id': stop_point_id,
+            'stop_area': {'codes': [{'type': 'CR-CI-CH', 'value': c} for c in codes] +
+                                   [{'type': 'external_code', 'value': 'OCE' + stop_point_id}]}
+        }
+    }
+
+
+def test_navitia_vj_index():
+    navitia_vj = NavitiaVJ({'id': 'vj:1', 'stop_times': [
+        _stop_time('sp:1', '0087-1-BV'),
+        _stop_time('sp:2', '0087-2-BV', '0087-2-00'),
+        _stop_time('sp:1', '0087-1-BV'),  # the vj serves twice the first stop
+    ]})
+
+    assert navitia_vj.id == 'vj:1'
+    assert len(navitia_vj.stop_times) == 3
+
+    sts = navitia_vj.stop_times_by_stop_point('sp:1')
+    assert sts == [navitia_vj.stop_times[0], navitia_vj.stop_times[2]]
+    assert sts[0] is not sts[1]
+
+    assert navitia_vj.stop_times_by_cr_ci_ch('0087-2-BV') == [navitia_vj.stop_times[1]]
+    assert navitia_vj.stop_times_by_cr_ci_ch('0087-2-00') == [navitia_vj.stop_times[1]]
+    assert len(navitia_vj.stop_times_by_cr_ci_ch('0087-1-BV')) == 2
+    # only the CR-CI-CH codes are indexed
+    assert navitia_vj.stop_times_by_cr_ci_ch('OCEsp:1') == []
+    assert navitia_vj.stop_times_by_stop_point('sp:3') == []
+
+    assert get_navitia_stop_time(navitia_vj, 'sp:1') is navitia_vj.stop_times[0]
+    assert get_navitia_stop_time(navitia_vj, 'sp:3') is None
+
+
+def test_navitia_vj_without_stop_times():
+    navitia_vj = NavitiaVJ({'id': 'vj:1'})
+    assert len(navitia_vj.stop_times) == 0
+    assert navitia_vj.stop_times_by_stop_point('sp:1') == []
+
+
+def test_navitia_vj_compact():
+    """
+    only the fields used by kirin are kept, and the navitia times are converted
+    """
+    navitia_vj = NavitiaVJ({'id': 'vj:1', 'name': '42', 'codes': [], 'journey_pattern': {'route': {}},
+                            'stop_times': [{'arrival_time': '174000',
+                                            'departure_time': '174200',
+                                            'headsign': '42',
+                                            'stop_point': {'id': 'sp:1', 'name': 'bob', 'coord': {}}},
+                                           {'arrival_time': '180000',
+                                            'departure_time': None,
+                                            'stop_point': {'id': 'sp:2'}}]})
+    assert not hasattr(navitia_vj, '__dict__')
+    st = navitia_vj.stop_times[0]
+    assert not hasattr(st, '__dict__')
+    assert st.stop_point_id == 'sp:1'
+    assert st.arrival_time == datetime.time(17, 40)
+    assert st.departure_time == datetime.time(17, 42)
+    assert navitia_vj.stop_times[1].departure_time is None
+
+
+def test_navitia_vj_past_midnight():
+    """
+    the stop times after midnight are the day after the circulation date
+    """
+    navitia_vj = NavitiaVJ({'id': 'vj:1',
+                            'stop_times': [{'arrival_time': None,
+                                            'departure_time': '234500',
+                                            'stop_point': {'id': 'sp:1'}},
+                                           {'arrival_time': '251000',
+                                            'departure_time': None,
+                                            'stop_point': {'id': 'sp:2'}}]})
+    first, last = navitia_vj.stop_times
+    circulation_date = datetime.date(2015, 9, 21)
+    assert first.departure(circulation_date) == datetime.datetime(2015, 9, 21, 23, 45)
+    assert first.arrival(circulation_date) is None
+    assert last.arrival_time == datetime.time(1, 10)
+    assert last.arrival(circulation_date) == datetime.datetime(2015, 9, 22, 1, 10)
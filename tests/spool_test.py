@@ -0,0 +1,157 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+from kirin.spool import Spool
+import os
+import pytest
+
+
+@pytest.fixture()
+def spool(tmpdir):
+    return Spool(str(tmpdir.join('spool')))
+
+
+def test_spool_replay_in_order(spool):
+    assert spool.is_empty()
+    spool.append('realtime.ire', 'feed 1')
+    spool.append(None, 'feed 2')
+    assert not spool.is_empty()
+
+    published = []
+    assert spool.replay(lambda item, contributor: published.append((contributor, item))) == 2
+    assert published == [('realtime.ire', 'feed 1'), (None, 'feed 2')]
+    assert spool.is_empty()
+    assert not os.path.exists(spool.path)
+
+
+def test_spool_replay_error(spool):
+    """
+    the replay stops at the first error, the other messages are replayed the next time
+    """
+    for i in range(4):
+        spool.append('realtime.ire', 'feed {}'.format(i))
+
+    published = []
+
+    def publish(item, contributor):
+        if item == 'feed 2':
+            raise IOError('rabbitmq is down')
+        published.append(item)
+
+    with pytest.raises(IOError):
+        spool.replay(publish)
+    assert published == ['feed 0', 'feed 1']
+
+    spool.append('realtime.ire', 'feed 4')
+    assert spool.replay(lambda item, contributor: published.append(item)) == 3
+    assert published == ['feed 0', 'feed 1', 'feed 2', 'feed 3', 'feed 4']
+
+
+def test_spool_incomplete_record(spool):
+    """
+    kirin has been stopped while writing the last record, it is ignored
+    """
+    spool.append('realtime.ire', 'feed 1')
+    spool.append('realtime.ire', 'feed 2')
+    with open(spool.path, 'r+b') as f:
+        f.truncate(spool.size() - 2)
+
+    published = []
+    assert spool.replay(lambda item, contributor: published.append(item)) == 1
+    assert published == ['feed 1']
+
+
+def test_spool_append_after_incomplete_record(spool):
+    """
+    the incomplete record is removed, the records appended after it are read
+    """
+    spool.append('realtime.ire', 'feed 1')
+    spool.append('realtime.ire', 'feed 2')
+    with open(spool.path, 'r+b') as f:
+        f.truncate(spool.size() - 2)
+    spool.append('realtime.ire', 'feed 3')
+
+    published = []
+    assert spool.replay(lambda item, contributor: published.append(item)) == 2
+    assert published == ['feed 1', 'feed 3']
+    assert spool.is_empty()
+
+
+def test_spool_incomplete_record_of_another_process(spool):
+    """
+    another process has been stopped while writing a record after the last one of this process,
+    it is removed by the next append
+    """
+    spool.append('realtime.ire', 'feed 1')
+    Spool(spool.path).append('realtime.ire', 'feed 2')
+    with open(spool.path, 'ab') as f:
+        f.write('\x00\x00')
+    spool.append('realtime.ire', 'feed 3')
+
+    published = []
+    assert spool.replay(lambda item, contributor: published.append(item)) == 3
+    assert published == ['feed 1', 'feed 2', 'feed 3']
+
+
+def test_spool_append_after_replay_of_another_process(spool):
+    """
+    the spool has been rewritten by the replay of another process, the records are read again
+    """
+    spool.append('realtime.ire', 'feed 1')
+    spool.append('realtime.ire', 'feed 2')
+
+    def publish_first(item, contributor):
+        if item != 'feed 1':
+            raise IOError('rabbitmq is down')
+    other = Spool(spool.path)
+    with pytest.raises(IOError):
+        other.replay(publish_first)
+    # the offset known by this process is now in the middle of 'feed 3', not at the end of a record
+    other.append('realtime.ire', 'feed 3, longer than the others')
+    other.append('realtime.ire', 'feed 4')
+    with open(spool.path, 'ab') as f:
+        f.write('\x00\x00')
+    spool.append('realtime.ire', 'feed 5')
+
+    published = []
+    assert spool.replay(lambda item, contributor: published.append(item)) == 4
+    assert published == ['feed 2', 'feed 3, longer than the others', 'feed 4', 'feed 5']
+
+
+def test_spool_replayed_by_one_process(spool):
+    """
+    the spool is not replayed while another process replays it
+    """
+    import fcntl
+    spool.append('realtime.ire', 'feed 1')
+    published = []
+    with open(spool.path + '.replay.lock', 'a') as other_process_lock:
+        fcntl.flock(other_process_lock, fcntl.LOCK_EX)
+        assert Spool(spool.path).replay(lambda item, contributor: published.append(item)) == 0
+    assert published == []
+    assert Spool(spool.path).replay(lambda item, contributor: published.append(item)) == 1
@@ -0,0 +1,121 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import datetime
+from kirin.vj_catalogue import VJCatalogue
+
+
+class FakeNavitia(object):
+    """
+    navitia with 2 vjs by day, the train 42 runs only the first day
+    """
+    def __init__(self):
+        self.queries = []
+
+    def iter_vehicle_journeys(self, q=None, count=1000):
+        self.queries.append(q)
+        day = q['since'][:8]
+        if day == '20150921':
+            yield {'id': 'vj:42', 'name': '42', 'links': [], 'journey_pattern': {'route': {}},
+                   'stop_times': [{'arrival_time': '101000', 'departure_time': '101200',
+                                   'stop_point': {'id': 'sp:1', 'name': 'bob', 'coord': {},
+                                                  'stop_area': {'codes': [{'type': 'CR-CI-CH',
+                                                                           'value': '0087-1-BV'},
+                                                                          {'type': 'external_code',
+                                                                           'value': 'OCE1'}]}}}]}
+        yield {'id': 'vj:43:' + day, 'name': '43', 'stop_times': []}
+
+
+def test_catalogue_load():
+    catalogue = VJCatalogue()
+    navitia = FakeNavitia()
+    days = [datetime.date(2015, 9, 21), datetime.date(2015, 9, 22)]
+    catalogue.load(navitia, days)
+
+    assert len(navitia.queries) == 2
+    assert navitia.queries[0]['since'] == '20150921T000000'
+    assert navitia.queries[0]['until'] == '20150922T000000'
+    assert catalogue.days == days
+
+    vjs = catalogue.get('42', datetime.date(2015, 9, 21))
+    assert len(vjs) == 1
+    assert vjs[0].id == 'vj:42'
+    assert len(vjs[0].stop_times) == 1
+    assert vjs[0].stop_times_by_cr_ci_ch('0087-1-BV') == vjs[0].stop_times
+    assert vjs[0].stop_times_by_stop_point('sp:1') == vjs[0].stop_times
+    assert vjs[0].stop_times[0].stop_point_id == 'sp:1'
+    assert vjs[0].stop_times[0].arrival_time == datetime.time(10, 10)
+    assert vjs[0].stop_times[0].departure_time == datetime.time(10, 12)
+
+    assert catalogue.get('42', datetime.date(2015, 9, 22)) is None
+    assert [vj.id for vj in catalogue.get('43', datetime.date(2015, 9, 22))] == ['vj:43:20150922']
+    # not loaded day
+    assert catalogue.get('43', datetime.date(2015, 9, 23)) is None
+
+    catalogue.clear()
+    assert catalogue.get('42', datetime.date(2015, 9, 21)) is None
+
+
+def test_catalogue_headsign_normalized():
+    """
+    the vjs are found with the same train numbers as the navitia queries
+    """
+    class ParityNavitia(object):
+        def iter_vehicle_journeys(self, q=None, count=1000):
+            yield {'id': 'vj:96230', 'name': '096230',
+                   'stop_times': [{'headsign': '096230', 'departure_time': '101200', 'stop_point': {'id': 'sp:1'}},
+                                  {'headsign': '096231', 'arrival_time': '111000', 'stop_point': {'id': 'sp:2'}}]}
+
+    catalogue = VJCatalogue()
+    day = datetime.date(2015, 9, 21)
+    catalogue.load(ParityNavitia(), [day])
+
+    assert [vj.id for vj in catalogue.get('96230', day)] == ['vj:96230']
+    assert [vj.id for vj in catalogue.get('096231', day)] == ['vj:96230']
+
+
+def test_catalogue_time_window():
+    """
+    like the navitia queries, only the vjs circulating in the time window are returned
+    """
+    class TwoVJsNavitia(object):
+        def iter_vehicle_journeys(self, q=None, count=1000):
+            yield {'id': 'vj:morning', 'name': '42',
+                   'stop_times': [{'departure_time': '081200', 'stop_point': {'id': 'sp:1'}}]}
+            yield {'id': 'vj:evening', 'name': '42',
+                   'stop_times': [{'departure_time': '201200', 'stop_point': {'id': 'sp:1'}}]}
+
+    catalogue = VJCatalogue()
+    day = datetime.date(2015, 9, 21)
+    catalogue.load(TwoVJsNavitia(), [day])
+
+    assert len(catalogue.get('42', day)) == 2
+    vjs = catalogue.get('42', day, datetime.datetime(2015, 9, 21, 19, 0), datetime.datetime(2015, 9, 21, 22, 0))
+    assert [vj.id for vj in vjs] == ['vj:evening']
+    assert catalogue.get('42', day, datetime.datetime(2015, 9, 21, 12, 0), datetime.datetime(2015, 9, 21, 14, 0)) \
+        is None
@@ -0,0 +1,72 @@
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import gevent
+from kirin import app
+from kirin.worker import Worker
+
+
+def test_same_key_in_order():
+    """
+    the tasks of a key are run one after the other, even if some greenlets are free
+    """
+    worker = Worker(app, 5)
+    done = []
+
+    def task(name, duration):
+        gevent.sleep(duration)
+        done.append(name)
+
+    worker.spawn(task, 'first', 0.05, key='6113')
+    worker.spawn(task, 'second', 0, key='6113')
+    worker.spawn(task, 'other', 0.01, key='96231')
+    worker.join()
+    assert done == ['other', 'first', 'second']
+
+
+def test_spawn_does_not_block():
+    worker = Worker(app, 1, max_pending=2)
+    done = []
+    worker.spawn(gevent.sleep, 0.05)
+    assert not worker.is_full()
+    worker.spawn(done.append, 1)
+    assert worker.is_full()
+    assert worker.info()['pending'] == 2
+
+    worker.join()
+    assert done == [1]
+    assert not worker.is_full()
+
+
+def test_failed_task():
+    worker = Worker(app, 1)
+    done = []
+    worker.spawn(lambda: 1 / 0, key='6113')
+    worker.spawn(done.append, 1, key='6113')
+    worker.join()
+    assert done == [1]